@@ -1,15 +1,36 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory, abort, stream_with_context, get_template_attribute, Response
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from jinja2 import FileSystemBytecodeCache
 from functools import wraps
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import hmac
 import os
 import re
-import json
 from models.database import init_db, get_db
+from models.patients import search_patients, typeahead_cache
+from models.consultations import get_waiting_queue
+from models.sessions import session_cache, check_session
+from models.dashboard import get_dashboard_stats
+from models.lab_tests import get_lab_tests, add_exam_tests, get_exam_tests, get_pending_tests
+from models.appointments import CALENDAR_VIEWS, calendar_range, shift_anchor, get_calendar, parse_time, book_appointment, slot_availability
+from models.archive import ArchiveWorker, queue_patient_archive, get_archived_patient, search_archived_patients
+from models.inventory import stock_cache, receive_stock, reserve_stock, dispense_stock, release_reservations
+from models.prescriptions import add_prescription_items, get_prescription_items, medicine_usage, get_account_queue, get_pharmacy_queue
+from models.worklist import LAB_PRIORITIES, get_queue_summary, claim_next, release_claim, get_claimed_tests, workable_tests, get_lab_queue
+from models.history import parse_history_params, get_patient_history_version, history_etag, stream_patient_history
+from models.uploads import StreamingUploadRequest
+from models.previews import PreviewGenerator
+from models.fragments import fragment_cache
+from models.events import EVENT_TOPICS, QueueEventBus, latest_event_id, get_events_since
+from models.vitals import parse_blood_pressure, parse_trend_params, get_vitals_trends, read_vitals_batch, ingest_vitals
+from models.workflow import move_to, get_flow, get_flow_metrics
+from models.audit import AuditLog, get_audit_events
+from models.profiling import Profiler
 from config import config
 
 app = Flask(__name__)
+app.request_class = StreamingUploadRequest
 
 # Load configuration from config.py
 config_name = os.environ.get('FLASK_ENV', 'development')
@@ -19,23 +40,27 @@ app.config.from_object(config[config_name])
 if not os.environ.get('SECRET_KEY') and config_name == 'development':
     print("WARNING: Using default SECRET_KEY. Set SECRET_KEY environment variable in production!")
 
+# Must be set before the first template is loaded
+if app.config['TEMPLATE_BYTECODE_CACHE']:
+    os.makedirs(app.config['TEMPLATE_BYTECODE_CACHE'], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_BYTECODE_CACHE'])
+fragment_cache.max_bytes = app.config['FRAGMENT_CACHE_MAX_BYTES']
+app.jinja_env.globals['cache_fragment'] = fragment_cache.fragment
+
+# Request profiling; when off nothing is hooked in and connections are plain sqlite3
+profiler = Profiler(slow_query_ms=app.config['SLOW_QUERY_MS'])
+if app.config['PROFILING_ENABLED']:
+    profiler.init_app(app)
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-def validate_file_size(file, max_size_mb=10):
-    """Validate file size. Returns True if valid, False otherwise."""
-    file.seek(0, 2)  # Seek to end of file
-    file_size = file.tell()  # Get file size
-    file.seek(0)  # Reset to beginning
-    max_size_bytes = max_size_mb * 1024 * 1024
-    return file_size <= max_size_bytes
-
 def sanitize_input(text, max_length=1000):
     if not text:
         return text
     # Remove HTML tags and dangerous characters but preserve apostrophes for names like O'Brien
     text = re.sub(r'<[^>]*>', '', str(text))
-    text = re.sub(r'[<>"']', '', text)
+    text = re.sub(r'[<>"]', '', text)
     text = text.strip()
     # Limit length to prevent database issues
     if len(text) > max_length:
@@ -48,6 +73,79 @@ with app.app_context():
 from models.database import close_db
 app.teardown_appcontext(close_db)
 
+session_cache.ttl = app.config['SESSION_CACHE_TTL']
+typeahead_cache.max_entries = app.config['PATIENT_TYPEAHEAD_CACHE_SIZE']
+
+stock_cache.refresh_interval = app.config['STOCK_CACHE_REFRESH']
+with app.app_context():
+    stock_cache.rebuild(get_db())
+
+lab_previews = PreviewGenerator(
+    app.config['UPLOAD_FOLDER'],
+    app.config['LAB_PREVIEW_FOLDER'],
+    size=app.config['LAB_PREVIEW_SIZE'],
+    max_bytes=app.config['LAB_PREVIEW_CACHE_MAX_BYTES'],
+    workers=app.config['LAB_PREVIEW_WORKERS']
+)
+
+queue_events = QueueEventBus(
+    app,
+    poll_interval=app.config['QUEUE_EVENTS_POLL_INTERVAL'],
+    buffer_size=app.config['QUEUE_EVENTS_BUFFER'],
+    max_streams=app.config['QUEUE_EVENTS_MAX_STREAMS'],
+    retention=app.config['QUEUE_EVENTS_RETENTION']
+)
+
+audit_log = AuditLog(
+    app,
+    app.config['AUDIT_SPOOL_FOLDER'],
+    batch_size=app.config['AUDIT_BATCH_SIZE'],
+    flush_interval=app.config['AUDIT_FLUSH_INTERVAL'],
+    max_backlog=app.config['AUDIT_MAX_BACKLOG']
+)
+
+def audit(action, patient_id=None, entity=None, entity_id=None, **details):
+    """Record who did what; call after the change is committed"""
+    audit_log.record(action, session.get('username'), patient_id, entity, entity_id, details or None)
+
+archive_worker = ArchiveWorker(
+    app,
+    interval=app.config['ARCHIVE_INTERVAL'],
+    batch_size=app.config['ARCHIVE_BATCH_SIZE'],
+    gc_interval=app.config['LAB_FILE_GC_INTERVAL'],
+    on_files_removed=lab_previews.discard
+)
+
+# Process that last started the background jobs
+_background_jobs_pid = None
+
+def start_background_jobs():
+    """Start this process's archive job and queue event pruning. run.py
+    calls it when a worker starts; other servers get it on the first
+    request. Calling it again is a no-op while the threads run."""
+    global _background_jobs_pid
+    _background_jobs_pid = os.getpid()
+    archive_worker.start()
+    queue_events.start()
+
+@app.before_request
+def ensure_background_jobs():
+    # Checked without the jobs' locks: only the first request of a process
+    # (or of a forked child) pays for starting them
+    if _background_jobs_pid != os.getpid():
+        start_background_jobs()
+
+def lab_preview_url(image_path):
+    """Preview URL for a stored lab result path, or None if none can be made"""
+    if not image_path:
+        return None
+    filename = image_path.rsplit('/', 1)[-1]
+    if not lab_previews.can_preview(filename):
+        return None
+    # Served through the route so each view counts for the LRU cache, and a
+    # preview not generated yet (or evicted) is filled in on demand
+    return url_for('lab_result_preview', filename=filename)
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -56,13 +154,10 @@ def login_required(f):
             return redirect(url_for('login'))
         
         # Validate that the user still exists and session is valid
+        # (cached per process, see models/sessions.py)
         if 'username' in session:
-            db = get_db()
-            user = db.execute(
-                'SELECT id FROM users WHERE id = ? AND username = ?',
-                (session['user_id'], session['username'])
-            ).fetchone()
-            if not user:
+            if not check_session(session['user_id'], session['username'],
+                                 session.get('session_version', 0)):
                 session.clear()
                 flash('Your session has expired. Please log in again.', 'warning')
                 return redirect(url_for('login'))
@@ -96,15 +191,20 @@ def login():
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['role'] = user['role']
+            session['session_version'] = user['session_version']
+            audit('login')
             flash(f'Welcome back, {user["full_name"]}!', 'success')
             return redirect(url_for('dashboard'))
         else:
+            audit_log.record('login_failed', username)
             flash('Invalid username or password', 'error')
     
     return render_template('login.html')
 
 @app.route('/logout')
 def logout():
+    if 'username' in session:
+        audit('logout')
     session.clear()
     flash('You have been logged out successfully.', 'info')
     return redirect(url_for('login'))
@@ -114,20 +214,9 @@ def logout():
 def dashboard():
     db = get_db()
     
-    total_patients = db.execute('SELECT COUNT(*) as count FROM patients').fetchone()['count']
+    counters = get_dashboard_stats(db)
+    today = counters['stats_date']
     
-    today = datetime.now().strftime('%Y-%m-%d')
-    today_appointments = db.execute(
-        'SELECT COUNT(*) as count FROM appointments WHERE date = ?', (today,)
-    ).fetchone()['count']
-    
-    # last 24hrs vitals
-    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S')
-    recent_vitals = db.execute(
-        'SELECT COUNT(*) as count FROM vitals WHERE recorded_at > ?', (yesterday,)
-    ).fetchone()['count']
-    
-
     upcoming = db.execute(
         '''SELECT a.*, p.name as patient_name 
            FROM appointments a
@@ -138,9 +227,9 @@ def dashboard():
     ).fetchall()
     
     stats = {
-        'total_patients': total_patients,
-        'today_appointments': today_appointments,
-        'recent_vitals': recent_vitals
+        'total_patients': counters['total_patients'],
+        'today_appointments': counters['today_appointments'],
+        'today_vitals': counters['today_vitals']
     }
     
     return render_template('dashboard.html', stats=stats, upcoming=upcoming)
@@ -150,11 +239,13 @@ def dashboard():
 @login_required
 def patients():
     db = get_db()
-    patients_list = db.execute(
-        'SELECT * FROM patients ORDER BY name'
-    ).fetchall()
+    query = request.args.get('q', '')
+    patients_list, next_cursor = search_patients(
+        db, query, request.args.get('cursor'), app.config['ITEMS_PER_PAGE']
+    )
     today = datetime.now().strftime('%Y-%m-%d')
-    return render_template('patients.html', patients=patients_list, today=today)
+    return render_template('patients.html', patients=patients_list, today=today,
+                           query=query, next_cursor=next_cursor)
 
 @app.route('/patients/add', methods=['POST'])
 @login_required
@@ -167,7 +258,7 @@ def add_patient():
         address = sanitize_input(request.form.get('address', ''))
         department = sanitize_input(request.form.get('department', ''))
         
-        db.execute(
+        cursor = db.execute(
             '''INSERT INTO patients (name, date_of_birth, gender, blood_type, allergies, contact, address, department, payment_method)
                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
             (name, request.form['date_of_birth'], request.form['gender'],
@@ -175,6 +266,7 @@ def add_patient():
              request.form['contact'], address, department, request.form['payment_method'])
         )
         db.commit()
+        audit('patient_added', cursor.lastrowid, 'patient', cursor.lastrowid)
         flash('Patient added successfully!', 'success')
     except KeyError as e:
         db.rollback()
@@ -204,6 +296,7 @@ def edit_patient(id):
              request.form['contact'], address, department, request.form['payment_method'], id)
         )
         db.commit()
+        audit('patient_updated', id, 'patient', id)
         flash('Patient updated successfully!', 'success')
     except KeyError as e:
         db.rollback()
@@ -217,8 +310,12 @@ def edit_patient(id):
 @login_required
 def delete_patient(id):
     db = get_db()
+    prescription_ids = [row['id'] for row in db.execute('SELECT id FROM prescriptions WHERE patient_id=?', (id,))]
+    release_reservations(db, prescription_ids, session['username'])
     db.execute('DELETE FROM patients WHERE id=?', (id,))
     db.commit()
+    audit('patient_deleted', id, 'patient', id)
+    stock_cache.refresh(db)
     flash('Patient deleted successfully!', 'info')
     return redirect(url_for('patients'))
 
@@ -227,8 +324,6 @@ def delete_patient(id):
 @login_required
 def vitals():
     db = get_db()
-    patients_list = db.execute('SELECT * FROM patients ORDER BY name').fetchall()
-    
     recent_vitals = db.execute(
         '''SELECT v.*, p.name as patient_name
            FROM vitals v
@@ -237,7 +332,7 @@ def vitals():
            LIMIT 20'''
     ).fetchall()
     
-    return render_template('vitals.html', patients=patients_list, vitals=recent_vitals)
+    return render_template('vitals.html', vitals=recent_vitals)
 
 @app.route('/vitals/add', methods=['POST'])
 @login_required
@@ -246,17 +341,22 @@ def add_vitals():
     try:
         # Sanitize notes input
         notes = sanitize_input(request.form.get('notes', ''))
+        systolic, diastolic = parse_blood_pressure(request.form['blood_pressure'])
+        if systolic is None:
+            flash('Blood pressure must be entered as systolic/diastolic, e.g. 120/80', 'error')
+            return redirect(url_for('vitals'))
         
-        db.execute(
-            '''INSERT INTO vitals (patient_id, blood_pressure, heart_rate, temperature, 
+        cursor = db.execute(
+            '''INSERT INTO vitals (patient_id, blood_pressure, systolic, diastolic, heart_rate, temperature, 
                respiratory_rate, oxygen_saturation, notes, recorded_by)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-            (request.form['patient_id'], request.form['blood_pressure'],
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (request.form['patient_id'], f'{systolic}/{diastolic}', systolic, diastolic,
              request.form['heart_rate'], request.form['temperature'],
-             request.form['respiratory_rate'], request.form.get('oxygen_saturation'),
+             request.form['respiratory_rate'], request.form.get('oxygen_saturation') or None,
              notes, session['username'])
         )
         db.commit()
+        audit('vitals_recorded', request.form.get('patient_id', type=int), 'vitals', cursor.lastrowid)
         flash('Vital signs recorded successfully!', 'success')
     except KeyError as e:
         db.rollback()
@@ -266,20 +366,103 @@ def add_vitals():
         flash(f'Error recording vitals: {str(e)}', 'error')
     return redirect(url_for('vitals'))
 
+@app.route('/api/vitals/batch', methods=['POST'])
+@login_required
+def api_vitals_batch():
+    """Record many readings at once, from a JSON array or NDJSON body.
+
+    Valid readings are inserted in one transaction and invalid ones are
+    reported by row; with ?all_or_nothing=1 one bad row rejects the batch.
+    """
+    db = get_db()
+    ndjson = request.mimetype in ('application/x-ndjson', 'application/jsonl')
+    all_or_nothing = request.args.get('all_or_nothing') in ('1', 'true')
+    try:
+        readings = read_vitals_batch(request.stream, ndjson, app.config['VITALS_BATCH_MAX_ROWS'])
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    try:
+        inserted, errors = ingest_vitals(db, readings, session['username'], sanitize_input, all_or_nothing)
+        db.commit()
+        if inserted:
+            audit('vitals_batch_recorded', inserted=inserted, rejected=len(errors))
+    except Exception as e:
+        db.rollback()
+        return jsonify({'success': False, 'error': f'Error recording vitals: {str(e)}'}), 500
+    return jsonify({
+        'success': not errors,
+        'received': len(readings),
+        'inserted': inserted,
+        'errors': errors
+    }), 400 if errors and not inserted else 200
+
 @app.route('/appointments')
 @login_required
 def appointments():
     db = get_db()
-    patients_list = db.execute('SELECT * FROM patients ORDER BY name').fetchall()
     
-    all_appointments = db.execute(
-        '''SELECT a.*, p.name as patient_name
-           FROM appointments a
-           JOIN patients p ON a.patient_id = p.id
-           ORDER BY a.date DESC, a.time DESC'''
-    ).fetchall()
+    # Only the selected day, week or month is loaded
+    view, anchor = calendar_params(request.args)
+    start, end = calendar_range(view, anchor)
+    calendar = get_calendar(db, start, end)
     
-    return render_template('appointments.html', patients=patients_list, appointments=all_appointments)
+    return render_template('appointments.html', appointments=calendar,
+                           view=view, anchor=anchor, start=start, end=end - timedelta(days=1),
+                           previous=shift_anchor(view, anchor, -1), next=shift_anchor(view, anchor, 1),
+                           today=datetime.now().date())
+
+def calendar_params(args):
+    """view (day/week/month, default week) and anchor date from the query string"""
+    view = args.get('view', 'week')
+    if view not in CALENDAR_VIEWS:
+        view = 'week'
+    try:
+        anchor = date.fromisoformat(args['date']) if args.get('date') else datetime.now().date()
+    except ValueError:
+        anchor = datetime.now().date()
+    return view, anchor
+
+@app.route('/api/appointments/calendar')
+@login_required
+def api_appointment_calendar():
+    """Appointments of one day, week or month (?view=&date=&status=)"""
+    db = get_db()
+    view = request.args.get('view', 'week')
+    if view not in CALENDAR_VIEWS:
+        return jsonify({'success': False, 'error': 'view must be day, week or month'}), 400
+    try:
+        anchor = date.fromisoformat(request.args['date']) if request.args.get('date') else datetime.now().date()
+    except ValueError:
+        return jsonify({'success': False, 'error': 'date must be YYYY-MM-DD'}), 400
+    start, end = calendar_range(view, anchor)
+    rows = get_calendar(db, start, end, request.args.get('status'))
+    return jsonify({
+        'success': True,
+        'view': view,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'appointments': [dict(row, date=row['date'].isoformat()) for row in rows]
+    })
+
+@app.route('/api/appointments/slots')
+@login_required
+def api_appointment_slots():
+    """Booked and free places per slot of one clinic day (?date=)"""
+    db = get_db()
+    try:
+        day = date.fromisoformat(request.args.get('date', ''))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'date must be YYYY-MM-DD'}), 400
+    return jsonify({
+        'success': True,
+        'date': day.isoformat(),
+        'slot_minutes': app.config['APPOINTMENT_SLOT_MINUTES'],
+        'slots': slot_availability(
+            db, day,
+            app.config['APPOINTMENT_DAY_START'], app.config['APPOINTMENT_DAY_END'],
+            app.config['APPOINTMENT_SLOT_MINUTES'], app.config['APPOINTMENT_SLOT_CAPACITY']
+        )
+    })
 
 @app.route('/appointments/add', methods=['POST'])
 @login_required
@@ -305,14 +488,24 @@ def add_appointment():
             flash('Cannot schedule appointments more than 1 year in advance!', 'error')
             return redirect(url_for('appointments'))
         
-        db.execute(
-            '''INSERT INTO appointments (patient_id, date, time, reason, status)
-               VALUES (?, ?, ?, ?, ?)''',
-            (request.form['patient_id'], appt_date_str,
-             request.form['time'], request.form['reason'], 'scheduled')
+        appt_time = request.form['time']
+        try:
+            parse_time(appt_time)
+        except ValueError:
+            flash('Invalid time format!', 'error')
+            return redirect(url_for('appointments'))
+        
+        appointment_id = book_appointment(
+            db, request.form['patient_id'], appt_date, appt_time, request.form['reason'],
+            app.config['APPOINTMENT_SLOT_MINUTES'], app.config['APPOINTMENT_SLOT_CAPACITY']
         )
-        db.commit()
+        if appointment_id is None:
+            flash(f'The {appt_time} slot on {appt_date_str} is already fully booked. Please choose another time.', 'error')
+            return redirect(url_for('appointments', view='day', date=appt_date_str))
+        audit('appointment_booked', request.form.get('patient_id', type=int), 'appointment', appointment_id,
+              date=appt_date_str, time=appt_time)
         flash('Appointment scheduled successfully!', 'success')
+        return redirect(url_for('appointments', view='week', date=appt_date_str))
     except KeyError as e:
         db.rollback()
         flash(f'Missing field: {str(e)}. Please refresh the page and try again.', 'error')
@@ -321,12 +514,17 @@ def add_appointment():
         flash(f'Error scheduling appointment: {str(e)}', 'error')
     return redirect(url_for('appointments'))
 
+def appointment_patient(db, appointment_id):
+    row = db.execute('SELECT patient_id FROM appointments WHERE id=?', (appointment_id,)).fetchone()
+    return row['patient_id'] if row else None
+
 @app.route('/appointments/update/<int:id>/<status>')
 @login_required
 def update_appointment_status(id, status):
     db = get_db()
     db.execute('UPDATE appointments SET status=? WHERE id=?', (status, id))
     db.commit()
+    audit('appointment_status_changed', appointment_patient(db, id), 'appointment', id, status=status)
     flash(f'Appointment marked as {status}!', 'success')
     return redirect(url_for('appointments'))
 
@@ -334,8 +532,10 @@ def update_appointment_status(id, status):
 @login_required
 def delete_appointment(id):
     db = get_db()
+    patient_id = appointment_patient(db, id)
     db.execute('DELETE FROM appointments WHERE id=?', (id,))
     db.commit()
+    audit('appointment_deleted', patient_id, 'appointment', id)
     flash('Appointment deleted successfully!', 'info')
     return redirect(url_for('appointments'))
 
@@ -343,45 +543,12 @@ def delete_appointment(id):
 @login_required
 def consultations():
     db = get_db()
-    consultations_list = db.execute(
-        '''SELECT c.*, p.name, p.date_of_birth, p.gender, p.blood_type, 
-                  p.allergies, p.contact, p.address, p.department, p.payment_method
-           FROM consultations c
-           JOIN patients p ON c.patient_id = p.id
-           WHERE c.status = 'waiting'
-           ORDER BY c.created_at ASC'''
-    ).fetchall()
+    # Read before the queue, so the page's live updates start from here
+    last_event_id = latest_event_id(db)
+    consultations_list = get_waiting_queue(db)
     
-    # Check exam and diagnosis status for each consultation
-    enhanced_consultations = []
-    for consult in consultations_list:
-        consult_dict = dict(consult)
-        
-        # Check if exam exists and its status
-        exam = db.execute(
-            'SELECT id, status FROM exams WHERE consultation_id = ? ORDER BY created_at DESC LIMIT 1',
-            (consult['id'],)
-        ).fetchone()
-        consult_dict['has_exam'] = exam is not None
-        consult_dict['exam_status'] = exam['status'] if exam else None
-        
-        # Check if diagnosis exists
-        diagnosis = db.execute(
-            'SELECT id FROM diagnoses WHERE consultation_id = ? LIMIT 1',
-            (consult['id'],)
-        ).fetchone()
-        consult_dict['has_diagnosis'] = diagnosis is not None
-        
-        # Check if prescription exists
-        prescription = db.execute(
-            'SELECT id FROM prescriptions WHERE consultation_id = ? LIMIT 1',
-            (consult['id'],)
-        ).fetchone()
-        consult_dict['has_prescription'] = prescription is not None
-        
-        enhanced_consultations.append(consult_dict)
-    
-    return render_template('consultations.html', consultations=enhanced_consultations)
+    return render_template('consultations.html', consultations=consultations_list, lab_tests=get_lab_tests(db),
+                           last_event_id=last_event_id)
 
 @app.route('/consultations/add/<int:patient_id>')
 @login_required
@@ -401,11 +568,12 @@ def add_to_consultation(patient_id):
             return redirect(url_for('patients'))
         
         # Insert new consultation
-        db.execute(
+        cursor = db.execute(
             'INSERT INTO consultations (patient_id, added_by) VALUES (?, ?)',
             (patient_id, session['username'])
         )
         db.commit()
+        audit('consultation_queued', patient_id, 'consultation', cursor.lastrowid)
         flash('Patient added to consultation queue!', 'success')
     except Exception as e:
         db.rollback()
@@ -420,8 +588,14 @@ def add_to_consultation(patient_id):
 @login_required
 def remove_from_consultation(id):
     db = get_db()
+    consultation = db.execute('SELECT patient_id FROM consultations WHERE id=?', (id,)).fetchone()
+    prescription_ids = [row['id'] for row in db.execute('SELECT id FROM prescriptions WHERE consultation_id=?', (id,))]
+    release_reservations(db, prescription_ids, session['username'])
     db.execute('DELETE FROM consultations WHERE id=?', (id,))
     db.commit()
+    if consultation:
+        audit('consultation_removed', consultation['patient_id'], 'consultation', id)
+    stock_cache.refresh(db)
     flash('Patient removed from consultation queue!', 'info')
     return redirect(url_for('consultations'))
 
@@ -429,9 +603,14 @@ def remove_from_consultation(id):
 @login_required
 def complete_consultation(id):
     db = get_db()
-    db.execute('UPDATE consultations SET status="completed" WHERE id=?', (id,))
-    db.commit()
-    flash('Consultation completed!', 'success')
+    try:
+        move_to(db, id, 'completed')
+        db.commit()
+        audit('consultation_completed', get_flow(db, id)['patient_id'], 'consultation', id)
+        flash('Consultation completed!', 'success')
+    except ValueError as e:
+        db.rollback()
+        flash(str(e), 'error')
     return redirect(url_for('consultations'))
 
 @app.route('/laboratory/results/<int:patient_id>')
@@ -461,6 +640,7 @@ def get_lab_results(patient_id):
                 'id': row['id'],
                 'test_name': row['test_name'],
                 'test_result_image': row['test_result_image'],
+                'test_result_preview': lab_preview_url(row['test_result_image']),
                 'clinical_details': row['clinical_details'],
                 'general_comments': row['general_comments'],
                 'processed_by': row['processed_by'],
@@ -477,6 +657,21 @@ def get_lab_results(patient_id):
             'error': str(e)
         }), 500
 
+@app.route('/laboratory/preview/<filename>')
+@login_required
+def lab_result_preview(filename):
+    """Serve a lab result preview, generating it first if it is missing"""
+    filename = secure_filename(filename)
+    if not lab_previews.can_preview(filename) or \
+            not os.path.isfile(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+        abort(404)
+    try:
+        preview_path = lab_previews.ensure(filename)
+    except Exception as e:
+        print(f'Warning: Could not create preview for {filename}: {e}')
+        abort(404)
+    return send_from_directory(os.path.dirname(preview_path), os.path.basename(preview_path))
+
 @app.route('/diagnosis/submit', methods=['POST'])
 @login_required
 def submit_diagnosis():
@@ -528,10 +723,12 @@ def submit_diagnosis():
             session['username']
         ))
         
-        # Keep consultation status as 'waiting' so patient remains in consultation room
-        db.execute('UPDATE consultations SET status=? WHERE id=?', ('waiting', consultation_id))
+        # Patient stays in the consultation room
+        move_to(db, consultation_id, 'waiting')
         
         db.commit()
+        audit('diagnosis_submitted', int(patient_id), 'consultation', int(consultation_id),
+              diagnosis=confirmed_diagnosis)
         flash('Diagnosis submitted successfully! Patient remains in consultation queue.', 'success')
     except Exception as e:
         db.rollback()
@@ -591,7 +788,7 @@ def submit_prescription():
                         return redirect(url_for('consultations'))
                     
                     medicines.append({
-                        'type': medicine_type,
+                        'medicine': medicine_type,
                         'amount': medicine_amount,
                         'times_per_day': times,
                         'duration_days': duration
@@ -625,27 +822,31 @@ def submit_prescription():
                 flash('Management plan cannot be empty if selected!', 'error')
                 return redirect(url_for('consultations'))
         
-        # Convert medicines list to JSON string
-        medicines_json = json.dumps(medicines)
-        
         # Insert prescription record with pharmacy_status
-        db.execute('''
+        cursor = db.execute('''
             INSERT INTO prescriptions (
-                consultation_id, patient_id, medicines,
+                consultation_id, patient_id,
                 prescription_comment, management_plan,
                 prescribed_by, prescribed_at, status, pharmacy_status
-            ) VALUES (?, ?, ?, ?, ?, ?, datetime('now'), 'pending', 'not_sent')
+            ) VALUES (?, ?, ?, ?, ?, datetime('now'), 'pending', 'not_sent')
         ''', (
-            consultation_id, patient_id, medicines_json,
+            consultation_id, patient_id,
             prescription_comment, management_plan,
             session['username']
         ))
+        add_prescription_items(db, cursor.lastrowid, medicines)
+        low_stock = reserve_stock(db, cursor.lastrowid, medicines, session['username'])
         
-        # Update consultation status to 'completed' since prescription is final step
-        db.execute('UPDATE consultations SET status=? WHERE id=?', ('completed', consultation_id))
+        # Prescription is the final step, the patient moves on to the account
+        move_to(db, consultation_id, 'completed')
         
         db.commit()
+        audit('prescription_submitted', int(patient_id), 'prescription', cursor.lastrowid,
+              medicines=len(medicines))
+        stock_cache.refresh(db)
         flash('Prescription submitted successfully! Patient sent to Account.', 'success')
+        if low_stock:
+            flash(f'Low pharmacy stock: {", ".join(low_stock)}', 'warning')
     except Exception as e:
         db.rollback()
         flash(f'Error submitting prescription: {str(e)}', 'error')
@@ -655,80 +856,88 @@ def submit_prescription():
 @app.route('/api/patient/<int:patient_id>/history')
 @login_required
 def get_patient_history(patient_id):
+    """Patient history as streamed JSON.
+
+    Supports fields=, since=, limit= and per-section cursors (see
+    models/history.py) and answers If-None-Match with 304 when nothing in
+    the patient's history changed.
+    """
     db = get_db()
     
-    # Get patient info
-    patient = db.execute('SELECT * FROM patients WHERE id=?', (patient_id,)).fetchone()
-    
-    if not patient:
+    version = get_patient_history_version(db, patient_id)
+    if version is None:
         return jsonify({
             'success': False,
             'error': 'Patient not found'
         }), 404
     
-    # Get vitals history
-    vitals = db.execute(
-        '''SELECT * FROM vitals 
-           WHERE patient_id=? 
-           ORDER BY recorded_at DESC''',
-        (patient_id,)
-    ).fetchall()
-    
-    # Get appointments history
-    appointments = db.execute(
-        '''SELECT * FROM appointments 
-           WHERE patient_id=? 
-           ORDER BY date DESC, time DESC''',
-        (patient_id,)
-    ).fetchall()
-    
-    # Get exams history (presenting complaints and history)
-    exams = db.execute(
-        '''SELECT 
-            e.id,
-            e.presenting_complaint,
-            e.history_of_complaint,
-            e.clinical_details,
-            e.status,
-            e.created_by,
-            e.created_at
-           FROM exams e
-           WHERE e.patient_id=? 
-           ORDER BY e.created_at DESC''',
-        (patient_id,)
-    ).fetchall()
+    try:
+        plan = parse_history_params(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     
-    # Get diagnoses history
-    diagnoses = db.execute(
-        '''SELECT 
-            d.id,
-            d.confirmed_diagnosis,
-            d.test_feedbacks,
-            d.lab_tech_comment,
-            d.diagnosis_notes,
-            d.diagnosed_by,
-            d.diagnosed_at
-           FROM diagnoses d
-           WHERE d.patient_id=? 
-           ORDER BY d.diagnosed_at DESC''',
-        (patient_id,)
-    ).fetchall()
+    etag = history_etag(patient_id, version, request.args)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(
+            stream_with_context(stream_patient_history(db, patient_id, plan)),
+            mimetype='application/json'
+        )
+    response.set_etag(etag)
+    # Let the browser keep a copy but check back with us every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/patients')
+@login_required
+def api_patients():
+    """Search patients by name, contact or department, one page at a time"""
+    db = get_db()
+    try:
+        limit = int(request.args.get('limit', app.config['ITEMS_PER_PAGE']))
+    except ValueError:
+        limit = app.config['ITEMS_PER_PAGE']
+    limit = max(1, min(limit, 100))
     
+    patients_list, next_cursor = search_patients(
+        db, request.args.get('q', ''), request.args.get('cursor'), limit
+    )
     return jsonify({
         'success': True,
-        'patient': dict(patient),
-        'vitals': [dict(v) for v in vitals],
-        'appointments': [dict(a) for a in appointments],
-        'exams': [dict(e) for e in exams],
-        'diagnoses': [dict(d) for d in diagnoses]
+        'patients': [dict(p) for p in patients_list],
+        'next_cursor': next_cursor
     })
 
-@app.route('/api/patients')
+@app.route('/api/patients/typeahead')
 @login_required
-def api_patients():
+def api_patient_typeahead():
+    """Top matches (id, name, date of birth) for the patient pickers"""
     db = get_db()
-    patients_list = db.execute('SELECT * FROM patients').fetchall()
-    return jsonify([dict(p) for p in patients_list])
+    limit = max(1, min(request.args.get('limit', 10, type=int), 25))
+    return jsonify({
+        'success': True,
+        'patients': typeahead_cache.lookup(db, request.args.get('q', ''), limit)
+    })
+
+@app.route('/api/patients/<int:patient_id>/vitals/trends')
+@login_required
+def api_vitals_trends(patient_id):
+    """Hourly or daily min/max/mean of a patient's vitals, for charts"""
+    db = get_db()
+    if not db.execute('SELECT 1 FROM patients WHERE id = ?', (patient_id,)).fetchone():
+        return jsonify({'success': False, 'error': 'Patient not found'}), 404
+    try:
+        resolution, start, end, metrics = parse_trend_params(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({
+        'success': True,
+        'resolution': resolution,
+        'start': start.strftime('%Y-%m-%d %H:%M:%S'),
+        'end': end.strftime('%Y-%m-%d %H:%M:%S'),
+        'trends': get_vitals_trends(db, patient_id, resolution, start, end, metrics)
+    })
 
 @app.route('/exams/add', methods=['POST'])
 @login_required
@@ -764,31 +973,22 @@ def add_exam():
             flash('An exam request already exists for this consultation!', 'warning')
             return redirect(url_for('consultations'))
         
-        # Get test selections
-        random_blood_sugar = 1 if request.form.get('random_blood_sugar') else 0
-        fasting_blood_sugar = 1 if request.form.get('fasting_blood_sugar') else 0
-        liver_function = 1 if request.form.get('liver_function') else 0
-        full_blood_count = 1 if request.form.get('full_blood_count') else 0
-        lipid_profile = 1 if request.form.get('lipid_profile') else 0
-        kidney_function = 1 if request.form.get('kidney_function') else 0
-        thyroid_function = 1 if request.form.get('thyroid_function') else 0
-        urinalysis = 1 if request.form.get('urinalysis') else 0
-        stool_examination = 1 if request.form.get('stool_examination') else 0
-        chest_xray = 1 if request.form.get('chest_xray') else 0
-        ecg = 1 if request.form.get('ecg') else 0
-        ultrasound = 1 if request.form.get('ultrasound') else 0
+        # Get test selections (codes from the lab test catalog)
+        selected_codes = set(request.form.getlist('tests'))
+        test_ids = [test['id'] for test in get_lab_tests(db) if test['code'] in selected_codes]
+        try:
+            priority = int(request.form.get('priority', 0))
+        except ValueError:
+            priority = 0
+        if priority not in LAB_PRIORITIES:
+            priority = 0
         
         # Get diagnosis recommendation
         recommend_diagnosis = 1 if request.form.get('recommend_diagnosis') else 0
         clinical_details = sanitize_input(request.form.get('clinical_details', ''))
         
         # Validate at least one test is selected
-        tests_selected = any([
-            random_blood_sugar, fasting_blood_sugar, liver_function, full_blood_count,
-            lipid_profile, kidney_function, thyroid_function, urinalysis,
-            stool_examination, chest_xray, ecg, ultrasound
-        ])
-        if not tests_selected:
+        if not test_ids:
             flash('Please select at least one test!', 'error')
             return redirect(url_for('consultations'))
         
@@ -796,25 +996,20 @@ def add_exam():
         cursor = db.execute('''
             INSERT INTO exams (
                 consultation_id, patient_id, presenting_complaint, history_of_complaint,
-                random_blood_sugar, fasting_blood_sugar, liver_function, full_blood_count,
-                lipid_profile, kidney_function, thyroid_function, urinalysis,
-                stool_examination, chest_xray, ecg, ultrasound,
                 recommend_diagnosis, clinical_details, status, created_by, created_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
         ''', (
             consultation_id, patient_id, presenting_complaint, history_of_complaint,
-            random_blood_sugar, fasting_blood_sugar, liver_function, full_blood_count,
-            lipid_profile, kidney_function, thyroid_function, urinalysis,
-            stool_examination, chest_xray, ecg, ultrasound,
             recommend_diagnosis, clinical_details, 'pending', session['username']
         ))
         
         exam_id = cursor.lastrowid
+        add_exam_tests(db, exam_id, test_ids, priority)
         
-        # Update consultation status instead of deleting (prevents CASCADE delete of exam)
-        db.execute('UPDATE consultations SET status=? WHERE id=?', ('sent_to_lab', consultation_id))
+        move_to(db, consultation_id, 'sent_to_lab')
         
         db.commit()
+        audit('exam_requested', int(patient_id), 'exam', exam_id, tests=len(test_ids), priority=priority)
         flash('Exam request sent to laboratory successfully!', 'success')
     except Exception as e:
         db.rollback()
@@ -822,41 +1017,81 @@ def add_exam():
     
     return redirect(url_for('consultations'))
 
+def filter_lab_queue(db, lab_patients, test_filter):
+    if not test_filter:
+        return lab_patients
+    pending_exam_ids = {row['exam_id'] for row in get_pending_tests(db, test_filter)}
+    return [row for row in lab_patients if row['exam_id'] in pending_exam_ids]
+
 @app.route('/laboratory')
 @login_required
 def laboratory():
     db = get_db()
     
-    lab_patients = db.execute('''
-        SELECT 
-            e.id as exam_id,
-            e.patient_id,
-            p.name,
-            p.gender,
-            p.date_of_birth,
-            e.presenting_complaint,
-            e.history_of_complaint,
-            e.random_blood_sugar,
-            e.fasting_blood_sugar,
-            e.liver_function,
-            e.full_blood_count,
-            e.lipid_profile,
-            e.kidney_function,
-            e.thyroid_function,
-            e.urinalysis,
-            e.stool_examination,
-            e.chest_xray,
-            e.ecg,
-            e.ultrasound,
-            e.clinical_details,
-            e.created_at
-        FROM exams e
-        JOIN patients p ON e.patient_id = p.id
-        WHERE e.status IN ('pending', 'in_progress')
-        ORDER BY e.created_at ASC
-    ''').fetchall()
+    last_event_id = latest_event_id(db)
+    lab_patients = get_lab_queue(db)
     
-    return render_template('laboratory.html', lab_patients=lab_patients)
+    # Optional filter to one test, e.g. ?test=cbc for every pending CBC
+    test_filter = request.args.get('test', '')
+    lab_patients = filter_lab_queue(db, lab_patients, test_filter)
+    
+    claimed_tests = get_claimed_tests(db, session['username'])
+    exam_tests = get_exam_tests(
+        db, {row['exam_id'] for row in lab_patients} | {row['exam_id'] for row in claimed_tests}
+    )
+    workable = {
+        exam_id: [test['code'] for test in workable_tests(tests, session['username'])]
+        for exam_id, tests in exam_tests.items()
+    }
+    return render_template('laboratory.html', lab_patients=lab_patients, exam_tests=exam_tests,
+                           workable=workable, lab_tests=get_lab_tests(db), test_filter=test_filter,
+                           queues=get_queue_summary(db), claimed_tests=claimed_tests,
+                           priorities=LAB_PRIORITIES, last_event_id=last_event_id)
+
+@app.route('/laboratory/queues/<queue>/claim', methods=['POST'])
+@login_required
+def claim_lab_test(queue):
+    """Claim the most urgent, oldest pending test on a lab bench"""
+    db = get_db()
+    try:
+        item = claim_next(db, queue, session['username'], app.config['LAB_CLAIM_TIMEOUT'])
+        if item:
+            audit('lab_test_claimed', item['patient_id'], 'exam_test', item['id'], test=item['test_name'])
+            flash(f"Claimed {item['test_name']} for {item['patient_name']}.", 'success')
+        else:
+            flash('No pending tests in this queue.', 'info')
+    except Exception as e:
+        flash(f'Error claiming test: {str(e)}', 'error')
+    
+    return redirect(url_for('laboratory'))
+
+@app.route('/laboratory/claims/<int:exam_test_id>/release', methods=['POST'])
+@login_required
+def release_lab_test(exam_test_id):
+    """Return a claimed test to its queue"""
+    db = get_db()
+    try:
+        if release_claim(db, exam_test_id, session['username']):
+            db.commit()
+            audit('lab_test_released', entity='exam_test', entity_id=exam_test_id)
+            flash('Test returned to the queue.', 'success')
+        else:
+            flash('That test is not claimed by you.', 'warning')
+    except Exception as e:
+        db.rollback()
+        flash(f'Error releasing test: {str(e)}', 'error')
+    
+    return redirect(url_for('laboratory'))
+
+@app.route('/api/laboratory/queues')
+@login_required
+def api_lab_queues():
+    """Queue depths for each lab bench"""
+    db = get_db()
+    return jsonify({
+        'success': True,
+        'queues': [queue._asdict() for queue in get_queue_summary(db)]
+    })
 
 @app.route('/laboratory/submit', methods=['POST'])
 @login_required
@@ -880,125 +1115,108 @@ def submit_lab_results():
             flash('Exam not found!', 'error')
             return redirect(url_for('laboratory'))
         
-        # Mark exam as in progress
-        db.execute('UPDATE exams SET status=? WHERE id=?', ('in_progress', exam_id))
-        
-        # Process uploaded test images
-        test_fields = [
-            ('rbs', 'random_blood_sugar', 'Random Blood Sugar'),
-            ('fbs', 'fasting_blood_sugar', 'Fasting Blood Sugar'),
-            ('lft', 'liver_function', 'Liver Function Test'),
-            ('cbc', 'full_blood_count', 'Complete Blood Count'),
-            ('lipid', 'lipid_profile', 'Lipid Profile'),
-            ('kft', 'kidney_function', 'Kidney Function Test'),
-            ('thyroid', 'thyroid_function', 'Thyroid Function Test'),
-            ('urine', 'urinalysis', 'Urinalysis'),
-            ('stool', 'stool_examination', 'Stool Examination'),
-            ('xray', 'chest_xray', 'Chest X-Ray'),
-            ('ecg', 'ecg', 'Electrocardiogram'),
-            ('ultrasound', 'ultrasound', 'Ultrasound')
-        ]
-        
-        # Create uploads directory if it doesn't exist
+        # Only unclaimed tests and the ones this technician claimed can take results
+        requested_tests = workable_tests(get_exam_tests(db, [exam['id']])[exam['id']], session['username'])
+        
         upload_folder = app.config['UPLOAD_FOLDER']
         os.makedirs(upload_folder, exist_ok=True)
+        max_size_mb = app.config['LAB_RESULT_MAX_FILE_SIZE'] // (1024 * 1024)
+        
+        # Uploads were already streamed to temp files while the request was
+        # parsed; unpublished temp files are deleted when the request closes
+        uploads = []  # (spool, final path, web path, test name, exam test id)
         
-        results_saved = False
-        saved_files = []  # Track saved files for rollback
-        
-        for test_key, db_field, test_name in test_fields:
-            if exam[db_field] == 1:
-                file_key = f'test_{test_key}_image'
-                
-                # Check if image was uploaded for this test
-                if file_key in request.files:
-                    file = request.files[file_key]
-                    if file and file.filename:
-                        # Validate file type
-                        if not allowed_file(file.filename):
-                            # Rollback: delete already saved files
-                            for saved_file in saved_files:
-                                try:
-                                    os.remove(saved_file)
-                                except (OSError, IOError) as cleanup_error:
-                                    print(f'Warning: Could not delete file {saved_file}: {cleanup_error}')
-                            flash(f'Invalid file type for {test_name}. Allowed types: png, jpg, jpeg, gif, pdf', 'error')
-                            db.rollback()
-                            return redirect(url_for('laboratory'))
-                        
-                        # Validate file size (10MB max per file)
-                        if not validate_file_size(file, max_size_mb=10):
-                            # Rollback: delete already saved files
-                            for saved_file in saved_files:
-                                try:
-                                    os.remove(saved_file)
-                                except (OSError, IOError) as cleanup_error:
-                                    print(f'Warning: Could not delete file {saved_file}: {cleanup_error}')
-                            flash(f'File too large for {test_name}. Maximum size is 10MB per file.', 'error')
-                            db.rollback()
-                            return redirect(url_for('laboratory'))
-                        
-                        try:
-                            # Secure the filename
-                            original_filename = secure_filename(file.filename)
-                            
-                            # Check if file has extension
-                            if '.' not in original_filename:
-                                flash(f'File must have an extension for {test_name}', 'error')
-                                continue
-                            
-                            # Generate unique filename
-                            ext = original_filename.rsplit('.', 1)[1].lower()
-                            filename = f"{patient_id}_{test_key}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{ext}"
-                            filepath = os.path.join(upload_folder, filename)
-                            
-                            # Save file with error handling
-                            file.save(filepath)
-                            saved_files.append(filepath)
-                            
-                            # Set file permissions for cross-platform compatibility (especially macOS)
-                            try:
-                                os.chmod(filepath, 0o644)  # rw-r--r--
-                            except (OSError, IOError) as perm_error:
-                                print(f'Warning: Could not set file permissions for {filepath}: {perm_error}')
-                            
-                            # Store relative path for web access
-                            relative_path = f"/static/lab_results/{filename}"
-                            
-                            # Insert laboratory record
-                            db.execute('''
-                                INSERT INTO laboratory (
-                                    exam_id, patient_id, test_name, test_result_image,
-                                    clinical_details, general_comments, status,
-                                    processed_by, processed_at
-                                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
-                            ''', (
-                                exam_id, patient_id, test_name, relative_path,
-                                exam['clinical_details'], general_comments, 'completed',
-                                session['username']
-                            ))
-                            results_saved = True
-                        except Exception as file_error:
-                            # Rollback: delete already saved files
-                            for saved_file in saved_files:
-                                try:
-                                    os.remove(saved_file)
-                                except (OSError, IOError) as cleanup_error:
-                                    print(f'Warning: Could not delete file {saved_file}: {cleanup_error}')
-                            raise Exception(f"Error saving file for {test_name}: {str(file_error)}")
-        
-        # Update exam status
-        if results_saved:
+        for test in requested_tests:
+            test_key, test_name = test['code'], test['name']
+            file = request.files.get(f'test_{test_key}_image')
+            if not file or not file.filename:
+                continue
+            
+            # Validate file type
+            if not allowed_file(file.filename):
+                flash(f'Invalid file type for {test_name}. Allowed types: png, jpg, jpeg, gif, pdf', 'error')
+                return redirect(url_for('laboratory'))
+            
+            # Size was enforced while streaming
+            if getattr(file.stream, 'too_large', False):
+                flash(f'File too large for {test_name}. Maximum size is {max_size_mb}MB per file.', 'error')
+                return redirect(url_for('laboratory'))
+            
+            # Secure the filename
+            original_filename = secure_filename(file.filename)
+            
+            # Check if file has extension
+            if '.' not in original_filename:
+                flash(f'File must have an extension for {test_name}', 'error')
+                continue
+            
+            # Generate unique filename
+            ext = original_filename.rsplit('.', 1)[1].lower()
+            filename = f"{patient_id}_{test_key}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{ext}"
+            uploads.append((
+                file.stream,
+                os.path.join(upload_folder, filename),
+                f"/static/lab_results/{filename}",  # relative path for web access
+                test_name,
+                test['id']
+            ))
+        
+        if not uploads:
+            flash('No test results were uploaded. Please upload at least one result.', 'warning')
+            return redirect(url_for('laboratory'))
+        
+        # The write transaction only covers these batched statements
+        db.executemany('''
+            INSERT INTO laboratory (
+                exam_id, patient_id, test_name, test_result_image,
+                clinical_details, general_comments, status,
+                processed_by, processed_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
+        ''', [
+            (exam_id, patient_id, test_name, relative_path,
+             exam['clinical_details'], general_comments, 'completed',
+             session['username'])
+            for _, _, relative_path, test_name, _ in uploads
+        ])
+        db.executemany(
+            "UPDATE exam_tests SET status='completed' WHERE id=?",
+            [(exam_test_id,) for *_, exam_test_id in uploads]
+        )
+        if request.form.get('close_exam'):
+            # Tests without a result are cancelled, except ones other benches claimed
+            db.execute('''
+                UPDATE exam_tests SET status='cancelled'
+                WHERE exam_id=? AND (status='pending' OR (status='in_progress' AND claimed_by=?))
+            ''', (exam_id, session['username']))
+        
+        open_tests = db.execute(
+            "SELECT COUNT(*) FROM exam_tests WHERE exam_id=? AND status IN ('pending', 'in_progress')",
+            (exam_id,)
+        ).fetchone()[0]
+        if open_tests:
+            db.execute('UPDATE exams SET status=? WHERE id=?', ('in_progress', exam_id))
+        else:
             db.execute('UPDATE exams SET status=? WHERE id=?', ('completed', exam_id))
             
             # Send patient back to consultation queue after lab work is completed
-            db.execute('UPDATE consultations SET status=? WHERE id=?', ('waiting', exam['consultation_id']))
-            
-            db.commit()
-            flash('Laboratory results submitted successfully! Patient sent back to consultation queue.', 'success')
+            move_to(db, exam['consultation_id'], 'waiting')
+        
+        db.commit()
+        audit('lab_results_submitted', exam['patient_id'], 'exam', exam['id'],
+              tests=[test_name for *_, test_name, _ in uploads], open_tests=open_tests)
+        
+        # Move files into place only once the results are committed
+        for spool, filepath, _, test_name, _ in uploads:
+            try:
+                spool.publish(filepath)
+                lab_previews.submit(os.path.basename(filepath))
+            except OSError as file_error:
+                print(f'Warning: Could not save file for {test_name} to {filepath}: {file_error}')
+        
+        if open_tests:
+            flash(f'Laboratory results saved. {open_tests} test(s) on this exam are still open.', 'success')
         else:
-            db.rollback()
-            flash('No test results were uploaded. Please upload at least one result.', 'warning')
+            flash('Laboratory results submitted successfully! Patient sent back to consultation queue.', 'success')
             
     except Exception as e:
         db.rollback()
@@ -1012,29 +1230,12 @@ def account():
     """Display patients with prescriptions pending payment"""
     db = get_db()
     
-    account_patients = db.execute('''
-        SELECT 
-            pr.id as prescription_id,
-            pr.patient_id,
-            p.name,
-            p.gender,
-            p.payment_method,
-            pr.medicines,
-            pr.prescription_comment,
-            pr.management_plan,
-            pr.prescribed_by,
-            pr.prescribed_at,
-            pr.status,
-            pr.pharmacy_status,
-            c.id as consultation_id
-        FROM prescriptions pr
-        JOIN patients p ON pr.patient_id = p.id
-        JOIN consultations c ON pr.consultation_id = c.id
-        WHERE pr.pharmacy_status = 'not_sent'
-        ORDER BY pr.prescribed_at DESC
-    ''').fetchall()
+    last_event_id = latest_event_id(db)
+    account_patients = get_account_queue(db)
     
-    return render_template('account.html', patients=account_patients)
+    medicines = get_prescription_items(db, [row['prescription_id'] for row in account_patients])
+    return render_template('account.html', patients=account_patients, medicines=medicines,
+                           last_event_id=last_event_id)
 
 @app.route('/account/complete/<int:prescription_id>', methods=['POST'])
 @login_required
@@ -1056,16 +1257,19 @@ def complete_payment(prescription_id):
             payment_method = 'cash'  # Default to cash if invalid
         
         # Update payment method in patients table
-        prescription = db.execute('SELECT patient_id FROM prescriptions WHERE id=?', (prescription_id,)).fetchone()
+        prescription = db.execute(
+            'SELECT patient_id, consultation_id FROM prescriptions WHERE id=?', (prescription_id,)
+        ).fetchone()
         
         if prescription:
             db.execute('UPDATE patients SET payment_method=? WHERE id=?', 
                       (sanitize_input(payment_method), prescription['patient_id']))
             
-            # Update prescription status
-            db.execute('UPDATE prescriptions SET status=? WHERE id=?', ('paid', prescription_id))
+            move_to(db, prescription['consultation_id'], 'paid')
             
             db.commit()
+            audit('payment_completed', prescription['patient_id'], 'prescription', prescription_id,
+                  payment_method=payment_method)
             flash('Payment completed successfully!', 'success')
         else:
             flash('Prescription not found!', 'error')
@@ -1083,16 +1287,18 @@ def send_to_pharmacy(prescription_id):
     db = get_db()
     try:
         # Verify prescription is paid
-        prescription = db.execute('SELECT status FROM prescriptions WHERE id=?', (prescription_id,)).fetchone()
+        prescription = db.execute(
+            'SELECT status, patient_id, consultation_id FROM prescriptions WHERE id=?', (prescription_id,)
+        ).fetchone()
         
         if not prescription:
             flash('Prescription not found!', 'error')
         elif prescription['status'] != 'paid':
             flash('Payment must be completed before sending to pharmacy!', 'error')
         else:
-            # Update pharmacy status
-            db.execute('UPDATE prescriptions SET pharmacy_status=? WHERE id=?', ('sent', prescription_id))
+            move_to(db, prescription['consultation_id'], 'sent')
             db.commit()
+            audit('sent_to_pharmacy', prescription['patient_id'], 'prescription', prescription_id)
             flash('Patient sent to Pharmacy successfully!', 'success')
             
     except Exception as e:
@@ -1107,50 +1313,254 @@ def pharmacy():
     """Display patients sent to pharmacy"""
     db = get_db()
     
-    pharmacy_patients = db.execute('''
-        SELECT 
-            pr.id as prescription_id,
-            pr.patient_id,
-            p.name,
-            p.gender,
-            p.date_of_birth,
-            p.contact,
-            p.payment_method,
-            pr.medicines,
-            pr.prescription_comment,
-            pr.management_plan,
-            pr.prescribed_by,
-            pr.prescribed_at,
-            pr.status
-        FROM prescriptions pr
-        JOIN patients p ON pr.patient_id = p.id
-        WHERE pr.pharmacy_status = 'sent'
-        ORDER BY pr.prescribed_at DESC
-    ''').fetchall()
+    last_event_id = latest_event_id(db)
+    pharmacy_patients = get_pharmacy_queue(db)
     
-    return render_template('pharmacy.html', patients=pharmacy_patients)
+    medicines = get_prescription_items(db, [row['prescription_id'] for row in pharmacy_patients])
+    return render_template('pharmacy.html', patients=pharmacy_patients, medicines=medicines,
+                           stock=stock_cache.all_levels(db), last_event_id=last_event_id)
+
+@app.route('/pharmacy/stock/receive', methods=['POST'])
+@login_required
+def receive_pharmacy_stock():
+    """Record a stock delivery and/or a new reorder level for a medicine"""
+    db = get_db()
+    medicine = sanitize_input(request.form.get('medicine', ''), max_length=200)
+    try:
+        quantity = int(request.form.get('quantity') or 0)
+        reorder_level = request.form.get('reorder_level')
+        reorder_level = int(reorder_level) if reorder_level else None
+    except ValueError:
+        flash('Quantity and reorder level must be whole numbers!', 'error')
+        return redirect(url_for('pharmacy'))
+    if not medicine or quantity < 0 or (reorder_level is not None and reorder_level < 0):
+        flash('Enter a medicine and a quantity of 0 or more!', 'error')
+        return redirect(url_for('pharmacy'))
+    if quantity == 0 and reorder_level is None:
+        flash('Nothing to record - enter a quantity or a reorder level.', 'error')
+        return redirect(url_for('pharmacy'))
+
+    try:
+        receive_stock(db, medicine, quantity, session['username'], reorder_level)
+        db.commit()
+        audit('stock_received', medicine=medicine, quantity=quantity, reorder_level=reorder_level)
+        stock_cache.refresh(db)
+        flash(f'Stock recorded for {medicine}.', 'success')
+    except Exception as e:
+        db.rollback()
+        flash(f'Error recording stock: {str(e)}', 'error')
+    return redirect(url_for('pharmacy'))
+
+# Live queue pages
+LIVE_QUEUE_PAGES = ('consultations', 'laboratory', 'account', 'pharmacy')
+
+@app.route('/api/queues/events')
+@login_required
+def api_queue_events():
+    """Server-sent events naming the queue rows that changed.
+
+    topics= is a comma-separated list of EVENT_TOPICS. Events after since=
+    (or the Last-Event-ID of a reconnect) are replayed first.
+    """
+    topics = [topic for topic in request.args.get('topics', '').split(',') if topic in EVENT_TOPICS]
+    if not topics:
+        return jsonify({'success': False, 'error': f"topics must be some of {', '.join(EVENT_TOPICS)}"}), 400
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        since = int(since) if since else None
+    except ValueError:
+        return jsonify({'success': False, 'error': 'since must be an event id'}), 400
+
+    db = get_db()
+    subscription, cutoff = queue_events.subscribe(db, topics)
+    if subscription is None:
+        response = jsonify({'success': False, 'error': 'Too many open event streams, try again later'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    try:
+        backlog = get_events_since(db, since, cutoff, topics) if since is not None else []
+    except Exception:
+        queue_events.unsubscribe(subscription)
+        raise
+
+    response = Response(
+        queue_events.stream(subscription, backlog, app.config['QUEUE_EVENTS_STREAM_SECONDS']),
+        mimetype='text/event-stream'
+    )
+    # Also covers a client that goes away before the stream starts
+    response.call_on_close(lambda: queue_events.unsubscribe(subscription))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/queues/<page>/rows')
+@login_required
+def api_queue_rows(page):
+    """Current markup of the given rows of a queue page, null for rows that left it"""
+    if page not in LIVE_QUEUE_PAGES:
+        return jsonify({'success': False, 'error': 'Unknown queue page'}), 404
+    try:
+        ids = [int(value) for value in request.args.get('ids', '').split(',') if value][:100]
+    except ValueError:
+        return jsonify({'success': False, 'error': 'ids must be a comma-separated list of numbers'}), 400
+
+    db = get_db()
+    macro = get_template_attribute('queue_rows.html', {
+        'consultations': 'consultation_row',
+        'laboratory': 'lab_row',
+        'account': 'account_row',
+        'pharmacy': 'pharmacy_row',
+    }[page])
+    if page == 'consultations':
+        rows = {row['id']: macro(row) for row in get_waiting_queue(db, ids)}
+    elif page == 'laboratory':
+        lab_patients = filter_lab_queue(db, get_lab_queue(db, ids), request.args.get('test', ''))
+        exam_tests = get_exam_tests(db, {row['exam_id'] for row in lab_patients})
+        rows = {
+            row['exam_id']: macro(
+                row, exam_tests[row['exam_id']],
+                [test['code'] for test in workable_tests(exam_tests[row['exam_id']], session['username'])],
+                session['username']
+            )
+            for row in lab_patients
+        }
+    else:
+        queue = get_account_queue(db, ids) if page == 'account' else get_pharmacy_queue(db, ids)
+        medicines = get_prescription_items(db, [row['prescription_id'] for row in queue])
+        rows = {row['prescription_id']: macro(row, medicines[row['prescription_id']]) for row in queue}
+    return jsonify({
+        'success': True,
+        'rows': {row_id: str(rows[row_id]) if row_id in rows else None for row_id in ids}
+    })
+
+@app.route('/api/stock')
+@login_required
+def api_stock():
+    """Stock level of one medicine (?medicine=) or the low-stock list, from the in-memory cache"""
+    db = get_db()
+    medicine = request.args.get('medicine')
+    if medicine is None:
+        return jsonify({'success': True, 'low_stock': [level.as_dict() for level in stock_cache.low_stock(db)]})
+    level = stock_cache.get(db, medicine)
+    return jsonify({'success': True, 'stocked': level is not None, 'stock': level.as_dict() if level else None})
+
+@app.route('/api/reports/medicines')
+@login_required
+def api_medicine_usage():
+    """Prescribed quantities per medicine, this month unless start/end are given"""
+    db = get_db()
+    today = datetime.now().date()
+    try:
+        start = date.fromisoformat(request.args.get('start') or today.replace(day=1).isoformat())
+        if request.args.get('end'):
+            end = date.fromisoformat(request.args['end'])
+        else:
+            end = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'start and end must be YYYY-MM-DD dates'}), 400
+    if end <= start:
+        return jsonify({'success': False, 'error': 'end must be after start'}), 400
+
+    usage = medicine_usage(db, start.isoformat(), end.isoformat(), request.args.get('medicine'))
+    return jsonify({
+        'success': True,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'medicines': [dict(row) for row in usage]
+    })
+
+@app.route('/api/reports/flow')
+@login_required
+def api_patient_flow():
+    """Queue lengths, stage throughput and wait times (minutes) of the last hours= (default 24)"""
+    hours = request.args.get('hours', 24, type=int)
+    if not hours or not 1 <= hours <= 24 * 31:
+        return jsonify({'success': False, 'error': 'hours must be between 1 and 744'}), 400
+    return jsonify({'success': True, **get_flow_metrics(get_db(), hours)})
+
+@app.route('/api/audit')
+@login_required
+def api_audit_log():
+    """Audit entries, newest first (admins only).
+
+    Filters: patient_id=, username=, action=, since=, until= (UTC
+    timestamps). Pages continue from the cursor= of the previous one.
+    """
+    if session.get('role') != 'admin':
+        return jsonify({'success': False, 'error': 'Only administrators can read the audit log'}), 403
+    db = get_db()
+    cursor = None
+    if request.args.get('cursor'):
+        occurred_at, _, entry_id = request.args['cursor'].rpartition('|')
+        if not occurred_at or not entry_id.isdigit():
+            return jsonify({'success': False, 'error': 'Invalid cursor'}), 400
+        cursor = (occurred_at, int(entry_id))
+    # This worker's queued events are written first so they show up
+    audit_log.flush(db)
+    entries, next_cursor = get_audit_events(
+        db,
+        patient_id=request.args.get('patient_id', type=int),
+        username=request.args.get('username') or None,
+        action=request.args.get('action') or None,
+        since=request.args.get('since'),
+        until=request.args.get('until'),
+        cursor=cursor,
+        limit=max(1, min(request.args.get('limit', 100, type=int), 500))
+    )
+    return jsonify({
+        'success': True,
+        'entries': entries,
+        'cursor': f'{next_cursor[0]}|{next_cursor[1]}' if next_cursor else None
+    })
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    """This worker's profiling histograms in the Prometheus text format.
+
+    Admins only; a scraper sends METRICS_TOKEN as a bearer token instead
+    of logging in.
+    """
+    if not app.config['PROFILING_ENABLED']:
+        return jsonify({'success': False, 'error': 'Profiling is turned off (PROFILING_ENABLED)'}), 404
+    token = app.config['METRICS_TOKEN']
+    authorized = bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not authorized and session.get('role') == 'admin':
+        authorized = check_session(session['user_id'], session['username'], session.get('session_version', 0))
+    if not authorized:
+        return jsonify({'success': False, 'error': 'Only administrators can read metrics'}), 403
+    return Response(profiler.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/pharmacy/complete/<int:prescription_id>', methods=['POST'])
 @login_required
 def complete_pharmacy(prescription_id):
-    """Complete pharmacy service and remove all patient records"""
+    """Complete pharmacy service and archive the patient's records"""
     db = get_db()
     try:
-        # Get patient information before deletion
         prescription = db.execute(
-            'SELECT patient_id FROM prescriptions WHERE id=?', 
+            'SELECT patient_id, consultation_id FROM prescriptions WHERE id=?', 
             (prescription_id,)
         ).fetchone()
         
         if prescription:
             patient_id = prescription['patient_id']
             
-            # Delete patient record - this will cascade delete all related records
-            # (prescriptions, consultations, exams, laboratory, diagnoses, vitals, appointments)
-            db.execute('DELETE FROM patients WHERE id=?', (patient_id,))
+            # Reserved stock leaves the shelf; the patient's other
+            # reservations are returned before their records are archived
+            dispense_stock(db, prescription_id, session['username'])
+            other_prescriptions = [row['id'] for row in db.execute(
+                'SELECT id FROM prescriptions WHERE patient_id=? AND id != ?', (patient_id, prescription_id)
+            )]
+            release_reservations(db, other_prescriptions, session['username'])
+            
+            # The archive job moves the patient's records out of the hot
+            # tables in the background; until then they are hidden
+            move_to(db, prescription['consultation_id'], 'dispensed')
+            queue_patient_archive(db, patient_id, session['username'])
             db.commit()
+            audit('prescription_dispensed', patient_id, 'prescription', prescription_id)
+            stock_cache.refresh(db)
             
-            flash('Patient completed successfully! All records removed.', 'success')
+            flash('Patient completed successfully! Records moved to the archive.', 'success')
         else:
             flash('Prescription not found!', 'error')
             
@@ -1160,16 +1570,43 @@ def complete_pharmacy(prescription_id):
     
     return redirect(url_for('pharmacy'))
 
+@app.route('/api/archive/patients')
+@login_required
+def api_archived_patients():
+    """Search archived patients by name prefix"""
+    db = get_db()
+    name = request.args.get('q', '').strip()
+    if not name:
+        return jsonify({'success': False, 'error': 'q is required'}), 400
+    patients = search_archived_patients(db, name, limit=min(request.args.get('limit', 20, type=int), 100))
+    return jsonify({'success': True, 'patients': [dict(row) for row in patients]})
+
+@app.route('/api/archive/patients/<int:patient_id>')
+@login_required
+def api_archived_patient(patient_id):
+    """Full archived record of a patient"""
+    db = get_db()
+    record = get_archived_patient(db, patient_id)
+    if record is None:
+        return jsonify({'success': False, 'error': 'Archived patient not found'}), 404
+    return jsonify({'success': True, 'record': record})
+
 @app.route('/pharmacy/cancel/<int:prescription_id>', methods=['POST'])
 @login_required
 def cancel_pharmacy(prescription_id):
     """Cancel pharmacy service and send back to account"""
     db = get_db()
     try:
-        # Update pharmacy status back to not_sent
-        db.execute('UPDATE prescriptions SET pharmacy_status=? WHERE id=?', ('not_sent', prescription_id))
-        db.commit()
-        flash('Pharmacy service cancelled. Patient sent back to Account.', 'info')
+        prescription = db.execute(
+            'SELECT patient_id, consultation_id FROM prescriptions WHERE id=?', (prescription_id,)
+        ).fetchone()
+        if prescription:
+            move_to(db, prescription['consultation_id'], 'paid')
+            db.commit()
+            audit('pharmacy_cancelled', prescription['patient_id'], 'prescription', prescription_id)
+            flash('Pharmacy service cancelled. Patient sent back to Account.', 'info')
+        else:
+            flash('Prescription not found!', 'error')
             
     except Exception as e:
         db.rollback()
@@ -1197,11 +1634,13 @@ def cancel_exam(exam_id):
         
         # Update status to cancelled
         db.execute('UPDATE exams SET status=? WHERE id=?', ('cancelled', exam_id))
+        db.execute("UPDATE exam_tests SET status='cancelled' WHERE exam_id=? AND status IN ('pending', 'in_progress')", (exam_id,))
         
-        # Also update associated consultation status back to waiting
-        db.execute('UPDATE consultations SET status=? WHERE id=?', ('waiting', exam['consultation_id']))
+        # Also send the patient back to the consultation queue
+        move_to(db, exam['consultation_id'], 'waiting')
         
         db.commit()
+        audit('exam_cancelled', exam['patient_id'], 'exam', exam_id)
         flash('Exam cancelled successfully!', 'success')
         
     except Exception as e:
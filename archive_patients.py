@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Patient Archive Utility
+Runs the archive job outside the app, e.g. from cron at night
+
+  python archive_patients.py                 move every queued patient into the archive
+  python archive_patients.py gc              delete lab files nothing refers to any more
+  python archive_patients.py gc --dry-run    list them without deleting
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+
+from config import Config
+from models.archive import init_archive, archive_patients, collect_lab_files
+from models.prescriptions import medicine_usage
+
+# Same files as the app, wherever cron runs the script from
+DB_FILE = Config.DATABASE
+ARCHIVE_FILE = Config.ARCHIVE_DATABASE
+UPLOAD_FOLDER = Config.UPLOAD_FOLDER
+
+def connect():
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_FILE,))
+    conn.execute('PRAGMA foreign_keys = ON')
+    init_archive(conn)
+    conn.commit()
+    return conn
+
+def all_time_usage(conn):
+    return [tuple(row) for row in medicine_usage(conn, '0000-01-01', '9999-12-31')]
+
+def run_archive(batch_size=50):
+    conn = connect()
+    try:
+        started = time.perf_counter()
+        queued = conn.execute('SELECT COUNT(*) FROM archive_queue').fetchone()[0]
+        print(f"Archiving {queued:,} queued patients into {ARCHIVE_FILE}...")
+        usage_before = all_time_usage(conn)
+        archived = 0
+        while True:
+            moved = archive_patients(conn, batch_size)
+            archived += moved
+            if moved < batch_size:
+                break
+        print(f"✓ Archived {archived:,} patients in {time.perf_counter() - started:.1f}s")
+        # Archived prescriptions must still count towards the medicine report
+        if all_time_usage(conn) != usage_before:
+            print("✗ The medicine usage report changed while archiving")
+            return False
+        print("✓ Medicine usage report unchanged")
+        return True
+    except Exception as e:
+        print(f"✗ Archive failed: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+def run_gc(dry_run=False):
+    conn = connect()
+    try:
+        removed = collect_lab_files(conn, UPLOAD_FOLDER, dry_run=dry_run)
+        for name in removed:
+            print(f"  {name}")
+        verb = 'Would delete' if dry_run else 'Deleted'
+        print(f"✓ {verb} {len(removed):,} unreferenced lab files")
+        return True
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Patient archive utility')
+    parser.add_argument('command', nargs='?', default='archive', choices=['archive', 'gc'])
+    parser.add_argument('--batch-size', type=int, default=50, help='patients moved per transaction')
+    parser.add_argument('--dry-run', action='store_true', help='gc: only list the files')
+    args = parser.parse_args()
+
+    if not os.path.exists(DB_FILE):
+        print(f"Database {DB_FILE} not found!")
+        return
+    if args.command == 'gc':
+        run_gc(args.dry_run)
+    else:
+        run_archive(args.batch_size)
+
+if __name__ == '__main__':
+    main()
@@ -1,64 +1,130 @@
 #!/usr/bin/env python3
 """
 Database Backup Utility
-Automatically creates timestamped backups of the clinical management database
+Creates consistent backups of the clinical management database while the app is running
+
+  python backup_database.py                     full backup (online backup API)
+  python backup_database.py --compress          full backup, gzip compressed
+  python backup_database.py incremental         only the pages changed since the last backup
+  python backup_database.py list                list backups
+  python backup_database.py verify [backup]     integrity check (latest backup by default)
+  python backup_database.py restore BACKUP DEST restore a full backup or incremental chain
 """
 
+import argparse
+import gzip
+import hashlib
+import json
 import os
 import shutil
-from datetime import datetime
+import sqlite3
+import struct
 import sys
+import tempfile
+import time
+from datetime import datetime
+
+DB_FILE = os.environ.get('DATABASE_PATH') or 'clinical_management.db'
+BACKUP_DIR = 'backups'
+INCREMENTAL_DIR = os.path.join(BACKUP_DIR, 'incremental')
+
+PAGES_PER_BATCH = 1024     # pages copied per step before letting writers in
+BATCH_SLEEP = 0.005        # seconds between batches
+CHAIN_LENGTH = 48          # incrementals per chain before a new base is taken
+KEEP_CHAINS = 7
+
+DELTA_MAGIC = b'CMSPAGES1\n'
+PAGE_RECORD = struct.Struct('>I')
+HASH_SIZE = 16
+
+def connect(path):
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    conn.execute('PRAGMA busy_timeout = 30000')
+    return conn
+
+def open_backup_file(path):
+    """Open a backup for reading, transparently decompressing gzip files"""
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rb') if compressed else open(path, 'rb')
+
+def backup_database(compress=False):
+    """Create a timestamped full backup using SQLite's online backup API.
+
+    The copy runs in batches of pages from inside a read transaction, so it
+    is a consistent snapshot and the app keeps writing (to the WAL) meanwhile.
+    """
 
-def backup_database():
-    """Create a timestamped backup of the database"""
-    
-    # Database file
-    db_file = 'clinical_management.db'
-    
     # Check if database exists
-    if not os.path.exists(db_file):
-        print(f"ERROR: Database file '{db_file}' not found!")
+    if not os.path.exists(DB_FILE):
+        print(f"ERROR: Database file '{DB_FILE}' not found!")
         return False
-    
+
     # Create backups directory if it doesn't exist
-    backup_dir = 'backups'
-    if not os.path.exists(backup_dir):
-        os.makedirs(backup_dir)
-        print(f"Created backups directory: {backup_dir}")
-    
+    if not os.path.exists(BACKUP_DIR):
+        os.makedirs(BACKUP_DIR)
+        print(f"Created backups directory: {BACKUP_DIR}")
+
     # Generate backup filename with timestamp
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    backup_file = os.path.join(backup_dir, f'clinical_management_backup_{timestamp}.db')
-    
+    backup_file = os.path.join(BACKUP_DIR, f'clinical_management_backup_{timestamp}.db')
+    if compress:
+        backup_file += '.gz'
+
+    fd, temp_file = tempfile.mkstemp(dir=BACKUP_DIR, suffix='.part')
+    os.close(fd)
     try:
-        # Copy database file
-        shutil.copy2(db_file, backup_file)
+        source = connect(DB_FILE)
+        target = sqlite3.connect(temp_file)
+        try:
+            # Pin a snapshot; otherwise each write would restart the copy
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            source.backup(target, pages=PAGES_PER_BATCH, sleep=BATCH_SLEEP)
+            source.execute('COMMIT')
+        finally:
+            target.close()
+            source.close()
+
+        if compress:
+            with open(temp_file, 'rb') as raw, gzip.open(temp_file + '.gz', 'wb', compresslevel=6) as packed:
+                shutil.copyfileobj(raw, packed, 1024 * 1024)
+            os.remove(temp_file)
+            temp_file += '.gz'
+        os.replace(temp_file, backup_file)
+
         file_size = os.path.getsize(backup_file)
         print(f"✓ Backup created successfully!")
         print(f"  File: {backup_file}")
         print(f"  Size: {file_size:,} bytes")
-        
+
         # Clean up old backups (keep last 30)
-        cleanup_old_backups(backup_dir, keep=30)
-        
+        cleanup_old_backups(BACKUP_DIR, keep=30)
+
         return True
     except Exception as e:
         print(f"ERROR: Failed to create backup: {e}")
+        for leftover in (temp_file, temp_file + '.gz'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
         return False
 
+def is_full_backup(filename):
+    return filename.startswith('clinical_management_backup_') and filename.endswith(('.db', '.db.gz'))
+
 def cleanup_old_backups(backup_dir, keep=30):
     """Remove old backup files, keeping only the most recent ones"""
     try:
         # Get all backup files sorted by modification time
         backup_files = []
         for filename in os.listdir(backup_dir):
-            if filename.startswith('clinical_management_backup_') and filename.endswith('.db'):
+            if is_full_backup(filename):
                 filepath = os.path.join(backup_dir, filename)
                 backup_files.append((filepath, os.path.getmtime(filepath)))
-        
+
         # Sort by modification time (newest first)
         backup_files.sort(key=lambda x: x[1], reverse=True)
-        
+
         # Remove old backups
         removed_count = 0
         for filepath, _ in backup_files[keep:]:
@@ -67,50 +133,421 @@ def cleanup_old_backups(backup_dir, keep=30):
                 removed_count += 1
             except Exception as e:
                 print(f"Warning: Could not remove old backup {filepath}: {e}")
-        
+
         if removed_count > 0:
             print(f"  Cleaned up {removed_count} old backup(s)")
-            
+
     except Exception as e:
         print(f"Warning: Error during backup cleanup: {e}")
 
+# Incremental backups
+#
+# Backups are grouped in chains under backups/incremental/chain_<timestamp>/.
+# The first delta of a chain holds every page, later ones only the pages
+# whose hash changed. pages.hash keeps one digest per page of the last
+# backup, so finding changes reads the database once and writes only deltas.
+#
+# Delta file: DELTA_MAGIC, one JSON header line, then (page number, page)
+# records ending with page number 0. The whole file may be gzip compressed.
+
+class PageSnapshot:
+    """Consistent, read-only view of the database file's pages.
+
+    In WAL mode the WAL is checkpointed and emptied under a brief write lock,
+    then a read transaction is opened that reads no WAL frames at all. While
+    it is open checkpoints cannot write into the database file, so the file's
+    pages are exactly this snapshot. Writers only append to the WAL meanwhile.
+    """
+
+    def __init__(self, path, attempts=20):
+        self.path = path
+        self.attempts = attempts
+        self.reader = None
+
+    def __enter__(self):
+        writer = connect(self.path)
+        reader = connect(self.path)
+        try:
+            wal_mode = writer.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal'
+            # Without WAL the read lock makes writers wait until we are done
+            for attempt in range(self.attempts):
+                if wal_mode:
+                    writer.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+                writer.execute('BEGIN IMMEDIATE')
+                try:
+                    # A commit may have slipped in after the checkpoint
+                    wal_empty = not wal_mode or self._wal_size() == 0
+                    if wal_empty:
+                        reader.execute('BEGIN')
+                        reader.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+                finally:
+                    writer.execute('ROLLBACK')
+                if wal_empty:
+                    break
+                time.sleep(0.1 * (attempt + 1))
+            else:
+                raise RuntimeError('database is too busy to take a snapshot, try again later')
+        except BaseException:
+            reader.close()
+            raise
+        finally:
+            writer.close()
+
+        self.reader = reader
+        self.page_size = reader.execute('PRAGMA page_size').fetchone()[0]
+        self.page_count = reader.execute('PRAGMA page_count').fetchone()[0]
+        return self
+
+    def __exit__(self, *exc):
+        self.reader.execute('COMMIT')
+        self.reader.close()
+
+    def _wal_size(self):
+        try:
+            return os.path.getsize(self.path + '-wal')
+        except FileNotFoundError:
+            return 0
+
+    def pages(self):
+        """Yield (page number, page bytes) for every page, 1-based."""
+        with open(self.path, 'rb') as f:
+            for pgno in range(1, self.page_count + 1):
+                page = f.read(self.page_size)
+                if len(page) != self.page_size:
+                    raise RuntimeError(f'database file is shorter than {self.page_count} pages')
+                yield pgno, page
+                if pgno % PAGES_PER_BATCH == 0:
+                    time.sleep(BATCH_SLEEP)  # leave disk bandwidth for the app
+
+def list_chains():
+    if not os.path.exists(INCREMENTAL_DIR):
+        return []
+    chains = [os.path.join(INCREMENTAL_DIR, name) for name in os.listdir(INCREMENTAL_DIR)
+              if name.startswith('chain_') and os.path.exists(os.path.join(INCREMENTAL_DIR, name, 'chain.json'))]
+    return sorted(chains)
+
+def load_chain(chain_dir):
+    with open(os.path.join(chain_dir, 'chain.json')) as f:
+        return json.load(f)
+
+def save_chain(chain_dir, chain):
+    temp_path = os.path.join(chain_dir, 'chain.json.part')
+    with open(temp_path, 'w') as f:
+        json.dump(chain, f, indent=2)
+    os.replace(temp_path, os.path.join(chain_dir, 'chain.json'))
+
+def incremental_backup(compress=False, new_chain=False):
+    """Write the pages changed since the last backup of the current chain"""
+    if not os.path.exists(DB_FILE):
+        print(f"ERROR: Database file '{DB_FILE}' not found!")
+        return False
+    os.makedirs(INCREMENTAL_DIR, exist_ok=True)
+
+    chains = list_chains()
+    chain_dir = chains[-1] if chains and not new_chain else None
+    chain = load_chain(chain_dir) if chain_dir else None
+    if chain and len(chain['deltas']) >= CHAIN_LENGTH:
+        chain_dir = chain = None
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    delta_path = None
+    try:
+        with PageSnapshot(DB_FILE) as snapshot:
+            if chain and chain['page_size'] != snapshot.page_size:
+                print("  Page size changed, starting a new chain")
+                chain_dir = chain = None
+            if chain is None:
+                chain_dir = os.path.join(INCREMENTAL_DIR, f'chain_{timestamp}')
+                os.makedirs(chain_dir)
+                chain = {'page_size': snapshot.page_size, 'deltas': []}
+                previous_hashes = b''
+            else:
+                with open(os.path.join(chain_dir, 'pages.hash'), 'rb') as f:
+                    previous_hashes = f.read()
+
+            delta_name = f'{len(chain["deltas"]):04d}_{timestamp}.delta' + ('.gz' if compress else '')
+            delta_path = os.path.join(chain_dir, delta_name)
+            hashes = bytearray()
+            changed = 0
+
+            raw = open(delta_path + '.part', 'wb')
+            out = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) if compress else raw
+            try:
+                header = {
+                    'page_size': snapshot.page_size,
+                    'page_count': snapshot.page_count,
+                    'created': datetime.now().isoformat(timespec='seconds'),
+                }
+                out.write(DELTA_MAGIC + json.dumps(header).encode() + b'\n')
+                for pgno, page in snapshot.pages():
+                    digest = hashlib.blake2b(page, digest_size=HASH_SIZE).digest()
+                    hashes += digest
+                    offset = (pgno - 1) * HASH_SIZE
+                    if previous_hashes[offset:offset + HASH_SIZE] != digest:
+                        out.write(PAGE_RECORD.pack(pgno))
+                        out.write(page)
+                        changed += 1
+                out.write(PAGE_RECORD.pack(0))
+            finally:
+                if out is not raw:
+                    out.close()
+                raw.close()
+
+        # Publish the delta before the hashes that depend on it
+        os.replace(delta_path + '.part', delta_path)
+        with open(os.path.join(chain_dir, 'pages.hash.part'), 'wb') as f:
+            f.write(hashes)
+        os.replace(os.path.join(chain_dir, 'pages.hash.part'), os.path.join(chain_dir, 'pages.hash'))
+        chain['deltas'].append(delta_name)
+        save_chain(chain_dir, chain)
+
+        print(f"✓ Incremental backup created successfully!")
+        print(f"  File: {delta_path}")
+        print(f"  Pages: {changed:,} of {snapshot.page_count:,} changed")
+        print(f"  Size: {os.path.getsize(delta_path):,} bytes")
+
+        cleanup_old_chains(keep=KEEP_CHAINS)
+        return True
+    except Exception as e:
+        print(f"ERROR: Failed to create incremental backup: {e}")
+        if delta_path and os.path.exists(delta_path + '.part'):
+            os.remove(delta_path + '.part')
+        return False
+
+def cleanup_old_chains(keep=KEEP_CHAINS):
+    removed_count = 0
+    for chain_dir in list_chains()[:-keep]:
+        try:
+            shutil.rmtree(chain_dir)
+            removed_count += 1
+        except Exception as e:
+            print(f"Warning: Could not remove old chain {chain_dir}: {e}")
+    if removed_count > 0:
+        print(f"  Cleaned up {removed_count} old chain(s)")
+
+def read_delta(path):
+    """Yield the delta's header, then its (page number, page) records."""
+    with open_backup_file(path) as f:
+        if f.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+            raise ValueError(f'{path} is not an incremental backup file')
+        header = json.loads(f.readline())
+        yield header
+        page_size = header['page_size']
+        while True:
+            record = f.read(PAGE_RECORD.size)
+            if len(record) != PAGE_RECORD.size:
+                raise ValueError(f'{path} is truncated')
+            pgno, = PAGE_RECORD.unpack(record)
+            if pgno == 0:
+                return
+            page = f.read(page_size)
+            if len(page) != page_size:
+                raise ValueError(f'{path} is truncated')
+            yield pgno, page
+
+def restore_chain(chain_dir, destination, upto=None):
+    """Replay a chain's deltas (the first upto of them) into destination"""
+    chain = load_chain(chain_dir)
+    deltas = chain['deltas'][:upto] if upto else chain['deltas']
+    if not deltas:
+        raise ValueError(f'{chain_dir} has no backups')
+
+    with open(destination, 'wb') as out:
+        for delta_name in deltas:
+            records = read_delta(os.path.join(chain_dir, delta_name))
+            header = next(records)
+            for pgno, page in records:
+                out.seek((pgno - 1) * header['page_size'])
+                out.write(page)
+            # The database may have shrunk (VACUUM) since the previous delta
+            out.truncate(header['page_count'] * header['page_size'])
+    return len(deltas)
+
+def restore_backup(backup_path, destination, upto=None, force=False):
+    if os.path.exists(destination) and not force:
+        print(f"ERROR: '{destination}' already exists (use --force to overwrite)")
+        return False
+    if os.path.abspath(destination) == os.path.abspath(DB_FILE):
+        print("  Make sure the app is stopped before restoring over the live database")
+
+    temp_path = destination + '.part'
+    try:
+        if os.path.isdir(backup_path):
+            applied = restore_chain(backup_path, temp_path, upto)
+            print(f"  Applied {applied} incremental backup(s)")
+        else:
+            with open_backup_file(backup_path) as src, open(temp_path, 'wb') as out:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+
+        result = integrity_check(temp_path)
+        if result != 'ok':
+            raise RuntimeError(f'restored database failed the integrity check: {result}')
+
+        # Stale WAL/SHM files would be replayed over the restored pages
+        remove_wal_files(destination)
+        os.replace(temp_path, destination)
+        print(f"✓ Restored to {destination}")
+        return True
+    except Exception as e:
+        print(f"ERROR: Restore failed: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+def remove_wal_files(path):
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def integrity_check(path):
+    # The copy is still in WAL mode, so opening it creates -wal/-shm files
+    # beside it. Ours are removed again, and stale ones must not be replayed.
+    remove_wal_files(path)
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        rows = conn.execute('PRAGMA integrity_check').fetchall()
+        return '; '.join(row[0] for row in rows)
+    finally:
+        conn.close()
+        remove_wal_files(path)
+
+def verify_backup(backup_path=None):
+    """Restore a backup to a temp file and run SQLite's integrity check on it"""
+    if backup_path is None:
+        backup_path = latest_backup()
+        if backup_path is None:
+            print("No backups found.")
+            return False
+    print(f"Verifying {backup_path}")
+
+    fd, temp_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        if os.path.isdir(backup_path):
+            restore_chain(backup_path, temp_path)
+            # The hashes describe the chain's latest state, page by page
+            with open(os.path.join(backup_path, 'pages.hash'), 'rb') as f:
+                expected = f.read()
+            actual = bytearray()
+            page_size = load_chain(backup_path)['page_size']
+            with open(temp_path, 'rb') as f:
+                for page in iter(lambda: f.read(page_size), b''):
+                    actual += hashlib.blake2b(page, digest_size=HASH_SIZE).digest()
+            if bytes(actual) != expected:
+                print("ERROR: Restored pages do not match the chain's page hashes")
+                return False
+        elif backup_path.endswith('.gz'):
+            with open_backup_file(backup_path) as src, open(temp_path, 'wb') as out:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+        else:
+            shutil.copyfile(backup_path, temp_path)
+
+        result = integrity_check(temp_path)
+        if result != 'ok':
+            print(f"ERROR: Integrity check failed: {result}")
+            return False
+        print("✓ Backup is valid")
+        return True
+    except Exception as e:
+        print(f"ERROR: Could not verify backup: {e}")
+        return False
+    finally:
+        os.remove(temp_path)
+
+def latest_backup():
+    candidates = []
+    if os.path.exists(BACKUP_DIR):
+        for filename in os.listdir(BACKUP_DIR):
+            if is_full_backup(filename):
+                filepath = os.path.join(BACKUP_DIR, filename)
+                candidates.append((os.path.getmtime(filepath), filepath))
+    for chain_dir in list_chains():
+        candidates.append((os.path.getmtime(os.path.join(chain_dir, 'chain.json')), chain_dir))
+    return max(candidates)[1] if candidates else None
+
 def list_backups():
     """List all available backups"""
-    backup_dir = 'backups'
-    
-    if not os.path.exists(backup_dir):
+    if not os.path.exists(BACKUP_DIR):
         print("No backups found.")
         return
-    
+
     backup_files = []
-    for filename in os.listdir(backup_dir):
-        if filename.startswith('clinical_management_backup_') and filename.endswith('.db'):
-            filepath = os.path.join(backup_dir, filename)
+    for filename in os.listdir(BACKUP_DIR):
+        if is_full_backup(filename):
+            filepath = os.path.join(BACKUP_DIR, filename)
             size = os.path.getsize(filepath)
             mtime = os.path.getmtime(filepath)
             backup_files.append((filename, size, mtime))
-    
-    if not backup_files:
+    chains = list_chains()
+
+    if not backup_files and not chains:
         print("No backups found.")
         return
-    
+
     backup_files.sort(key=lambda x: x[2], reverse=True)
-    
-    print(f"\nAvailable backups ({len(backup_files)}):")
-    print("-" * 70)
-    for filename, size, mtime in backup_files:
-        date_str = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
-        print(f"  {filename}")
-        print(f"    Date: {date_str}  |  Size: {size:,} bytes")
+
+    if backup_files:
+        print(f"\nAvailable backups ({len(backup_files)}):")
+        print("-" * 70)
+        for filename, size, mtime in backup_files:
+            date_str = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"  {filename}")
+            print(f"    Date: {date_str}  |  Size: {size:,} bytes")
+
+    if chains:
+        print(f"\nIncremental chains ({len(chains)}):")
+        print("-" * 70)
+        for chain_dir in reversed(chains):
+            deltas = load_chain(chain_dir)['deltas']
+            size = sum(os.path.getsize(os.path.join(chain_dir, name)) for name in deltas)
+            print(f"  {chain_dir}")
+            print(f"    Backups: {len(deltas)}  |  Size: {size:,} bytes")
+            if deltas:
+                print(f"    Latest: {deltas[-1]}")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Clinical Management System database backups')
+    parser.add_argument('--compress', action='store_true', help='gzip the backup')
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('list', help='list backups')
+
+    incremental = commands.add_parser('incremental', help='back up only the pages changed since the last backup')
+    incremental.add_argument('--compress', action='store_true', help='gzip the backup')
+    incremental.add_argument('--new-chain', action='store_true', help='start a new chain with a full copy')
+
+    verify = commands.add_parser('verify', help='check that a backup restores to a valid database')
+    verify.add_argument('backup', nargs='?', help='backup file or chain directory (default: latest)')
+
+    restore = commands.add_parser('restore', help='restore a backup file or chain directory')
+    restore.add_argument('backup', help='backup file or chain directory')
+    restore.add_argument('destination', help='database file to create')
+    restore.add_argument('--upto', type=int, help='only apply the first N backups of a chain')
+    restore.add_argument('--force', action='store_true', help='overwrite an existing destination')
+
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
     print("Clinical Management System - Database Backup")
     print("=" * 50)
-    
-    if len(sys.argv) > 1 and sys.argv[1] == 'list':
+
+    args = parse_args(sys.argv[1:])
+    if args.command == 'list':
         list_backups()
+    elif args.command == 'verify':
+        if not verify_backup(args.backup):
+            sys.exit(1)
+    elif args.command == 'restore':
+        if not restore_backup(args.backup, args.destination, args.upto, args.force):
+            sys.exit(1)
+    elif args.command == 'incremental':
+        if incremental_backup(compress=args.compress, new_chain=args.new_chain):
+            print("\nBackup completed successfully!")
+        else:
+            print("\nBackup failed!")
+            sys.exit(1)
     else:
-        if backup_database():
+        if backup_database(compress=args.compress):
             print("\nBackup completed successfully!")
         else:
             print("\nBackup failed!")
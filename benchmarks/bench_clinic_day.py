@@ -0,0 +1,698 @@
+"""
+Clinic Day Load Test
+Seeds a synthetic clinic at a configurable scale (registered patients with
+vitals and appointments, today's visits at every stage with their exams,
+lab images, diagnoses and prescriptions, and pharmacy stock), then drives
+the app with the mix of requests a clinic day brings: registrations,
+triage, queue page refreshes, patient searches, exam requests, lab
+uploads, prescriptions, payments and dispensing. Reports p50/p95/p99
+latency and throughput per route, and compares them with a stored
+baseline.
+
+Requests go through Flask's test client by default. With --server they
+are sent over HTTP to a local threaded server (run.py's
+ThreadPoolWSGIServer), which adds sockets, request parsing and the thread
+pool. Each client works on the patients at the head of a queue, so two
+clients can race for the same one; the loser gets the redirect and flash
+message a double click would.
+
+Baselines are machine specific: record one for the machine you compare
+on with --save-baseline before changing the code.
+
+Usage: python benchmarks/bench_clinic_day.py [--patients 5000] [--visits 200]
+       [--requests 2000] [--clients 4] [--server] [--save-baseline]
+       [--tolerance 0.25] [--fail-on-regression]
+"""
+
+import argparse
+import http.client
+import io
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+BASELINE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+VITALS_PER_PATIENT = 3
+APPOINTMENT_SHARE = 0.25  # of registered patients with an upcoming appointment
+# Where today's visits are when the day is simulated
+STAGE_SHARES = {'waiting': 35, 'sent_to_lab': 25, 'completed': 15, 'paid': 10, 'sent': 15}
+TOLERANCE = 0.25  # default share a p50 or p95 may grow by before it is flagged
+# Changes smaller than this are never regressions: the clients share the
+# GIL, so a fast route's p95 includes waiting out a page render elsewhere
+NOISE_FLOOR_MS = 10.0
+MIN_SAMPLES = 50  # below this a route's p95 is one or two requests, too few to flag
+
+FIRST_NAMES = ['Amina', 'Brian', 'Carmen', 'David', 'Esther', 'Farid', 'Grace', 'Hassan', 'Irene', 'James',
+               'Kofi', 'Lucia', 'Moses', 'Nadia', 'Oscar', 'Priya', 'Quentin', 'Rosa', 'Samuel', 'Teresa']
+LAST_NAMES = ['Achieng', 'Bianchi', 'Castillo', 'Dlamini', 'Eriksen', 'Fofana', 'Garcia', 'Haddad', 'Ivanova',
+              'Johnson', 'Kamau', 'Lopez', 'Mensah', 'Nakamura', 'Okafor', 'Petrov', 'Quispe', 'Reyes',
+              'Santos', 'Tanaka']
+BLOOD_TYPES = ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']
+DEPARTMENTS = ['General', 'Pediatrics', 'Maternity', 'Outpatient', 'Emergency']
+PAYMENT_METHODS = ['cash', 'insurance', 'card', 'mobile_money']
+COMPLAINTS = ['Fever and headache', 'Persistent cough', 'Abdominal pain', 'Fatigue', 'Chest tightness']
+DIAGNOSES = ['Malaria', 'Upper respiratory tract infection', 'Gastritis', 'Hypertension', 'Anaemia']
+MEDICINES = [('Amoxicillin', '500mg'), ('Paracetamol', '1g'), ('Ibuprofen', '400mg'), ('Metformin', '500mg'),
+             ('Amlodipine', '5mg'), ('Omeprazole', '20mg'), ('Ciprofloxacin', '500mg'), ('Artemether', '80mg')]
+
+def make_png(rng, kilobytes):
+    """An RGB PNG of random pixels, about kilobytes in size, like a scan
+    that doesn't compress."""
+    side = max(1, int(math.sqrt(kilobytes * 1024 / 3)))
+    rows = b''.join(b'\x00' + rng.randbytes(side * 3) for _ in range(side))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', side, side, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows, 1))
+            + chunk(b'IEND', b''))
+
+def stamp(moment):
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+def random_name(rng):
+    return f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+
+def random_medicines(rng):
+    return [
+        {'medicine': name, 'amount': amount, 'times_per_day': rng.randint(1, 3), 'duration_days': rng.randint(3, 14)}
+        for name, amount in rng.sample(MEDICINES, rng.randint(1, 3))
+    ]
+
+def seed(db, rng, patients, visits, upload_folder, image):
+    """Fill a fresh database through the app's own schema. Returns the row
+    counts of the tables written."""
+    from models.lab_tests import add_exam_tests
+    from models.prescriptions import add_prescription_items
+    from models.workflow import rebuild_patient_flow
+
+    now = datetime.now().replace(microsecond=0)
+    tests = db.execute('SELECT id, code, name FROM lab_tests WHERE active = 1').fetchall()
+
+    db.executemany('''
+        INSERT INTO patients (id, name, date_of_birth, gender, blood_type, allergies, contact,
+                              address, department, payment_method, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (i, random_name(rng), f'{rng.randint(1940, 2022)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+         rng.choice(['Female', 'Male']), rng.choice(BLOOD_TYPES), rng.choice(['', '', 'Penicillin', 'Sulfa']),
+         f'07{rng.randint(10000000, 99999999)}', f'{rng.randint(1, 400)} Market Street',
+         rng.choice(DEPARTMENTS), rng.choice(PAYMENT_METHODS), stamp(now - timedelta(days=rng.randint(1, 720))))
+        for i in range(1, patients + 1)
+    ])
+    db.executemany('''
+        INSERT INTO vitals (patient_id, blood_pressure, heart_rate, temperature, respiratory_rate,
+                            oxygen_saturation, recorded_by, recorded_at)
+        VALUES (?, ?, ?, ?, ?, ?, 'nurse', ?)
+    ''', [
+        (i, f'{rng.randint(100, 150)}/{rng.randint(60, 95)}', rng.randint(55, 110),
+         round(rng.uniform(36.0, 39.0), 1), rng.randint(12, 24), rng.randint(90, 100),
+         stamp(now - timedelta(days=rng.randint(1, 720), minutes=rng.randint(0, 600))))
+        for i in range(1, patients + 1) for _ in range(VITALS_PER_PATIENT)
+    ])
+    appointments = [
+        (i, (now + timedelta(days=rng.randint(1, 30))).strftime('%Y-%m-%d'),
+         f'{rng.randint(8, 16):02d}:{rng.choice(["00", "30"])}', 'Follow-up')
+        for i in rng.sample(range(1, patients + 1), int(patients * APPOINTMENT_SHARE))
+    ]
+    db.executemany(
+        "INSERT INTO appointments (patient_id, date, time, reason, status) VALUES (?, ?, ?, ?, 'scheduled')",
+        appointments
+    )
+
+    stock_items = []
+    for medicine, _ in MEDICINES:
+        item_id = db.execute('INSERT INTO stock_items (medicine) VALUES (?)', (medicine,)).lastrowid
+        stock_items.append((item_id, medicine))
+    db.executemany('''
+        INSERT INTO stock_ledger (item_id, kind, on_hand_change, reorder_level, created_by)
+        VALUES (?, 'receive', 1000000, 100, 'pharmacist')
+    ''', [(item_id,) for item_id, _ in stock_items])
+    stock_ids = {medicine: item_id for item_id, medicine in stock_items}
+
+    stages = rng.choices(list(STAGE_SHARES), weights=list(STAGE_SHARES.values()), k=visits)
+    lab_rows = 0
+    for consultation_id, (patient_id, stage) in enumerate(
+            zip(rng.sample(range(1, patients + 1), visits), stages), start=1):
+        arrived = now - timedelta(minutes=rng.randint(5, 480))
+        status = stage if stage in ('waiting', 'sent_to_lab') else 'completed'
+        db.execute(
+            "INSERT INTO consultations (id, patient_id, status, added_by, created_at) VALUES (?, ?, ?, 'nurse', ?)",
+            (consultation_id, patient_id, status, stamp(arrived))
+        )
+        if stage == 'waiting' and rng.random() < 0.5:
+            continue  # not seen by the doctor yet
+
+        # Exams are pending for the lab queue, finished with results otherwise
+        requested = rng.sample(tests, rng.randint(1, 3))
+        finished = stage != 'sent_to_lab'
+        exam_id = db.execute('''
+            INSERT INTO exams (consultation_id, patient_id, presenting_complaint, history_of_complaint,
+                               clinical_details, status, created_by, created_at)
+            VALUES (?, ?, ?, 'Three days', 'Rule out infection', ?, 'doctor', ?)
+        ''', (consultation_id, patient_id, rng.choice(COMPLAINTS), 'completed' if finished else 'pending',
+              stamp(arrived + timedelta(minutes=10)))).lastrowid
+        priority = rng.choices([0, 1, 2], weights=[85, 10, 5])[0]
+        add_exam_tests(db, exam_id, [test['id'] for test in requested], priority)
+        if not finished:
+            continue
+        db.execute("UPDATE exam_tests SET status = 'completed' WHERE exam_id = ?", (exam_id,))
+        results = []
+        for test in requested:
+            filename = f"{patient_id}_{test['code']}_seed.png"
+            with open(os.path.join(upload_folder, filename), 'wb') as f:
+                f.write(image)
+            results.append((exam_id, patient_id, test['name'], f'/static/lab_results/{filename}',
+                            'Rule out infection', 'Within normal limits', 'completed', 'labtech'))
+        db.executemany('''
+            INSERT INTO laboratory (exam_id, patient_id, test_name, test_result_image, clinical_details,
+                                    general_comments, status, processed_by)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', results)
+        lab_rows += len(results)
+        if stage == 'waiting':
+            continue  # back from the lab
+
+        db.execute('''
+            INSERT INTO diagnoses (consultation_id, patient_id, confirmed_diagnosis, diagnosed_by)
+            VALUES (?, ?, ?, 'doctor')
+        ''', (consultation_id, patient_id, rng.choice(DIAGNOSES)))
+        prescription_id = db.execute('''
+            INSERT INTO prescriptions (consultation_id, patient_id, prescribed_by, prescribed_at,
+                                       status, pharmacy_status)
+            VALUES (?, ?, 'doctor', ?, ?, ?)
+        ''', (consultation_id, patient_id, stamp(arrived + timedelta(minutes=90)),
+              'pending' if stage == 'completed' else 'paid', 'sent' if stage == 'sent' else 'not_sent')).lastrowid
+        medicines = random_medicines(rng)
+        add_prescription_items(db, prescription_id, medicines)
+        db.executemany('''
+            INSERT INTO stock_ledger (item_id, kind, reserved_change, prescription_id, created_by)
+            VALUES (?, 'reserve', ?, ?, 'doctor')
+        ''', [(stock_ids[med['medicine']], med['times_per_day'] * med['duration_days'], prescription_id)
+              for med in medicines])
+
+    # Stages and timestamps from the status columns just written
+    rebuild_patient_flow(db)
+    db.commit()
+    return {
+        'patients': patients,
+        'vitals': patients * VITALS_PER_PATIENT,
+        'appointments': len(appointments),
+        'visits': visits,
+        'lab images': lab_rows,
+    }
+
+class Picker:
+    """Finds the rows a request works on, outside the timed part, through
+    its own connection to the benchmark database."""
+
+    def __init__(self, db_path, rng):
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.rng = rng
+
+    def one(self, sql, params=()):
+        rows = self.conn.execute(sql, params).fetchall()
+        return self.rng.choice(rows) if rows else None
+
+    def queue(self, stage, extra=''):
+        # Staff take one of the patients at the head of the queue
+        return self.one(f'''
+            SELECT consultation_id, patient_id, exam_id, prescription_id FROM patient_flow
+            WHERE stage = ? {extra}
+            ORDER BY priority DESC, queued_at
+            LIMIT 10
+        ''', (stage,))
+
+    def patient(self):
+        row = self.one('SELECT id FROM patients WHERE id >= ? ORDER BY id LIMIT 1',
+                       (self.rng.randint(1, self.max_patient_id()),))
+        return row[0] if row else None
+
+    def max_patient_id(self):
+        return self.conn.execute('SELECT COALESCE(MAX(id), 1) FROM patients').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+# Request builders: (method, path, form, files), or None when there is
+# nobody to work on right now
+
+def register(picker, rng):
+    return 'POST', '/patients/add', {
+        'name': random_name(rng),
+        'date_of_birth': f'{rng.randint(1940, 2022)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+        'gender': rng.choice(['Female', 'Male']),
+        'blood_type': rng.choice(BLOOD_TYPES),
+        'contact': f'07{rng.randint(10000000, 99999999)}',
+        'address': f'{rng.randint(1, 400)} Market Street',
+        'department': rng.choice(DEPARTMENTS),
+        'payment_method': rng.choice(PAYMENT_METHODS),
+    }, None
+
+def queue_patient(picker, rng):
+    row = picker.one('''
+        SELECT id FROM patients p
+        WHERE NOT EXISTS (SELECT 1 FROM consultations c WHERE c.patient_id = p.id)
+        ORDER BY id DESC
+        LIMIT 10
+    ''')
+    return ('GET', f'/consultations/add/{row[0]}', None, None) if row else None
+
+def record_vitals(picker, rng):
+    row = picker.queue('waiting')
+    if not row:
+        return None
+    return 'POST', '/vitals/add', {
+        'patient_id': row[1],
+        'blood_pressure': f'{rng.randint(100, 150)}/{rng.randint(60, 95)}',
+        'heart_rate': rng.randint(55, 110),
+        'temperature': round(rng.uniform(36.0, 39.0), 1),
+        'respiratory_rate': rng.randint(12, 24),
+        'oxygen_saturation': rng.randint(90, 100),
+    }, None
+
+def book_appointment(picker, rng):
+    patient_id = picker.patient()
+    if patient_id is None:
+        return None
+    return 'POST', '/appointments/add', {
+        'patient_id': patient_id,
+        'date': (datetime.now() + timedelta(days=rng.randint(1, 30))).strftime('%Y-%m-%d'),
+        'time': f'{rng.randint(8, 16):02d}:{rng.choice(["00", "30"])}',
+        'reason': 'Follow-up',
+    }, None
+
+def request_exam(picker, rng):
+    row = picker.queue('waiting', 'AND exam_id IS NULL')
+    if not row:
+        return None
+    codes = [code for (code,) in picker.conn.execute('SELECT code FROM lab_tests WHERE active = 1')]
+    return 'POST', '/exams/add', {
+        'consultation_id': row[0],
+        'patient_id': row[1],
+        'presenting_complaint': rng.choice(COMPLAINTS),
+        'history_of_complaint': 'Three days',
+        'tests': rng.sample(codes, rng.randint(1, 3)),
+        'priority': rng.choices([0, 1, 2], weights=[85, 10, 5])[0],
+        'clinical_details': 'Rule out infection',
+    }, None
+
+def upload_results(image):
+    def build(picker, rng):
+        row = picker.queue('sent_to_lab')
+        if not row or not row[2]:
+            return None
+        codes = [code for (code,) in picker.conn.execute('''
+            SELECT t.code FROM exam_tests et JOIN lab_tests t ON t.id = et.test_id
+            WHERE et.exam_id = ? AND et.status = 'pending'
+        ''', (row[2],))]
+        if not codes:
+            return None
+        return 'POST', '/laboratory/submit', {
+            'exam_id': row[2],
+            'patient_id': row[1],
+            'general_comments': 'Within normal limits',
+        }, {f'test_{code}_image': (f'{code}.png', image) for code in codes}
+    return build
+
+def prescribe(picker, rng):
+    row = picker.queue('waiting')
+    if not row:
+        return None
+    medicines = random_medicines(rng)
+    form = {'consultation_id': row[0], 'patient_id': row[1], 'medicine_count': len(medicines)}
+    for i, med in enumerate(medicines):
+        form[f'medicine_type_{i}'] = med['medicine']
+        form[f'medicine_amount_{i}'] = med['amount']
+        form[f'medicine_times_{i}'] = med['times_per_day']
+        form[f'medicine_duration_{i}'] = med['duration_days']
+    return 'POST', '/prescription/submit', form, None
+
+def pay(picker, rng):
+    row = picker.queue('completed', 'AND prescription_id IS NOT NULL')
+    if not row:
+        return None
+    return 'POST', f'/account/complete/{row[3]}', {'payment_method': rng.choice(PAYMENT_METHODS)}, None
+
+def send_to_pharmacy(picker, rng):
+    row = picker.queue('paid')
+    return ('POST', f'/account/send-to-pharmacy/{row[3]}', {}, None) if row else None
+
+def dispense(picker, rng):
+    row = picker.queue('sent')
+    return ('POST', f'/pharmacy/complete/{row[3]}', {}, None) if row else None
+
+def receive_stock(picker, rng):
+    return 'POST', '/pharmacy/stock/receive', {'medicine': rng.choice(MEDICINES)[0], 'quantity': 500}, None
+
+def patient_history(picker, rng):
+    patient_id = picker.patient()
+    return ('GET', f'/api/patient/{patient_id}/history', None, None) if patient_id else None
+
+def lab_results(picker, rng):
+    row = picker.one('SELECT patient_id FROM laboratory ORDER BY id DESC LIMIT 20')
+    return ('GET', f'/laboratory/results/{row[0]}', None, None) if row else None
+
+def search(picker, rng):
+    return 'GET', '/api/patients?' + urlencode({'q': rng.choice(LAST_NAMES)[:3]}), None, None
+
+def typeahead(picker, rng):
+    return 'GET', '/api/patients/typeahead?' + urlencode({'q': rng.choice(FIRST_NAMES)[:2]}), None, None
+
+def page(path):
+    return lambda picker, rng: ('GET', path, None, None)
+
+def workload(image):
+    """(route, weight, request builder) of a clinic day. Queue moves are
+    weighted so patients keep flowing from registration to the pharmacy."""
+    return [
+        ('GET /consultations', 12, page('/consultations')),
+        ('GET /laboratory', 8, page('/laboratory')),
+        ('GET /account', 6, page('/account')),
+        ('GET /pharmacy', 6, page('/pharmacy')),
+        ('GET /dashboard', 4, page('/dashboard')),
+        ('GET /patients', 3, page('/patients')),
+        ('GET /api/laboratory/queues', 3, page('/api/laboratory/queues')),
+        ('GET /api/reports/flow', 1, page('/api/reports/flow')),
+        ('GET /api/patients', 8, search),
+        ('GET /api/patients/typeahead', 6, typeahead),
+        ('GET /api/patient/<id>/history', 4, patient_history),
+        ('GET /laboratory/results/<id>', 3, lab_results),
+        ('POST /patients/add', 4, register),
+        ('GET /consultations/add/<id>', 4, queue_patient),
+        ('POST /vitals/add', 6, record_vitals),
+        ('POST /appointments/add', 2, book_appointment),
+        ('POST /exams/add', 3, request_exam),
+        ('POST /laboratory/submit', 3, upload_results(image)),
+        ('POST /prescription/submit', 3, prescribe),
+        ('POST /account/complete/<id>', 3, pay),
+        ('POST /account/send-to-pharmacy/<id>', 3, send_to_pharmacy),
+        ('POST /pharmacy/complete/<id>', 3, dispense),
+        ('POST /pharmacy/stock/receive', 1, receive_stock),
+    ]
+
+class TestClientSession:
+    """A logged-in user, served in process by Flask's test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+        self.client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+
+    def request(self, method, path, form=None, files=None):
+        """Sends the request; True unless it failed or was sent to the login page."""
+        data = dict(form or {})
+        for field, (filename, content) in (files or {}).items():
+            data[field] = (io.BytesIO(content), filename)
+        response = self.client.open(path, method=method, data=data or None)
+        response.get_data()
+        response.close()
+        return response.status_code < 400 and not is_login_redirect(response.status_code, response.location)
+
+class HttpSession:
+    """A logged-in user talking HTTP to a server, keeping its cookies."""
+
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+        self.cookies = {}
+        self.request('POST', '/login', {'username': 'admin', 'password': 'admin123'})
+
+    def request(self, method, path, form=None, files=None):
+        """Sends the request; True unless it failed or was sent to the login page."""
+        headers = {}
+        body = None
+        if files:
+            body, headers['Content-Type'] = encode_multipart(form or {}, files)
+        elif form is not None:
+            body = urlencode(form, doseq=True).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in self.cookies.items())
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            name, _, value = header.split(';', 1)[0].partition('=')
+            if value:
+                self.cookies[name.strip()] = value
+            else:
+                self.cookies.pop(name.strip(), None)
+        if response.getheader('Connection', '').lower() == 'close' or response.version == 10:
+            self.connection.close()
+        return response.status < 400 and not is_login_redirect(response.status, response.getheader('Location'))
+
+def is_login_redirect(status, location):
+    return status in (301, 302, 303, 307) and urlsplit(location or '').path == '/login'
+
+def encode_multipart(form, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in form.items():
+        for item in value if isinstance(value, list) else [value]:
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{item}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def run_clients(sessions, db_path, routes, requests, seed):
+    """Sends requests spread over one thread per session. Returns
+    [(route, seconds, ok)] and the wall clock seconds taken."""
+    weights = [weight for _, weight, _ in routes]
+    remaining = [requests]
+    results = []
+    lock = threading.Lock()
+
+    def client(index, session):
+        rng = random.Random(seed * 1000 + index)
+        picker = Picker(db_path, rng)
+        timings = []
+        try:
+            while True:
+                with lock:
+                    if not remaining[0]:
+                        break
+                    remaining[0] -= 1
+                while True:
+                    route, _, build = rng.choices(routes, weights=weights)[0]
+                    request = build(picker, rng)
+                    if request is not None:
+                        break
+                started = time.perf_counter()
+                try:
+                    ok = session.request(*request)
+                except Exception as e:
+                    print(f'Warning: {route} failed: {e}')
+                    ok = False
+                timings.append((route, time.perf_counter() - started, ok))
+        finally:
+            picker.close()
+            with lock:
+                results.extend(timings)
+
+    threads = [threading.Thread(target=client, args=(i, session)) for i, session in enumerate(sessions)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+def percentile(values, p):
+    # Nearest rank on sorted values
+    return values[max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))]
+
+def latency_stats(results, seconds):
+    values = sorted(elapsed * 1000 for _, elapsed, _ in results)
+    return {
+        'count': len(values),
+        'errors': sum(1 for *_, ok in results if not ok),
+        'p50': round(percentile(values, 50), 2),
+        'p95': round(percentile(values, 95), 2),
+        'p99': round(percentile(values, 99), 2),
+        'rps': round(len(values) / seconds, 1),
+    }
+
+def summarize(results, seconds):
+    by_route = {}
+    for result in results:
+        by_route.setdefault(result[0], []).append(result)
+    return {
+        'routes': {route: latency_stats(by_route[route], seconds) for route in sorted(by_route)},
+        'total': latency_stats(results, seconds),
+    }
+
+def compare(stats, base, tolerance):
+    """(p95 change, flag) against the baseline's stats for the same route.
+    Slower means p50 or p95 grew by more than tolerance and the noise floor."""
+    if not base or not base['p95']:
+        return None, ''
+    change = stats['p95'] / base['p95'] - 1
+    if stats['count'] < MIN_SAMPLES:
+        return change, ''
+    regressed = any(
+        stats[p] > base[p] * (1 + tolerance) and stats[p] - base[p] >= NOISE_FLOOR_MS for p in ('p50', 'p95')
+    )
+    return change, ' slower' if regressed else (' faster' if change < -tolerance else '')
+
+def report(summary, baseline, tolerance):
+    base_routes = baseline['routes'] if baseline else {}
+    print(f"{'route':<38} | {'count':>5} | {'errors':>6} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8} | "
+          f"{'req/s':>7}" + (f" | {'base p95':>8} | change" if baseline else ''))
+    print('-' * (101 + (27 if baseline else 0)))
+    regressions = []
+    rows = list(summary['routes'].items()) + [('all routes', summary['total'])]
+    for route, stats in rows:
+        line = (f"{route:<38} | {stats['count']:>5} | {stats['errors']:>6} | {stats['p50']:>8.2f} | "
+                f"{stats['p95']:>8.2f} | {stats['p99']:>8.2f} | {stats['rps']:>7.1f}")
+        if baseline:
+            base = baseline['total'] if route == 'all routes' else base_routes.get(route)
+            change, flag = compare(stats, base, tolerance)
+            if change is None:
+                line += f" | {'-':>8} | new"
+            else:
+                line += f" | {base['p95']:>8.2f} | {change:+.0%}{flag}"
+            if flag == ' slower':
+                regressions.append(route)
+        if route == 'all routes':
+            print('-' * (101 + (27 if baseline else 0)))
+        print(line)
+
+    if baseline and summary['total']['rps'] < baseline['total']['rps'] * (1 - tolerance):
+        regressions.append(f"throughput ({summary['total']['rps']:.1f} vs {baseline['total']['rps']:.1f} req/s)")
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test the app with a simulated clinic day.')
+    parser.add_argument('--patients', type=int, default=5000, help='registered patients to seed')
+    parser.add_argument('--visits', type=int, default=200, help="today's visits in progress when the day starts")
+    parser.add_argument('--requests', type=int, default=2000, help='requests to time')
+    parser.add_argument('--warmup', type=int, default=100, help='requests sent before timing starts')
+    parser.add_argument('--clients', type=int, default=4, help='users sending requests at the same time')
+    parser.add_argument('--image-kb', type=int, default=64, help='size of each lab image')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the data and the workload')
+    parser.add_argument('--server', action='store_true', help='send requests over HTTP to a local server')
+    parser.add_argument('--threads', type=int, default=8, help='request threads of the --server')
+    parser.add_argument('--baseline', help='baseline file (default: benchmarks/baselines/clinic_day[_server].json)')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='share a p95 may grow over the baseline before it counts as slower')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='exit with status 1 when a route is slower than the baseline')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    mode = 'server' if args.server else 'test_client'
+    baseline_path = args.baseline or os.path.join(
+        BASELINE_FOLDER, 'clinic_day_server.json' if args.server else 'clinic_day.json'
+    )
+    settings = {
+        'mode': mode, 'patients': args.patients, 'visits': args.visits, 'requests': args.requests,
+        'clients': args.clients, 'image_kb': args.image_kb, 'seed': args.seed,
+    }
+    if args.server:
+        settings['threads'] = args.threads
+
+    workdir = tempfile.mkdtemp(prefix='cms-clinic-day-')
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'clinic.db')
+
+    from app import app, audit_log, lab_previews
+    from models.database import get_db, get_pool
+
+    # Files the run writes stay out of the source tree
+    for key in ('UPLOAD_FOLDER', 'UPLOAD_TEMP_FOLDER', 'LAB_PREVIEW_FOLDER', 'AUDIT_SPOOL_FOLDER'):
+        app.config[key] = os.path.join(workdir, key.lower())
+        os.makedirs(app.config[key])
+    lab_previews.source_folder = app.config['UPLOAD_FOLDER']
+    lab_previews.cache_folder = app.config['LAB_PREVIEW_FOLDER']
+    audit_log.spool_folder = app.config['AUDIT_SPOOL_FOLDER']
+    app.config['DEBUG'] = False
+    app.config['TESTING'] = False
+
+    server = None
+    regressions = []
+    try:
+        rng = random.Random(args.seed)
+        image = make_png(rng, args.image_kb)
+        start = time.perf_counter()
+        with app.app_context():
+            counts = seed(get_db(), rng, args.patients, args.visits, app.config['UPLOAD_FOLDER'], image)
+        print(f"Seeded {', '.join(f'{count:,} {name}' for name, count in counts.items())} "
+              f'in {time.perf_counter() - start:.1f}s')
+
+        if args.server:
+            from run import ThreadPoolWSGIServer
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)  # no access log line per request
+            server = ThreadPoolWSGIServer('127.0.0.1', 0, app, threads=args.threads)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            new_session = lambda: HttpSession('127.0.0.1', server.server_port)
+            print(f'Serving on 127.0.0.1:{server.server_port} with {args.threads} threads')
+        else:
+            new_session = lambda: TestClientSession(app)
+
+        routes = workload(image)
+        sessions = [new_session() for _ in range(args.clients)]
+        run_clients(sessions, app.config['DATABASE'], routes, args.warmup, args.seed + 1)
+        results, seconds = run_clients(sessions, app.config['DATABASE'], routes, args.requests, args.seed)
+        summary = summarize(results, seconds)
+
+        baseline = None
+        if not args.save_baseline and os.path.exists(baseline_path):
+            with open(baseline_path) as f:
+                baseline = json.load(f)
+            if baseline['settings'] != settings:
+                print(f"Warning: Baseline was recorded with {baseline['settings']}; changes are only indicative")
+
+        print(f"\n{summary['total']['count']:,} requests from {args.clients} clients ({mode}) in {seconds:.1f}s\n")
+        regressions = report(summary, baseline, args.tolerance)
+
+        if args.save_baseline:
+            os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+            with open(baseline_path, 'w') as f:
+                json.dump({'settings': settings, 'python': platform.python_version(),
+                           'sqlite': sqlite3.sqlite_version, **summary}, f, indent=2)
+                f.write('\n')
+            print(f'\nBaseline saved to {baseline_path}')
+        elif baseline is None:
+            print(f'\nNo baseline at {baseline_path}; record one with --save-baseline')
+        elif regressions:
+            print(f"\nSlower than the baseline (over +{args.tolerance:.0%}): {', '.join(regressions)}")
+        else:
+            print(f'\nWithin {args.tolerance:.0%} of the baseline')
+
+        with app.app_context():
+            audit_log.flush(get_db())
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.drain()
+            server.server_close()
+        get_pool(app).close_all()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Consultation Queue Benchmark
+Times the consultations() queue query from 10 to 5,000 waiting patients
+and compares it with the old per-row (3N+1) lookups.
+
+Usage: python benchmarks/bench_consultation_queue.py
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+SIZES = [10, 100, 1000, 5000]
+REPEAT = 5
+
+def seed(db, count):
+    db.execute('DELETE FROM patients')
+    db.executemany(
+        '''INSERT INTO patients (id, name, date_of_birth, gender, contact, department)
+           VALUES (?, ?, '1980-01-01', 'Female', ?, 'OPD')''',
+        [(i, f'Patient {i:05d}', f'555-{i:05d}') for i in range(1, count + 1)]
+    )
+    db.executemany(
+        "INSERT INTO consultations (id, patient_id, status, added_by) VALUES (?, ?, 'waiting', 'bench')",
+        [(i, i) for i in range(1, count + 1)]
+    )
+    # Every other patient has been to the lab, every third has a diagnosis,
+    # every fifth a prescription
+    db.executemany(
+        '''INSERT INTO exams (consultation_id, patient_id, presenting_complaint, status, created_by)
+           VALUES (?, ?, 'Headache', 'completed', 'bench')''',
+        [(i, i) for i in range(1, count + 1, 2)]
+    )
+    db.executemany(
+        '''INSERT INTO diagnoses (consultation_id, patient_id, confirmed_diagnosis, diagnosed_by)
+           VALUES (?, ?, 'Migraine', 'bench')''',
+        [(i, i) for i in range(1, count + 1, 3)]
+    )
+    db.executemany(
+        '''INSERT INTO prescriptions (consultation_id, patient_id, prescribed_by)
+           VALUES (?, ?, 'bench')''',
+        [(i, i) for i in range(1, count + 1, 5)]
+    )
+    db.commit()
+
+def legacy_queue(db):
+    # The pre-aggregation implementation, kept here for comparison
+    rows = db.execute(
+        '''SELECT c.*, p.name FROM consultations c
+           JOIN patients p ON c.patient_id = p.id
+           WHERE c.status = 'waiting' ORDER BY c.created_at ASC'''
+    ).fetchall()
+    result = []
+    for consult in rows:
+        consult_dict = dict(consult)
+        exam = db.execute(
+            'SELECT id, status FROM exams WHERE consultation_id = ? ORDER BY created_at DESC LIMIT 1',
+            (consult['id'],)
+        ).fetchone()
+        consult_dict['exam_status'] = exam['status'] if exam else None
+        consult_dict['has_diagnosis'] = db.execute(
+            'SELECT id FROM diagnoses WHERE consultation_id = ? LIMIT 1', (consult['id'],)
+        ).fetchone() is not None
+        consult_dict['has_prescription'] = db.execute(
+            'SELECT id FROM prescriptions WHERE consultation_id = ? LIMIT 1', (consult['id'],)
+        ).fetchone() is not None
+        result.append(consult_dict)
+    return result
+
+def measure(db, func):
+    statements = []
+    db.set_trace_callback(statements.append)
+    func(db)
+    db.set_trace_callback(None)
+
+    best = float('inf')
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(db)
+        best = min(best, time.perf_counter() - start)
+    return best, len(statements)
+
+def main():
+    handle, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    os.environ['DATABASE_PATH'] = db_path
+
+    from app import app
+    from models.database import get_db
+    from models.consultations import get_waiting_queue
+
+    try:
+        with app.app_context():
+            db = get_db()
+            print(f"{'queued':>8} | {'aggregated ms':>13} {'us/row':>8} {'stmts':>5} | "
+                  f"{'legacy ms':>10} {'us/row':>8} {'stmts':>6}")
+            print('-' * 75)
+            for size in SIZES:
+                seed(db, size)
+                new_time, new_stmts = measure(db, get_waiting_queue)
+                old_time, old_stmts = measure(db, legacy_queue)
+                print(f"{size:>8} | {new_time * 1000:>13.2f} {new_time / size * 1e6:>8.1f} {new_stmts:>5} | "
+                      f"{old_time * 1000:>10.2f} {old_time / size * 1e6:>8.1f} {old_stmts:>6}")
+    finally:
+        os.remove(db_path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Consultation Page Render Benchmark
+Times rendering consultations.html with 500 queued patients: compiling
+the template with and without the bytecode cache, and rendering the
+queue with the row fragment cache off, cold and warm.
+
+Usage: python benchmarks/bench_render_consultations.py
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+QUEUED = 500
+REPEAT = 5
+
+def seed(db, count):
+    db.executemany(
+        '''INSERT INTO patients (id, name, date_of_birth, gender, blood_type, allergies, contact, address, department, payment_method)
+           VALUES (?, ?, '1980-01-01', 'Female', 'O+', 'Penicillin', ?, '12 Main St', 'OPD', 'Cash')''',
+        [(i, f'Patient {i:05d}', f'555-{i:05d}') for i in range(1, count + 1)]
+    )
+    db.executemany(
+        "INSERT INTO consultations (id, patient_id, status, added_by) VALUES (?, ?, 'waiting', 'bench')",
+        [(i, i) for i in range(1, count + 1)]
+    )
+    # Every third patient has a diagnosis, so rows differ
+    db.executemany(
+        "INSERT INTO diagnoses (consultation_id, patient_id, confirmed_diagnosis, diagnosed_by) VALUES (?, ?, 'Flu', 'bench')",
+        [(i, i) for i in range(1, count + 1, 3)]
+    )
+    db.commit()
+
+def best_of(func):
+    best = float('inf')
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    handle, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    cache_dir = tempfile.mkdtemp()
+    os.environ['DATABASE_PATH'] = db_path
+
+    from jinja2 import Environment, FileSystemBytecodeCache
+    from flask import render_template, session
+    from app import app
+    from models.database import get_db
+    from models.consultations import get_waiting_queue
+    from models.fragments import fragment_cache
+    from models.lab_tests import get_lab_tests
+
+    def load_template(bytecode_cache):
+        # A fresh environment is what a newly started worker has
+        env = Environment(loader=app.jinja_env.loader, bytecode_cache=bytecode_cache)
+        env.get_template('consultations.html')
+
+    try:
+        print(f"{'template load':<28} {'ms':>8}")
+        print('-' * 37)
+        no_cache = best_of(lambda: load_template(None))
+        load_template(FileSystemBytecodeCache(cache_dir))
+        with_cache = best_of(lambda: load_template(FileSystemBytecodeCache(cache_dir)))
+        print(f"{'compile from source':<28} {no_cache * 1000:>8.2f}")
+        print(f"{'bytecode cache':<28} {with_cache * 1000:>8.2f}")
+        print()
+
+        with app.test_request_context('/consultations'):
+            # layout.html only renders the page body for a signed-in user
+            session.update(user_id=1, username='admin', role='admin')
+            db = get_db()
+            seed(db, QUEUED)
+            queue = get_waiting_queue(db)
+            lab_tests = get_lab_tests(db)
+
+            def render():
+                return render_template('consultations.html', consultations=queue, lab_tests=lab_tests)
+
+            max_bytes = fragment_cache.max_bytes
+            fragment_cache.max_bytes = 0
+            render()
+            off = best_of(render)
+            page = render()
+
+            fragment_cache.max_bytes = max_bytes
+            def cold():
+                fragment_cache.clear()
+                render()
+            cold_time = best_of(cold)
+            render()
+            warm = best_of(render)
+            assert render() == page, 'cached page differs from the uncached one'
+
+            print(f"{QUEUED} queued patients, {len(page) / 1024:.0f} KB page")
+            print(f"{'render':<28} {'ms':>8} {'us/row':>8}")
+            print('-' * 46)
+            for label, seconds in (('fragment cache off', off), ('fragment cache cold', cold_time),
+                                   ('fragment cache warm', warm)):
+                print(f"{label:<28} {seconds * 1000:>8.2f} {seconds / QUEUED * 1e6:>8.1f}")
+    finally:
+        os.remove(db_path)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
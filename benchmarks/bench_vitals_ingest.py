@@ -0,0 +1,85 @@
+"""
+Vitals Ingestion Benchmark
+Records rounds of readings through /vitals/add (one form post and commit
+per reading) and through /api/vitals/batch as a JSON array and as NDJSON,
+and reports readings per second.
+
+Usage: python benchmarks/bench_vitals_ingest.py
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+SIZES = [60, 600, 5000]
+PATIENTS = 60
+FORM_POST_LIMIT = 600  # one commit each, so larger rounds take too long
+
+def reading(i):
+    return {
+        'patient_id': i % PATIENTS + 1,
+        'blood_pressure': f'{110 + i % 40}/{70 + i % 20}',
+        'heart_rate': 60 + i % 40,
+        'temperature': 36.0 + (i % 15) / 10,
+        'respiratory_rate': 12 + i % 8,
+        'oxygen_saturation': 94 + i % 6,
+    }
+
+def main():
+    handle, db_path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    os.environ['DATABASE_PATH'] = db_path
+
+    from app import app
+    from models.database import get_db
+
+    try:
+        with app.app_context():
+            db = get_db()
+            db.executemany(
+                "INSERT INTO patients (id, name, date_of_birth, gender) VALUES (?, ?, '1980-01-01', 'Female')",
+                [(i, f'Patient {i:03d}') for i in range(1, PATIENTS + 1)]
+            )
+            db.commit()
+
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+
+        def form_posts(readings):
+            for item in readings:
+                client.post('/vitals/add', data=item)
+
+        def json_batch(readings):
+            response = client.post('/api/vitals/batch', json=readings)
+            assert response.json['inserted'] == len(readings), response.json
+
+        def ndjson_batch(readings):
+            body = '\n'.join(json.dumps(item) for item in readings)
+            response = client.post('/api/vitals/batch', data=body, content_type='application/x-ndjson')
+            assert response.json['inserted'] == len(readings), response.json
+
+        print(f"{'readings':>8} | {'form posts/s':>12} | {'JSON batch/s':>12} | {'NDJSON batch/s':>14}")
+        print('-' * 57)
+        for size in SIZES:
+            readings = [reading(i) for i in range(size)]
+            rates = []
+            for func in (form_posts, json_batch, ndjson_batch):
+                if func is form_posts and size > FORM_POST_LIMIT:
+                    rates.append(None)
+                    continue
+                start = time.perf_counter()
+                func(readings)
+                rates.append(size / (time.perf_counter() - start))
+            print(f"{size:>8} | " + ' | '.join(
+                f"{rate:>{width},.0f}" if rate else f"{'-':>{width}}"
+                for rate, width in zip(rates, (12, 12, 14))
+            ))
+    finally:
+        os.remove(db_path)
+
+if __name__ == '__main__':
+    main()
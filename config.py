@@ -12,17 +12,75 @@ class Config:
     
     # Use absolute path for database
     DATABASE = os.environ.get('DATABASE_PATH') or os.path.join(BASE_DIR, 'clinical_management.db')
+    # Finished patients are moved here by the archive job (attached as "archive")
+    ARCHIVE_DATABASE = os.environ.get('ARCHIVE_DATABASE_PATH') or os.path.splitext(DATABASE)[0] + '_archive.db'
+    ARCHIVE_INTERVAL = 60  # seconds between archive job runs
+    ARCHIVE_BATCH_SIZE = 50  # patients moved per transaction
+    LAB_FILE_GC_INTERVAL = 24 * 3600  # seconds between sweeps for unreferenced lab files
+    
+    # SQLite connection pool - connections are reused and configured once
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+    DB_STATEMENT_CACHE_SIZE = 256  # prepared statements kept per connection
+    DB_PRAGMAS = {
+        'journal_mode': 'WAL',       # readers no longer block on writers
+        'synchronous': 'NORMAL',     # safe with WAL, fsync only at checkpoints
+        'cache_size': -16000,        # 16MB page cache per connection
+        'mmap_size': 268435456,      # 256MB memory-mapped reads
+        'busy_timeout': 5000,        # wait up to 5s instead of "database is locked"
+        'temp_store': 'MEMORY',
+        'foreign_keys': 'ON'         # needed for CASCADE deletes
+    }
     
     # File upload settings - use absolute path
     UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'lab_results')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+    LAB_RESULT_MAX_FILE_SIZE = 10 * 1024 * 1024  # per file, enforced while streaming
+    # Uploads are streamed here, then moved into UPLOAD_FOLDER on commit
+    UPLOAD_TEMP_FOLDER = os.path.join(BASE_DIR, 'uploads_tmp')
+    
+    # Downscaled lab result previews (needs Pillow; PyMuPDF for PDFs)
+    LAB_PREVIEW_FOLDER = os.path.join(BASE_DIR, 'static', 'lab_previews')
+    LAB_PREVIEW_SIZE = 320  # longest edge in pixels
+    LAB_PREVIEW_CACHE_MAX_BYTES = 200 * 1024 * 1024  # least recently used are evicted
+    LAB_PREVIEW_WORKERS = 2
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf'}
+    LAB_CLAIM_TIMEOUT = 30 * 60  # seconds before an unfinished lab claim returns to its queue
+    APPOINTMENT_DAY_START = '08:00'  # clinic hours offered by the booking form
+    APPOINTMENT_DAY_END = '17:00'
+    APPOINTMENT_SLOT_MINUTES = 30
+    APPOINTMENT_SLOT_CAPACITY = 1  # scheduled appointments allowed per slot
+    VITALS_BATCH_MAX_ROWS = 5000  # readings accepted by one /api/vitals/batch request
+    STOCK_CACHE_REFRESH = 2  # seconds between picking up other workers' stock changes
     
     # session config
     PERMANENT_SESSION_LIFETIME = timedelta(hours=8)
     SESSION_COOKIE_SECURE = False  # Set to True in production with HTTPS
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
+    SESSION_CACHE_TTL = 300  # seconds a validated session skips the users lookup
+    PATIENT_TYPEAHEAD_CACHE_SIZE = 512  # recent patient picker prefixes kept per worker
+    
+    # Live queue pages (server-sent events)
+    QUEUE_EVENTS_POLL_INTERVAL = 1  # seconds between checks for queue changes while pages are open
+    QUEUE_EVENTS_BUFFER = 100  # unsent events held per page before it is told to reload
+    QUEUE_EVENTS_MAX_STREAMS = 4  # open streams per worker; each one holds a request thread
+    QUEUE_EVENTS_STREAM_SECONDS = 300  # streams are closed and reopened this often
+    QUEUE_EVENTS_RETENTION = 600  # seconds queue events are kept for reconnecting pages
+    
+    # Audit log: events are spooled here and written in batches by a background thread
+    AUDIT_SPOOL_FOLDER = os.path.join(BASE_DIR, 'audit_spool')
+    AUDIT_BATCH_SIZE = 200  # queued events that trigger a write before the interval
+    AUDIT_FLUSH_INTERVAL = 2  # seconds an event waits at most before it is written
+    AUDIT_MAX_BACKLOG = 10000  # unwritten events kept in memory while the database refuses writes
+    
+    # Request profiling: latency, SQL, template and response size histograms at /admin/metrics
+    PROFILING_ENABLED = os.environ.get('PROFILING') == '1'  # off costs nothing; on times every statement
+    SLOW_QUERY_MS = 100  # statements slower than this are printed with their query plan
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # lets a Prometheus scraper in without a session
+    
+    # Compiled templates are kept here so new workers skip the Jinja compile; None disables
+    TEMPLATE_BYTECODE_CACHE = os.path.join(BASE_DIR, 'cache', 'jinja')
+    FRAGMENT_CACHE_MAX_BYTES = 8 * 1024 * 1024  # rendered row fragments kept per worker
     
     # Pagination
     ITEMS_PER_PAGE = 20
@@ -43,6 +101,8 @@ class TestingConfig(Config):
     DEBUG = True
     TESTING = True
     DATABASE = ':memory:'  # in-memory db for tests
+    ARCHIVE_DATABASE = ':memory:'
+    DB_POOL_SIZE = 1  # every :memory: connection is a separate database
 
 # Configuration dictionary
 config = {
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Exam Tests Migration Script
+Moves the per-test flag columns of the exams table into the lab_tests
+catalog and the exam_tests table, then drops the old columns.
+
+The app also does this on startup; run it beforehand on large databases
+(after a backup) to keep the conversion out of the first app start.
+"""
+
+import os
+import sqlite3
+import time
+
+from models.lab_tests import init_lab_tests, legacy_test_columns, migrate_exam_test_flags
+
+def migrate_exam_tests():
+    db_path = os.environ.get('DATABASE_PATH') or 'clinical_management.db'
+
+    if not os.path.exists(db_path):
+        print(f"Database {db_path} not found!")
+        return False
+
+    conn = sqlite3.connect(db_path)
+
+    try:
+        print("Starting exam tests migration...")
+        conn.execute('PRAGMA foreign_keys = ON')
+
+        columns = legacy_test_columns(conn)
+        if not columns:
+            print("✓ Exams are already migrated")
+            return True
+
+        started = time.perf_counter()
+        init_lab_tests(conn)
+        exams = conn.execute('SELECT COUNT(*) FROM exams').fetchone()[0]
+        print(f"Converting {len(columns)} test columns on {exams:,} exams...")
+
+        created = migrate_exam_test_flags(conn)
+        conn.commit()
+
+        print(f"✓ Created {created:,} exam test rows in {time.perf_counter() - started:.1f}s")
+        remaining = legacy_test_columns(conn)
+        if remaining:
+            print(f"  Old columns kept: {', '.join(remaining)}")
+        else:
+            print("✓ Old test columns dropped from exams")
+        return True
+
+    except Exception as e:
+        conn.rollback()
+        print(f"✗ Migration failed: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    migrate_exam_tests()
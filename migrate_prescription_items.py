@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Prescription Items Migration Script
+Moves the JSON medicines column of the prescriptions table into the
+prescription_items table, then drops the old column.
+
+The app also does this on startup; run it beforehand on large databases
+(after a backup) to keep the conversion out of the first app start.
+"""
+
+import os
+import sqlite3
+import time
+
+from models.prescriptions import init_prescription_items, has_medicines_column, migrate_prescription_medicines
+
+def migrate_prescription_items():
+    db_path = os.environ.get('DATABASE_PATH') or 'clinical_management.db'
+
+    if not os.path.exists(db_path):
+        print(f"Database {db_path} not found!")
+        return False
+
+    conn = sqlite3.connect(db_path)
+
+    try:
+        print("Starting prescription items migration...")
+        conn.execute('PRAGMA foreign_keys = ON')
+
+        if not has_medicines_column(conn):
+            print("✓ Prescriptions are already migrated")
+            return True
+
+        started = time.perf_counter()
+        init_prescription_items(conn)
+        prescriptions = conn.execute('SELECT COUNT(*) FROM prescriptions').fetchone()[0]
+        print(f"Converting medicines of {prescriptions:,} prescriptions...")
+
+        created, invalid = migrate_prescription_medicines(conn)
+        conn.commit()
+
+        print(f"✓ Created {created:,} prescription items in {time.perf_counter() - started:.1f}s")
+        if invalid:
+            print(f"  {invalid:,} prescriptions have malformed medicines JSON and were not converted")
+        if has_medicines_column(conn):
+            print("  Old medicines column kept")
+        else:
+            print("✓ Old medicines column dropped from prescriptions")
+        return True
+
+    except Exception as e:
+        conn.rollback()
+        print(f"✗ Migration failed: {str(e)}")
+        return False
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    migrate_prescription_items()
@@ -0,0 +1,112 @@
+from datetime import date, datetime, timedelta
+
+CALENDAR_VIEWS = ('day', 'week', 'month')
+
+def init_appointments(db):
+    # Calendar ranges and slot lookups are ranges of this index; status is
+    # included so counting booked slots never reads the table
+    db.execute('CREATE INDEX IF NOT EXISTS idx_appointments_date_time ON appointments(date, time, status)')
+
+def calendar_range(view, anchor):
+    """[start, end) dates of the day, week (Monday first) or month holding anchor."""
+    if view == 'day':
+        return anchor, anchor + timedelta(days=1)
+    if view == 'week':
+        start = anchor - timedelta(days=anchor.weekday())
+        return start, start + timedelta(days=7)
+    if view == 'month':
+        start = anchor.replace(day=1)
+        return start, (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    raise ValueError(f'Unknown calendar view: {view}')
+
+def shift_anchor(view, anchor, steps):
+    """The anchor date steps views before (negative) or after anchor."""
+    if view == 'day':
+        return anchor + timedelta(days=steps)
+    if view == 'week':
+        return anchor + timedelta(weeks=steps)
+    month = anchor.month - 1 + steps
+    return date(anchor.year + month // 12, month % 12 + 1, 1)
+
+def get_calendar(db, start, end, status=None):
+    where = ['a.date >= ?', 'a.date < ?']
+    params = [start.isoformat(), end.isoformat()]
+    if status:
+        where.append('a.status = ?')
+        params.append(status)
+    return db.execute(f'''
+        SELECT a.id, a.patient_id, a.date, a.time, a.reason, a.status, a.notes, p.name AS patient_name
+        FROM appointments a
+        JOIN patients p ON p.id = a.patient_id
+        WHERE {' AND '.join(where)}
+        ORDER BY a.date, a.time
+    ''', params).fetchall()
+
+def parse_time(value):
+    """'HH:MM' (seconds allowed) -> minutes after midnight. Raises ValueError."""
+    for fmt in ('%H:%M', '%H:%M:%S'):
+        try:
+            parsed = datetime.strptime(value, fmt)
+            return parsed.hour * 60 + parsed.minute
+        except (TypeError, ValueError):
+            pass
+    raise ValueError(f'Invalid time: {value}')
+
+def format_time(minutes):
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+def slot_bounds(time_value, slot_minutes):
+    """'HH:MM' strings bounding the slot time_value falls in."""
+    start = parse_time(time_value) // slot_minutes * slot_minutes
+    return format_time(start), format_time(start + slot_minutes)
+
+def slot_bookings(db, day, time_value, slot_minutes):
+    """Scheduled appointments in the slot holding time_value on day."""
+    slot_start, slot_end = slot_bounds(time_value, slot_minutes)
+    return db.execute('''
+        SELECT COUNT(*) FROM appointments
+        WHERE date = ? AND time >= ? AND time < ? AND status = 'scheduled'
+    ''', (day.isoformat(), slot_start, slot_end)).fetchone()[0]
+
+def book_appointment(db, patient_id, day, time_value, reason, slot_minutes, capacity):
+    """Insert an appointment unless its slot is full.
+
+    The check and the insert run under BEGIN IMMEDIATE, so two desks can't
+    both take the last place in a slot. Returns the new id, or None when
+    the slot is full.
+    """
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        if slot_bookings(db, day, time_value, slot_minutes) >= capacity:
+            db.rollback()
+            return None
+        cursor = db.execute(
+            '''INSERT INTO appointments (patient_id, date, time, reason, status)
+               VALUES (?, ?, ?, ?, 'scheduled')''',
+            (patient_id, day.isoformat(), time_value, reason)
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return cursor.lastrowid
+
+def slot_availability(db, day, day_start, day_end, slot_minutes, capacity):
+    """Every slot of the clinic day with its scheduled count and free places."""
+    first, last = parse_time(day_start), parse_time(day_end)
+    booked = {}
+    for row in db.execute('''
+        SELECT time FROM appointments
+        WHERE date = ? AND time >= ? AND time < ? AND status = 'scheduled'
+    ''', (day.isoformat(), format_time(first), format_time(last))):
+        try:
+            slot = parse_time(row[0]) // slot_minutes * slot_minutes
+        except ValueError:
+            continue
+        booked[slot] = booked.get(slot, 0) + 1
+
+    slots = []
+    for start in range(first // slot_minutes * slot_minutes, last, slot_minutes):
+        count = booked.get(start, 0)
+        slots.append({'time': format_time(start), 'booked': count, 'available': max(capacity - count, 0)})
+    return slots
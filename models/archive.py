@@ -0,0 +1,282 @@
+import json
+import os
+import re
+import threading
+import time
+
+# What goes into an archived patient's record, and how each table's rows
+# are found from the patient row p
+ARCHIVE_SECTIONS = {
+    'consultations': ('consultations', 't.patient_id = p.id'),
+    'vitals': ('vitals', 't.patient_id = p.id'),
+    'appointments': ('appointments', 't.patient_id = p.id'),
+    'exams': ('exams', 't.patient_id = p.id'),
+    'exam_tests': ('exam_tests', 't.exam_id IN (SELECT id FROM exams WHERE patient_id = p.id)'),
+    'laboratory': ('laboratory', 't.patient_id = p.id'),
+    'diagnoses': ('diagnoses', 't.patient_id = p.id'),
+    'prescriptions': ('prescriptions', 't.patient_id = p.id'),
+    'prescription_items': ('prescription_items', 't.prescription_id IN (SELECT id FROM prescriptions WHERE patient_id = p.id)'),
+}
+
+# Names submit_lab_results gives uploads: {patient_id}_{test_key}_{YYYYmmdd_HHMMSS}.{ext}
+LAB_UPLOAD_NAME = re.compile(r'\d+_\w+_\d{8}_\d{6}\.[A-Za-z0-9]+')
+
+def init_archive(db):
+    # Patients whose care is finished, waiting for the archive job
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS archive_queue (
+            patient_id INTEGER PRIMARY KEY,
+            queued_by TEXT,
+            queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id) ON DELETE CASCADE
+        )
+    ''')
+    # The archive lives in its own database file, attached as "archive".
+    # One row per patient: the searchable demographics plus the whole
+    # history as a JSON document (query it with json_extract / json_each).
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS archive.archived_patients (
+            patient_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            date_of_birth DATE,
+            gender TEXT,
+            contact TEXT,
+            completed_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            record TEXT NOT NULL
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS archive.idx_archived_patients_name ON archived_patients(name COLLATE NOCASE)')
+    db.execute('CREATE INDEX IF NOT EXISTS archive.idx_archived_patients_archived ON archived_patients(archived_at)')
+    # Prescription items of archived patients, kept as rows with the same
+    # covering index as prescription_items so medicine_usage can report
+    # them together with the hot table
+    exists = db.execute(
+        "SELECT 1 FROM archive.sqlite_master WHERE type = 'table' AND name = 'archived_prescription_items'"
+    ).fetchone()
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS archive.archived_prescription_items (
+            id INTEGER PRIMARY KEY,
+            prescription_id INTEGER NOT NULL,
+            patient_id INTEGER NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0,
+            medicine TEXT NOT NULL,
+            amount TEXT NOT NULL,
+            times_per_day INTEGER NOT NULL,
+            duration_days INTEGER NOT NULL,
+            prescribed_at TIMESTAMP
+        )
+    ''')
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS archive.idx_archived_prescription_items_medicine ON archived_prescription_items(
+            medicine COLLATE NOCASE, prescribed_at, prescription_id, times_per_day, duration_days
+        )
+    ''')
+    if not exists:
+        # Patients archived before the table existed only have their JSON record
+        db.execute('''
+            INSERT OR IGNORE INTO archive.archived_prescription_items (
+                id, prescription_id, patient_id, position, medicine, amount, times_per_day, duration_days, prescribed_at
+            )
+            SELECT json_extract(item.value, '$.id'), json_extract(item.value, '$.prescription_id'), ap.patient_id,
+                   json_extract(item.value, '$.position'), json_extract(item.value, '$.medicine'),
+                   json_extract(item.value, '$.amount'), json_extract(item.value, '$.times_per_day'),
+                   json_extract(item.value, '$.duration_days'), json_extract(item.value, '$.prescribed_at')
+            FROM archive.archived_patients ap, json_each(ap.record, '$.prescription_items') item
+        ''')
+    # Lab result files the archive still points at; they are kept on disk
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS archive.archived_files (
+            path TEXT PRIMARY KEY,
+            patient_id INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+def queue_patient_archive(db, patient_id, username):
+    """Hand a finished patient to the archive job. The caller commits."""
+    db.execute(
+        'INSERT OR IGNORE INTO archive_queue (patient_id, queued_by) VALUES (?, ?)',
+        (patient_id, username)
+    )
+
+def table_columns(db, table):
+    return [row[1] for row in db.execute(f'PRAGMA main.table_info({table})')]
+
+def json_rows_sql(db, table, where):
+    columns = ', '.join(f"'{column}', t.{column}" for column in table_columns(db, table))
+    return f'(SELECT json_group_array(json_object({columns})) FROM {table} t WHERE {where})'
+
+def archive_record_sql(db):
+    patient = ', '.join(f"'{column}', p.{column}" for column in table_columns(db, 'patients'))
+    sections = ', '.join(
+        f"'{name}', json({json_rows_sql(db, table, where)})"
+        for name, (table, where) in ARCHIVE_SECTIONS.items()
+    )
+    return f"json_object('patient', json_object({patient}), {sections})"
+
+def archive_patients(db, batch_size=50):
+    """Move one batch of queued patients into the archive database.
+
+    Each patient's rows are copied into a single archived_patients record
+    and committed first; only then are the patients that have a record
+    deleted, which cascades through the hot tables. SQLite in WAL mode
+    commits each attached file on its own, so one transaction writing
+    both could lose the record yet keep the delete after a crash. Both
+    steps are idempotent, and a crash in between just archives the batch
+    again. Each runs under BEGIN IMMEDIATE so concurrent archive jobs
+    never take the same batch. Returns the number of patients archived.
+    """
+    record = archive_record_sql(db)
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        patient_ids = [row[0] for row in db.execute(
+            'SELECT patient_id FROM archive_queue ORDER BY queued_at, patient_id LIMIT ?', (batch_size,)
+        )]
+        if patient_ids:
+            placeholders = ', '.join('?' * len(patient_ids))
+            db.execute(f'''
+                INSERT OR REPLACE INTO archive.archived_patients (
+                    patient_id, name, date_of_birth, gender, contact, completed_at, archived_at, record
+                )
+                SELECT p.id, p.name, p.date_of_birth, p.gender, p.contact, q.queued_at, datetime('now'), {record}
+                FROM patients p
+                JOIN archive_queue q ON q.patient_id = p.id
+                WHERE p.id IN ({placeholders})
+            ''', patient_ids)
+            db.execute(f'''
+                INSERT OR IGNORE INTO archive.archived_files (path, patient_id)
+                SELECT test_result_image, patient_id FROM laboratory
+                WHERE patient_id IN ({placeholders}) AND test_result_image IS NOT NULL
+            ''', patient_ids)
+            db.execute(f'''
+                INSERT OR REPLACE INTO archive.archived_prescription_items (
+                    id, prescription_id, patient_id, position, medicine, amount,
+                    times_per_day, duration_days, prescribed_at
+                )
+                SELECT i.id, i.prescription_id, pr.patient_id, i.position, i.medicine, i.amount,
+                       i.times_per_day, i.duration_days, i.prescribed_at
+                FROM prescription_items i
+                JOIN prescriptions pr ON pr.id = i.prescription_id
+                WHERE pr.patient_id IN ({placeholders})
+            ''', patient_ids)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if not patient_ids:
+        return 0
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute(f'''
+            DELETE FROM patients
+            WHERE id IN ({placeholders})
+              AND id IN (SELECT patient_id FROM archive.archived_patients WHERE patient_id IN ({placeholders}))
+        ''', patient_ids + patient_ids)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(patient_ids)
+
+def get_archived_patient(db, patient_id):
+    """The archived record of a patient as a dict, or None."""
+    row = db.execute(
+        '''SELECT record, CAST(completed_at AS TEXT) AS completed_at, CAST(archived_at AS TEXT) AS archived_at
+           FROM archive.archived_patients WHERE patient_id = ?''',
+        (patient_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    record = json.loads(row['record'])
+    record['completed_at'] = row['completed_at']
+    record['archived_at'] = row['archived_at']
+    return record
+
+def search_archived_patients(db, name, limit=20):
+    return db.execute('''
+        SELECT patient_id, name, CAST(date_of_birth AS TEXT) AS date_of_birth, gender, contact,
+               CAST(completed_at AS TEXT) AS completed_at, CAST(archived_at AS TEXT) AS archived_at
+        FROM archive.archived_patients
+        WHERE name LIKE ? ESCAPE '\\'
+        ORDER BY name COLLATE NOCASE, patient_id
+        LIMIT ?
+    ''', (name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%', limit)).fetchall()
+
+def collect_lab_files(db, upload_folder, grace_seconds=3600, dry_run=False):
+    """Delete lab result files that no laboratory row or archived record uses.
+
+    Only files named like a lab upload are considered, and those younger
+    than grace_seconds are left alone, since an upload is moved into
+    place just after its row commits. Returns the deleted file names.
+    """
+    if not os.path.isdir(upload_folder):
+        return []
+    referenced = set()
+    for query in ('SELECT test_result_image FROM laboratory WHERE test_result_image IS NOT NULL',
+                  'SELECT path FROM archive.archived_files'):
+        referenced.update(row[0].rsplit('/', 1)[-1] for row in db.execute(query))
+
+    cutoff = time.time() - grace_seconds
+    deleted = []
+    for entry in os.scandir(upload_folder):
+        if not entry.is_file() or not LAB_UPLOAD_NAME.fullmatch(entry.name):
+            continue
+        if entry.name in referenced or entry.stat().st_mtime > cutoff:
+            continue
+        if not dry_run:
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                print(f'Warning: Could not remove {entry.path}: {e}')
+                continue
+        deleted.append(entry.name)
+    return deleted
+
+class ArchiveWorker:
+    """Background thread that drains the archive queue in small batches.
+
+    Started when each worker process starts. It runs every interval
+    seconds, archives batch_size patients per transaction with a short
+    pause between batches so request writes are never held up for long,
+    and collects orphaned lab files every gc_interval seconds.
+    """
+
+    def __init__(self, app, interval=60, batch_size=50, batch_pause=0.2, gc_interval=24 * 3600,
+                 on_files_removed=None):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.gc_interval = gc_interval
+        self.on_files_removed = on_files_removed
+        self._thread = None
+        self._pid = None
+        self._last_gc = time.monotonic()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Make sure this process's archive thread is running."""
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='cms-archive', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        from models.database import get_db
+        while True:
+            # Patients completed meanwhile are archived together
+            time.sleep(self.interval)
+            try:
+                with self.app.app_context():
+                    db = get_db()
+                    while archive_patients(db, self.batch_size) == self.batch_size:
+                        time.sleep(self.batch_pause)
+                    if time.monotonic() - self._last_gc >= self.gc_interval:
+                        self._last_gc = time.monotonic()
+                        removed = collect_lab_files(db, self.app.config['UPLOAD_FOLDER'])
+                        if removed and self.on_files_removed:
+                            self.on_files_removed(removed)
+            except Exception as e:
+                print(f'Warning: Archive job failed: {e}')
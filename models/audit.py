@@ -0,0 +1,279 @@
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+AUDIT_COLUMNS = ('event_key', 'occurred_at', 'username', 'action', 'patient_id', 'entity', 'entity_id', 'details')
+
+def init_audit_log(db):
+    # Who did what, written in batches by AuditLog. Not tied to patients by
+    # a foreign key, so entries outlive archiving. event_key makes replaying
+    # a spool file after a crash idempotent.
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS audit_log (
+            id INTEGER PRIMARY KEY,
+            event_key TEXT NOT NULL UNIQUE,
+            occurred_at TIMESTAMP NOT NULL,
+            username TEXT,
+            action TEXT NOT NULL,
+            patient_id INTEGER,
+            entity TEXT,
+            entity_id INTEGER,
+            details TEXT
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_audit_log_patient ON audit_log(patient_id, occurred_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_audit_log_occurred ON audit_log(occurred_at)')
+    for event in ('UPDATE', 'DELETE'):
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS audit_log_no_{event.lower()} BEFORE {event} ON audit_log BEGIN
+                SELECT RAISE(ABORT, 'audit_log is append-only');
+            END
+        ''')
+
+def write_audit_events(db, events):
+    """Insert events (dicts as made by AuditLog.record), skipping ones
+    already written. The caller commits."""
+    db.executemany(f'''
+        INSERT OR IGNORE INTO audit_log ({', '.join(AUDIT_COLUMNS)})
+        VALUES ({', '.join('?' * len(AUDIT_COLUMNS))})
+    ''', [
+        (event['key'], event['at'], event.get('username'), event['action'], event.get('patient_id'),
+         event.get('entity'), event.get('entity_id'),
+         json.dumps(event['details']) if event.get('details') else None)
+        for event in events
+    ])
+
+def get_audit_events(db, patient_id=None, username=None, action=None, since=None, until=None,
+                     cursor=None, limit=100):
+    """Audit entries, newest first, matching the given filters.
+
+    Uses the patient index when patient_id is given, the time index
+    otherwise. cursor is the (occurred_at, id) of the last entry of the
+    previous page. Returns (entries, cursor of the next page or None).
+    """
+    where, params = [], []
+    for column, value in (('patient_id', patient_id), ('username', username), ('action', action)):
+        if value is not None:
+            where.append(f'{column} = ?')
+            params.append(value)
+    if since:
+        where.append('occurred_at >= ?')
+        params.append(since)
+    if until:
+        where.append('occurred_at < ?')
+        params.append(until)
+    if cursor:
+        where.append('(occurred_at, id) < (?, ?)')
+        params.extend(cursor)
+    rows = db.execute(f'''
+        SELECT id, CAST(occurred_at AS TEXT) AS occurred_at, username, action,
+               patient_id, entity, entity_id, details
+        FROM audit_log
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY occurred_at DESC, id DESC
+        LIMIT ?
+    ''', params + [limit + 1]).fetchall()
+    entries = [dict(row, details=json.loads(row['details']) if row['details'] else None) for row in rows[:limit]]
+    next_cursor = (entries[-1]['occurred_at'], entries[-1]['id']) if len(rows) > limit else None
+    return entries, next_cursor
+
+class AuditLog:
+    """Append-only audit log with batched, asynchronous writes.
+
+    record() appends the event to this process's spool file and queues it
+    in memory; nothing touches the database in the request. A background
+    thread writes the queue in one executemany transaction once
+    batch_size events are waiting or flush_interval seconds have passed,
+    then deletes the spool segment it came from. Segments left behind by
+    a crashed or stopped process are replayed once they are stale_after
+    seconds old. While writes keep failing at most max_backlog events are
+    held in memory; older ones are left to the replay of their segments.
+    """
+
+    def __init__(self, app, spool_folder, batch_size=200, flush_interval=2.0, stale_after=60,
+                 max_backlog=10000):
+        self.app = app
+        self.spool_folder = spool_folder
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stale_after = stale_after
+        self.max_backlog = max_backlog
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        self._reset()
+        # Once for the object; close() is a no-op in a process with nothing queued
+        atexit.register(self.close)
+
+    def _reset(self):
+        # Also run in a forked child, whose parent writes what it inherited
+        self._pid = os.getpid()
+        self._token = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._file = None
+        self._segment = None
+        self._pending = []
+        self._batches = []  # (segment, events) taken off the queue but not yet written
+        self._handed_off = set()  # own segments dropped from _batches, for replay_spool
+        self._thread = None
+        self._replayed_at = None
+
+    def record(self, action, username=None, patient_id=None, entity=None, entity_id=None, details=None):
+        """Queue an audit event; it is written within flush_interval seconds."""
+        event = {
+            'key': uuid.uuid4().hex,
+            'at': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+            'username': username,
+            'action': action,
+            'patient_id': patient_id,
+            'entity': entity,
+            'entity_id': entity_id,
+            'details': details,
+        }
+        line = json.dumps(event, separators=(',', ':'), default=str) + '\n'
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            try:
+                if self._file is None:
+                    os.makedirs(self.spool_folder, exist_ok=True)
+                    self._seq += 1
+                    self._segment = os.path.join(
+                        self.spool_folder, f'audit-{self._pid}-{self._token}-{self._seq:06d}.jsonl'
+                    )
+                    self._file = open(self._segment, 'a', encoding='utf-8')
+                self._file.write(line)
+                self._file.flush()
+            except OSError as e:
+                print(f'Warning: Could not spool audit event: {e}')
+            self._pending.append(event)
+            full = len(self._pending) >= self.batch_size
+            self._start()
+        if full:
+            self._wake.set()
+
+    def flush(self, db):
+        """Write every queued event now. Returns the number written.
+
+        A failed write keeps the events (and their spool segment) for the
+        next flush and re-raises.
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+                if self._pending:
+                    if self._file is not None:
+                        self._file.close()
+                    self._batches.append((self._segment if self._file is not None else None, self._pending))
+                    self._file = self._segment = None
+                    self._pending = []
+                self._trim_backlog()
+            written = 0
+            while self._batches:
+                segment, events = self._batches[0]
+                try:
+                    write_audit_events(db, events)
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                    raise
+                self._batches.pop(0)
+                written += len(events)
+                if segment:
+                    remove_quietly(segment)
+            return written
+
+    def _trim_backlog(self):
+        # Keep the newest batch; the older ones are on disk in their
+        # segments, which replay_spool writes once they are stale
+        backlog = sum(len(events) for _, events in self._batches)
+        while backlog > self.max_backlog and len(self._batches) > 1:
+            segment, events = self._batches.pop(0)
+            backlog -= len(events)
+            if segment:
+                self._handed_off.add(segment)
+            else:
+                print(f'Warning: Dropped {len(events)} audit events that could not be spooled')
+
+    def replay_spool(self, db):
+        """Write events from stale spool segments of other (or earlier)
+        processes, and this process's segments dropped from the backlog.
+        Returns the number of events read."""
+        try:
+            names = sorted(os.listdir(self.spool_folder))
+        except FileNotFoundError:
+            return 0
+        replayed = 0
+        for name in names:
+            path = os.path.join(self.spool_folder, name)
+            if not (name.startswith('audit-') and name.endswith('.jsonl')):
+                continue
+            if f'-{self._token}-' in name and path not in self._handed_off:
+                continue
+            try:
+                if time.time() - os.path.getmtime(path) < self.stale_after:
+                    continue
+                with open(path, encoding='utf-8') as spool:
+                    lines = spool.readlines()
+            except OSError:
+                continue  # already replayed elsewhere
+            events = []
+            for line in lines:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    # The last line of a process that died mid-write
+                    print(f'Warning: Skipping unreadable audit spool line in {name}')
+            try:
+                write_audit_events(db, events)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            remove_quietly(path)
+            self._handed_off.discard(path)
+            replayed += len(events)
+        return replayed
+
+    def close(self):
+        """Write what is still queued, e.g. when the process exits."""
+        if self._pid != os.getpid() or not (self._pending or self._batches):
+            return
+        from models.database import get_db
+        try:
+            with self.app.app_context():
+                self.flush(get_db())
+        except Exception as e:
+            print(f'Warning: Audit events left in the spool for replay: {e}')
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='cms-audit', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        from models.database import get_db
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    db = get_db()
+                    if self._replayed_at is None or time.monotonic() - self._replayed_at >= self.stale_after:
+                        self._replayed_at = time.monotonic()
+                        self.replay_spool(db)
+                    self.flush(db)
+            except Exception as e:
+                print(f'Warning: Audit log flush failed: {e}')
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,95 @@
+from datetime import datetime
+
+def init_dashboard_stats(db):
+    # Single-row summary of the dashboard counters, kept current by triggers
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS dashboard_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            stats_date TEXT NOT NULL,
+            total_patients INTEGER NOT NULL DEFAULT 0,
+            today_appointments INTEGER NOT NULL DEFAULT 0,
+            today_vitals INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_vitals_recorded_at ON vitals(recorded_at)')
+
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS dashboard_stats_patient_insert AFTER INSERT ON patients BEGIN
+            UPDATE dashboard_stats SET total_patients = total_patients + 1 WHERE id = 1;
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS dashboard_stats_patient_delete AFTER DELETE ON patients BEGIN
+            UPDATE dashboard_stats SET total_patients = total_patients - 1 WHERE id = 1;
+        END
+    ''')
+
+    # Appointment and vitals counters only track the row's stats_date;
+    # rows for other days are picked up by the daily rollover
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS dashboard_stats_appointment_insert AFTER INSERT ON appointments BEGIN
+            UPDATE dashboard_stats SET today_appointments = today_appointments + 1
+            WHERE id = 1 AND stats_date = NEW.date;
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS dashboard_stats_appointment_delete AFTER DELETE ON appointments BEGIN
+            UPDATE dashboard_stats SET today_appointments = today_appointments - 1
+            WHERE id = 1 AND stats_date = OLD.date;
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS dashboard_stats_appointment_update AFTER UPDATE OF date ON appointments BEGIN
+            UPDATE dashboard_stats SET today_appointments = today_appointments - 1
+            WHERE id = 1 AND stats_date = OLD.date;
+            UPDATE dashboard_stats SET today_appointments = today_appointments + 1
+            WHERE id = 1 AND stats_date = NEW.date;
+        END
+    ''')
+    # recorded_at is stored in UTC, stats_date is the clinic's local date
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS dashboard_stats_vitals_insert AFTER INSERT ON vitals BEGIN
+            UPDATE dashboard_stats SET today_vitals = today_vitals + 1
+            WHERE id = 1 AND stats_date = date(NEW.recorded_at, 'localtime');
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS dashboard_stats_vitals_delete AFTER DELETE ON vitals BEGIN
+            UPDATE dashboard_stats SET today_vitals = today_vitals - 1
+            WHERE id = 1 AND stats_date = date(OLD.recorded_at, 'localtime');
+        END
+    ''')
+
+    exists = db.execute('SELECT 1 FROM dashboard_stats WHERE id = 1').fetchone()
+    if not exists:
+        db.execute("INSERT INTO dashboard_stats (id, stats_date) VALUES (1, '')")
+        rollover_dashboard_stats(db, datetime.now().strftime('%Y-%m-%d'))
+
+def rollover_dashboard_stats(db, today):
+    """Recount the per-day counters for a new day. No-op if already current.
+
+    Uses the date indexes, so this is a couple of range counts once a day.
+    total_patients is recounted too so any drift heals daily.
+    """
+    cursor = db.execute('''
+        UPDATE dashboard_stats SET
+            stats_date = :today,
+            total_patients = (SELECT COUNT(*) FROM patients),
+            today_appointments = (SELECT COUNT(*) FROM appointments WHERE date = :today),
+            today_vitals = (
+                SELECT COUNT(*) FROM vitals
+                WHERE recorded_at >= datetime(:today, 'utc')
+                  AND recorded_at < datetime(:today, '+1 day', 'utc')
+            )
+        WHERE id = 1 AND stats_date != :today
+    ''', {'today': today})
+    return cursor.rowcount > 0
+
+def get_dashboard_stats(db):
+    today = datetime.now().strftime('%Y-%m-%d')
+    stats = db.execute('SELECT * FROM dashboard_stats WHERE id = 1').fetchone()
+    if stats['stats_date'] != today:
+        rollover_dashboard_stats(db, today)
+        db.commit()
+        stats = db.execute('SELECT * FROM dashboard_stats WHERE id = 1').fetchone()
+    return stats
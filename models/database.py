@@ -1,22 +1,128 @@
+import os
+import queue
 import sqlite3
+import threading
 from flask import g, current_app
 from werkzeug.security import generate_password_hash
+from models.dashboard import init_dashboard_stats
+from models.history import init_patient_history
+from models.lab_tests import init_lab_tests, legacy_test_columns, migrate_exam_test_flags
+from models.appointments import init_appointments
+from models.archive import init_archive
+from models.consultations import init_consultation_stamps
+from models.vitals import init_vitals
+from models.events import init_queue_events
+from models.workflow import init_patient_flow
+from models.audit import init_audit_log
+from models.profiling import ProfiledConnection
+from models.inventory import init_inventory
+from models.patients import init_patient_typeahead
+from models.prescriptions import init_prescription_items, has_medicines_column, migrate_prescription_medicines
+
+class ConnectionPool:
+    """Per-process pool of pre-configured SQLite connections.
+
+    Connections are opened lazily, configured once with the pragmas from
+    config.py and reused across requests instead of reconnecting each time.
+    attachments maps schema names to database files attached to every
+    connection (e.g. the patient archive).
+    """
+
+    def __init__(self, database, size=8, pragmas=None, statement_cache_size=128, attachments=None,
+                 factory=sqlite3.Connection):
+        self.database = database
+        self.factory = factory
+        self.size = size
+        self.pragmas = pragmas or {}
+        self.attachments = attachments or {}
+        self.statement_cache_size = statement_cache_size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue(maxsize=self.size)
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=self.statement_cache_size,
+            factory=self.factory,
+            check_same_thread=False  # connections move between request threads
+        )
+        conn.row_factory = sqlite3.Row
+        # Attached first so pragmas like journal_mode apply to them too
+        for name, path in self.attachments.items():
+            conn.execute('ATTACH DATABASE ? AS ' + name, (path,))
+        for name, value in self.pragmas.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def acquire(self):
+        # A forked worker must never reuse its parent's connections
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            return
+        try:
+            # Never hand out a connection with a half-finished transaction
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+        except sqlite3.Error:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+# Serialises creating the pool, so the first requests of a worker's
+# threads can't each build one (and leak the connections of the losers)
+_pool_lock = threading.Lock()
+
+def get_pool(app=None):
+    app = app or current_app
+    pool = app.extensions.get('db_pool')
+    if pool is not None:
+        return pool
+    with _pool_lock:
+        pool = app.extensions.get('db_pool')
+        if pool is None:
+            pool = ConnectionPool(
+                app.config['DATABASE'],
+                size=app.config.get('DB_POOL_SIZE', 8),
+                pragmas=app.config.get('DB_PRAGMAS', {'foreign_keys': 'ON'}),
+                statement_cache_size=app.config.get('DB_STATEMENT_CACHE_SIZE', 128),
+                attachments={'archive': app.config.get('ARCHIVE_DATABASE', ':memory:')},
+                # Timed connections only while profiling, so it costs nothing otherwise
+                factory=ProfiledConnection if app.config.get('PROFILING_ENABLED') else sqlite3.Connection
+            )
+            app.extensions['db_pool'] = pool
+        return pool
 
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
-        # Enable foreign key constraints for CASCADE deletes
-        g.db.execute('PRAGMA foreign_keys = ON')
+        g.db = get_pool().acquire()
     return g.db
 
 def close_db(e=None):
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        get_pool().release(db)
 
 def init_db():
     db = get_db()
@@ -29,10 +135,16 @@ def init_db():
             password TEXT NOT NULL,
             full_name TEXT NOT NULL,
             role TEXT NOT NULL DEFAULT 'nurse',
+            session_version INTEGER NOT NULL DEFAULT 0,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
     
+    # Older databases predate session versioning
+    user_columns = [col[1] for col in db.execute('PRAGMA table_info(users)').fetchall()]
+    if 'session_version' not in user_columns:
+        db.execute('ALTER TABLE users ADD COLUMN session_version INTEGER NOT NULL DEFAULT 0')
+    
     # Create patients table
     db.execute('''
         CREATE TABLE IF NOT EXISTS patients (
@@ -104,18 +216,6 @@ def init_db():
             patient_id INTEGER NOT NULL,
             presenting_complaint TEXT,
             history_of_complaint TEXT,
-            random_blood_sugar INTEGER DEFAULT 0,
-            fasting_blood_sugar INTEGER DEFAULT 0,
-            liver_function INTEGER DEFAULT 0,
-            full_blood_count INTEGER DEFAULT 0,
-            lipid_profile INTEGER DEFAULT 0,
-            kidney_function INTEGER DEFAULT 0,
-            thyroid_function INTEGER DEFAULT 0,
-            urinalysis INTEGER DEFAULT 0,
-            stool_examination INTEGER DEFAULT 0,
-            chest_xray INTEGER DEFAULT 0,
-            ecg INTEGER DEFAULT 0,
-            ultrasound INTEGER DEFAULT 0,
             recommend_diagnosis INTEGER DEFAULT 0,
             clinical_details TEXT,
             status TEXT DEFAULT 'pending',
@@ -167,7 +267,6 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             consultation_id INTEGER NOT NULL,
             patient_id INTEGER NOT NULL,
-            medicines TEXT NOT NULL,
             prescription_comment TEXT,
             management_plan TEXT,
             prescribed_by TEXT NOT NULL,
@@ -194,7 +293,36 @@ def init_db():
     db.execute('CREATE INDEX IF NOT EXISTS idx_prescriptions_patient_id ON prescriptions(patient_id)')
     db.execute('CREATE INDEX IF NOT EXISTS idx_prescriptions_consultation_id ON prescriptions(consultation_id)')
     db.execute('CREATE INDEX IF NOT EXISTS idx_prescriptions_pharmacy_status ON prescriptions(pharmacy_status)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_patients_name ON patients(name)')
+    # Composite indexes for the consultation queue query
+    db.execute('CREATE INDEX IF NOT EXISTS idx_consultations_status_created ON consultations(status, created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_exams_consultation_created ON exams(consultation_id, created_at)')
+
+    init_patient_search(db)
+    init_dashboard_stats(db)
+    init_patient_history(db)
+    init_lab_tests(db)
     
+    # Databases from before exam_tests still carry one flag column per test
+    if legacy_test_columns(db):
+        print("Converting exam test flags to exam_tests (see migrate_exam_tests.py)...")
+        migrate_exam_test_flags(db)
+
+    init_prescription_items(db)
+    # Prescriptions used to keep their medicines as a JSON text column
+    if has_medicines_column(db):
+        print("Converting prescription medicines to prescription_items (see migrate_prescription_items.py)...")
+        migrate_prescription_medicines(db)
+    init_inventory(db)
+    init_archive(db)
+    init_patient_typeahead(db)
+    init_appointments(db)
+    init_consultation_stamps(db)
+    init_vitals(db)
+    init_queue_events(db)
+    init_patient_flow(db)
+    init_audit_log(db)
+
     # Check if default admin user exists
     admin = db.execute('SELECT * FROM users WHERE username = ?', ('admin',)).fetchone()
     
@@ -221,6 +349,50 @@ def init_db():
     
     db.commit()
 
+def init_patient_search(db):
+    # Full-text index over the searchable patient columns, kept in sync by triggers
+    exists = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='patients_fts'"
+    ).fetchone()
+    if exists:
+        return
+
+    try:
+        db.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+                name, contact, department,
+                content='patients', content_rowid='id'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5 - search falls back to LIKE
+        print(f"Warning: Full-text patient search unavailable: {e}")
+        return
+
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_insert AFTER INSERT ON patients BEGIN
+            INSERT INTO patients_fts(rowid, name, contact, department)
+            VALUES (new.id, new.name, new.contact, new.department);
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_delete AFTER DELETE ON patients BEGIN
+            INSERT INTO patients_fts(patients_fts, rowid, name, contact, department)
+            VALUES ('delete', old.id, old.name, old.contact, old.department);
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_update AFTER UPDATE ON patients BEGIN
+            INSERT INTO patients_fts(patients_fts, rowid, name, contact, department)
+            VALUES ('delete', old.id, old.name, old.contact, old.department);
+            INSERT INTO patients_fts(rowid, name, contact, department)
+            VALUES (new.id, new.name, new.contact, new.department);
+        END
+    ''')
+
+    # Index patients that were registered before the search table existed
+    db.execute("INSERT INTO patients_fts(patients_fts) VALUES ('rebuild')")
+
 def seed_sample_data():
     # adds test patients if db is empty
     db = get_db()
@@ -0,0 +1,234 @@
+import json
+import os
+import queue
+import threading
+import time
+
+# What the queue pages listen to. Rows are consultation ids, exam ids and
+# prescription ids (the account and pharmacy pages share the last).
+EVENT_TOPICS = ('consultations', 'laboratory', 'prescriptions')
+
+HEARTBEAT_SECONDS = 15  # comment lines keep idle streams open through proxies
+PRUNE_INTERVAL = 60  # seconds between deletes of events past their retention
+
+def init_queue_events(db):
+    # Append-only feed of queue rows that changed, written by the triggers
+    # below in the same transaction as the change. Every worker process
+    # tails it by id, so a change made in one process reaches the pages
+    # connected to any other. Old events are pruned by QueueEventBus.
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS queue_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            topic TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_queue_events_created ON queue_events(created_at)')
+
+    event = "INSERT INTO queue_events (topic, row_id) VALUES ('{topic}', {row_id});"
+    # consultations.updated_at is touched whenever its exam, diagnosis,
+    # prescription or patient changes (see init_consultation_stamps)
+    triggers = [
+        ('consultation_insert', 'INSERT ON consultations', event.format(topic='consultations', row_id='NEW.id')),
+        ('consultation_update', 'UPDATE OF status, updated_at ON consultations',
+         event.format(topic='consultations', row_id='NEW.id')),
+        ('consultation_delete', 'DELETE ON consultations', event.format(topic='consultations', row_id='OLD.id')),
+        ('exam_insert', 'INSERT ON exams', event.format(topic='laboratory', row_id='NEW.id')),
+        ('exam_update', 'UPDATE OF status ON exams', event.format(topic='laboratory', row_id='NEW.id')),
+        ('exam_delete', 'DELETE ON exams', event.format(topic='laboratory', row_id='OLD.id')),
+        ('exam_test_insert', 'INSERT ON exam_tests', event.format(topic='laboratory', row_id='NEW.exam_id')),
+        ('exam_test_update', 'UPDATE ON exam_tests', event.format(topic='laboratory', row_id='NEW.exam_id')),
+        ('prescription_insert', 'INSERT ON prescriptions', event.format(topic='prescriptions', row_id='NEW.id')),
+        ('prescription_update', 'UPDATE ON prescriptions', event.format(topic='prescriptions', row_id='NEW.id')),
+        ('prescription_delete', 'DELETE ON prescriptions', event.format(topic='prescriptions', row_id='OLD.id')),
+        ('patient_update', 'UPDATE ON patients', '''
+            INSERT INTO queue_events (topic, row_id)
+            SELECT 'laboratory', id FROM exams
+            WHERE patient_id = NEW.id AND status IN ('pending', 'in_progress');
+            INSERT INTO queue_events (topic, row_id)
+            SELECT 'prescriptions', id FROM prescriptions
+            WHERE patient_id = NEW.id AND pharmacy_status IN ('not_sent', 'sent');
+        '''),
+    ]
+    for name, on, action in triggers:
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS queue_event_{name} AFTER {on} BEGIN
+                {action}
+            END
+        ''')
+
+def latest_event_id(db):
+    """Id of the newest queue event; pages hand it to the event stream."""
+    return db.execute('SELECT COALESCE(MAX(id), 0) FROM queue_events').fetchone()[0]
+
+def get_events_since(db, since, until, topics):
+    """(id, topic, row_id) of events in (since, until] for the given topics,
+    or None when events after since were already pruned."""
+    oldest = db.execute('SELECT MIN(id) FROM queue_events').fetchone()[0]
+    if since < until and (oldest is None or oldest > since + 1):
+        return None
+    return db.execute(f'''
+        SELECT id, topic, row_id FROM queue_events
+        WHERE id > ? AND id <= ? AND topic IN ({', '.join('?' * len(topics))})
+        ORDER BY id
+    ''', (since, until, *topics)).fetchall()
+
+def format_event(event):
+    event_id, topic, row_id = event
+    return f'id: {event_id}\nevent: change\ndata: {json.dumps({"topic": topic, "id": row_id})}\n\n'
+
+class Subscription:
+    """One connected page: the topics it wants and a bounded buffer of events."""
+
+    def __init__(self, topics, buffer_size):
+        self.topics = set(topics)
+        self.events = queue.Queue(maxsize=buffer_size)
+        self.overflowed = False
+
+    def put(self, event):
+        # A client too slow to keep up is told to reload instead of
+        # growing its buffer
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+class QueueEventBus:
+    """In-process pub/sub of queue changes for the live queue pages.
+
+    One thread per worker process tails queue_events every poll_interval
+    seconds while at least one page is connected, and copies each event
+    into the buffers of the subscriptions that want its topic. Events
+    older than retention seconds are pruned every PRUNE_INTERVAL seconds,
+    whether or not a page is connected, once start() has run. At most
+    max_streams pages are connected per process, since each open stream
+    holds a request thread.
+    """
+
+    def __init__(self, app, poll_interval=1.0, buffer_size=100, max_streams=4, retention=600):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.buffer_size = buffer_size
+        self.max_streams = max_streams
+        self.retention = retention
+        self._subscriptions = set()
+        self._last_id = None
+        self._pruned_at = 0
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def subscribe(self, db, topics):
+        """Register a page; returns (subscription, id of the last event it
+        will not be sent), or (None, None) if this process is full."""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked from the process that created the bus
+                self._subscriptions = set()
+                self._last_id = None
+            if len(self._subscriptions) >= self.max_streams:
+                return None, None
+            if self._last_id is None:
+                self._last_id = latest_event_id(db)
+            subscription = Subscription(topics, self.buffer_size)
+            self._subscriptions.add(subscription)
+            cutoff = self._last_id
+            self._start()
+        self._wake.set()
+        return subscription, cutoff
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def stream(self, subscription, backlog, duration):
+        """Server-sent events for a subscription, for at most duration seconds.
+
+        backlog (events the page missed) goes first; None means they were
+        pruned, so the page is told to reload. The browser reconnects when
+        the stream ends, sending the last event id it saw.
+        """
+        try:
+            yield 'retry: 2000\n\n'
+            if backlog is None:
+                yield 'event: reset\ndata: {}\n\n'
+                return
+            for event in backlog:
+                yield format_event(event)
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                if subscription.overflowed:
+                    yield 'event: reset\ndata: {}\n\n'
+                    return
+                try:
+                    timeout = min(HEARTBEAT_SECONDS, deadline - time.monotonic())
+                    event = subscription.events.get(timeout=max(timeout, 0))
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                yield format_event(event)
+        finally:
+            self.unsubscribe(subscription)
+
+    def start(self):
+        """Make sure this process's thread is running, so old events are
+        pruned even while no queue page is open."""
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='cms-queue-events', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        from models.database import get_db
+        while True:
+            with self._lock:
+                idle = not self._subscriptions
+                if idle:
+                    # Picked up again from the newest event on the next subscribe
+                    self._last_id = None
+                    self._wake.clear()
+            try:
+                with self.app.app_context():
+                    db = get_db()
+                    if not idle:
+                        self._poll(db)
+                    self._prune(db)
+            except Exception as e:
+                print(f'Warning: Queue event poll failed: {e}')
+            if idle:
+                self._wake.wait(PRUNE_INTERVAL)
+            else:
+                time.sleep(self.poll_interval)
+
+    def _poll(self, db):
+        with self._lock:
+            last_id = self._last_id
+        if last_id is None:
+            return
+        rows = db.execute(
+            'SELECT id, topic, row_id FROM queue_events WHERE id > ? ORDER BY id LIMIT 1000', (last_id,)
+        ).fetchall()
+        with self._lock:
+            if self._last_id != last_id:
+                return
+            for row in rows:
+                event = (row[0], row[1], row[2])
+                for subscription in self._subscriptions:
+                    if row[1] in subscription.topics:
+                        subscription.put(event)
+                self._last_id = row[0]
+
+    def _prune(self, db):
+        if time.monotonic() - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = time.monotonic()
+        db.execute(
+            "DELETE FROM queue_events WHERE created_at < datetime('now', ?)", (f'-{int(self.retention)} seconds',)
+        )
+        db.commit()
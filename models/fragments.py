@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+from markupsafe import Markup
+
+class FragmentCache:
+    """LRU cache of rendered template fragments, bounded by total size.
+
+    A fragment is keyed on its name, the row id and the row's updated_at,
+    so an edited row simply misses and its old HTML ages out. Use it from
+    a template with a call block; the body is only rendered on a miss:
+
+        {% call cache_fragment('consultation_row', consult.id, consult.updated_at) %}
+            ...
+        {% endcall %}
+
+    The body must depend on nothing but the row. max_bytes = 0 disables it.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def fragment(self, name, row_id, updated_at, caller):
+        key = (name, row_id, updated_at)
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return Markup(html)
+            self.misses += 1
+
+        html = str(caller())
+        if len(html) <= self.max_bytes:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = html
+                    self._size += len(html)
+                while self._size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+        return Markup(html)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+fragment_cache = FragmentCache()
@@ -0,0 +1,227 @@
+import base64
+import hashlib
+import json
+from datetime import datetime
+
+# Columns each history section may return, and the keys it is ordered by
+# (newest first). Sort keys are also what the section cursors point at.
+HISTORY_SECTIONS = {
+    'vitals': {
+        'table': 'vitals',
+        'columns': ['id', 'blood_pressure', 'systolic', 'diastolic', 'heart_rate', 'temperature', 'respiratory_rate',
+                    'oxygen_saturation', 'notes', 'recorded_by', 'recorded_at'],
+        'order': ['recorded_at', 'id'],
+        'since': 'recorded_at >= ?',
+    },
+    'appointments': {
+        'table': 'appointments',
+        'columns': ['id', 'date', 'time', 'reason', 'status', 'notes', 'created_at'],
+        'order': ['date', 'time', 'id'],
+        'since': 'date >= date(?)',
+    },
+    'exams': {
+        'table': 'exams',
+        'columns': ['id', 'presenting_complaint', 'history_of_complaint', 'clinical_details',
+                    'status', 'created_by', 'created_at'],
+        'order': ['created_at', 'id'],
+        'since': 'created_at >= ?',
+    },
+    'diagnoses': {
+        'table': 'diagnoses',
+        'columns': ['id', 'confirmed_diagnosis', 'test_feedbacks', 'lab_tech_comment',
+                    'diagnosis_notes', 'diagnosed_by', 'diagnosed_at'],
+        'order': ['diagnosed_at', 'id'],
+        'since': 'diagnosed_at >= ?',
+    },
+}
+
+PATIENT_COLUMNS = ['id', 'name', 'date_of_birth', 'gender', 'blood_type', 'allergies', 'contact',
+                   'address', 'department', 'payment_method', 'created_at']
+
+DEFAULT_HISTORY_LIMIT = 50
+MAX_HISTORY_LIMIT = 500
+FETCH_BATCH = 100
+
+def init_patient_history(db):
+    # Per-patient counter bumped by any change to the patient or their
+    # history, so the history endpoint can answer If-None-Match cheaply
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS patient_history_versions (
+            patient_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    bump = '''
+        INSERT INTO patient_history_versions (patient_id, version) VALUES ({patient_id}, 1)
+        ON CONFLICT(patient_id) DO UPDATE SET version = version + 1;
+    '''
+    for table in HISTORY_SECTIONS:
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            db.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS patient_history_{table}_{event.lower()}
+                AFTER {event} ON {table} BEGIN
+                    {bump.format(patient_id=row + '.patient_id')}
+                END
+            ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS patient_history_patients_update AFTER UPDATE ON patients BEGIN
+            {bump.format(patient_id='NEW.id')}
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS patient_history_patients_delete AFTER DELETE ON patients BEGIN
+            DELETE FROM patient_history_versions WHERE patient_id = OLD.id;
+        END
+    ''')
+
+    # Patient-scoped, newest-first history reads walk these in order
+    db.execute('CREATE INDEX IF NOT EXISTS idx_vitals_patient_recorded ON vitals(patient_id, recorded_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_appointments_patient_date ON appointments(patient_id, date, time)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_exams_patient_created ON exams(patient_id, created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_diagnoses_patient_diagnosed ON diagnoses(patient_id, diagnosed_at)')
+
+def encode_history_cursor(keys):
+    raw = json.dumps(list(keys)).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_history_cursor(cursor, size):
+    try:
+        keys = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        keys = None
+    if not isinstance(keys, list) or len(keys) != size:
+        raise ValueError('Invalid cursor')
+    return keys
+
+def parse_since(value):
+    """Normalize a since= date or datetime to the format stored in the db."""
+    try:
+        return datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise ValueError(f'Invalid since value: {value}')
+
+def parse_limit(value):
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError(f'Invalid limit: {value}')
+    return max(1, min(limit, MAX_HISTORY_LIMIT))
+
+def parse_history_params(args):
+    """Turn the query string into a plan of what to read for each section.
+
+    fields= lists sections ("vitals") and/or single columns ("vitals.notes");
+    without it every section is returned in full. limit= and since= apply to
+    every section unless overridden per section, e.g. exams_limit=5.
+    <section>_cursor continues a section from a previous response's
+    next_cursors. Raises ValueError on anything unknown or malformed.
+    """
+    selected = {}
+    fields = args.get('fields')
+    if fields:
+        for field in filter(None, (f.strip() for f in fields.split(','))):
+            section, _, column = field.partition('.')
+            allowed = PATIENT_COLUMNS if section == 'patient' else HISTORY_SECTIONS.get(section, {}).get('columns')
+            if allowed is None:
+                raise ValueError(f'Unknown history section: {section}')
+            if column and column not in allowed:
+                raise ValueError(f'Unknown field: {field}')
+            columns = selected.setdefault(section, [])
+            if columns is not None:
+                if column:
+                    if column not in columns:
+                        columns.append(column)
+                else:
+                    selected[section] = None  # whole section
+    else:
+        selected = dict.fromkeys(['patient', *HISTORY_SECTIONS])
+
+    plan = {'patient': None, 'sections': {}}
+    if 'patient' in selected:
+        plan['patient'] = selected['patient'] or PATIENT_COLUMNS
+    for name, section in HISTORY_SECTIONS.items():
+        if name not in selected:
+            continue
+        limit = args.get(f'{name}_limit', args.get('limit'))
+        since = args.get(f'{name}_since', args.get('since'))
+        cursor = args.get(f'{name}_cursor')
+        plan['sections'][name] = {
+            'columns': selected[name] or section['columns'],
+            'limit': parse_limit(limit) if limit else DEFAULT_HISTORY_LIMIT,
+            'since': parse_since(since) if since else None,
+            'after': decode_history_cursor(cursor, len(section['order'])) if cursor else None,
+        }
+    return plan
+
+def get_patient_history_version(db, patient_id):
+    """Returns the patient's history version, or None if there is no such patient."""
+    row = db.execute('''
+        SELECT COALESCE(v.version, 0) AS version
+        FROM patients p
+        LEFT JOIN patient_history_versions v ON v.patient_id = p.id
+        WHERE p.id = ?
+    ''', (patient_id,)).fetchone()
+    return row['version'] if row else None
+
+def history_etag(patient_id, version, args):
+    # The representation depends on the query too (fields, limits, cursors)
+    query = '&'.join(f'{key}={value}' for key, value in sorted(args.items(multi=True)))
+    digest = hashlib.sha1(query.encode('utf-8')).hexdigest()[:12]
+    return f'history-{patient_id}-{version}-{digest}'
+
+def json_object_sql(columns):
+    # SQLite builds each row's JSON text, so rows never become Python dicts
+    return 'json_object(' + ', '.join(f"'{column}', {column}" for column in columns) + ')'
+
+def stream_patient_history(db, patient_id, plan):
+    """Yield the history response as JSON text, one batch of rows at a time."""
+    yield '{"success": true'
+
+    if plan['patient']:
+        patient = db.execute(
+            f'SELECT {json_object_sql(plan["patient"])} FROM patients WHERE id = ?',
+            (patient_id,)
+        ).fetchone()
+        yield ', "patient": ' + patient[0]
+
+    next_cursors = {}
+    for name, options in plan['sections'].items():
+        section = HISTORY_SECTIONS[name]
+        order = section['order']
+        where = ['patient_id = ?']
+        params = [patient_id]
+        if options['since']:
+            where.append(section['since'])
+            params.append(options['since'])
+        if options['after']:
+            where.append(f'({", ".join(order)}) < ({", ".join("?" * len(order))})')
+            params.extend(options['after'])
+        params.append(options['limit'] + 1)  # one extra row tells us there is more
+
+        # Keys are read back as stored text, not as PARSE_DECLTYPES datetimes
+        keys = ', '.join(key if key == 'id' else f'CAST({key} AS TEXT)' for key in order)
+        cursor = db.execute(f'''
+            SELECT {json_object_sql(options['columns'])}, {keys}
+            FROM {section['table']}
+            WHERE {' AND '.join(where)}
+            ORDER BY {', '.join(f'{key} DESC' for key in order)}
+            LIMIT ?
+        ''', params)
+
+        yield f', "{name}": ['
+        sent = 0
+        last_keys = None
+        while sent < options['limit']:
+            rows = cursor.fetchmany(min(FETCH_BATCH, options['limit'] - sent))
+            if not rows:
+                break
+            yield (',' if sent else '') + ','.join(row[0] for row in rows)
+            sent += len(rows)
+            last_keys = tuple(rows[-1])[1:]
+        yield ']'
+
+        if sent == options['limit'] and cursor.fetchone() is not None:
+            next_cursors[name] = encode_history_cursor(last_keys)
+        cursor.close()
+
+    yield ', "next_cursors": ' + json.dumps(next_cursors) + '}'
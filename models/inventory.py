@@ -0,0 +1,231 @@
+import threading
+import time
+
+def init_inventory(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS stock_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            medicine TEXT UNIQUE NOT NULL COLLATE NOCASE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Append-only: stock levels are the running sums of on_hand_change and
+    # reserved_change, counted in doses (times per day x days) like
+    # prescription items. kind is receive, reserve, release or dispense; a
+    # row with reorder_level set changes the item's low-stock threshold.
+    # prescription_id outlives the prescription, so it is not a foreign key.
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS stock_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            on_hand_change INTEGER NOT NULL DEFAULT 0,
+            reserved_change INTEGER NOT NULL DEFAULT 0,
+            reorder_level INTEGER,
+            prescription_id INTEGER,
+            created_by TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (item_id) REFERENCES stock_items (id)
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_stock_ledger_item ON stock_ledger(item_id)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_stock_ledger_prescription ON stock_ledger(prescription_id) WHERE prescription_id IS NOT NULL')
+
+class StockLevel:
+    __slots__ = ('item_id', 'medicine', 'on_hand', 'reserved', 'reorder_level')
+
+    def __init__(self, item_id, medicine):
+        self.item_id = item_id
+        self.medicine = medicine
+        self.on_hand = 0
+        self.reserved = 0
+        self.reorder_level = 0
+
+    @property
+    def available(self):
+        return self.on_hand - self.reserved
+
+    @property
+    def low(self):
+        return self.available <= self.reorder_level
+
+    def as_dict(self):
+        return {
+            'medicine': self.medicine,
+            'on_hand': self.on_hand,
+            'reserved': self.reserved,
+            'available': self.available,
+            'reorder_level': self.reorder_level,
+            'low': self.low,
+        }
+
+class StockCache:
+    """In-process stock levels per medicine, folded from the stock ledger.
+
+    rebuild() sums the whole ledger once at startup; after that refresh()
+    only reads ledger rows with a higher id than the last one applied, so
+    writes from other worker processes show up without rescanning. Lookups
+    are dict hits; the set of low items is kept up to date as rows are
+    applied.
+    """
+
+    def __init__(self, refresh_interval=2):
+        self.refresh_interval = refresh_interval
+        self._levels = {}  # medicine.lower() -> StockLevel
+        self._by_id = {}
+        self._low = set()
+        self._last_ledger_id = 0
+        self._last_item_id = 0
+        self._refreshed_at = 0
+        self._lock = threading.Lock()
+
+    def rebuild(self, db):
+        with self._lock:
+            self._levels = {}
+            self._by_id = {}
+            self._low = set()
+            self._last_item_id = 0
+            self._load_items(db)
+            # The latest reorder level per item is the one with the highest id
+            for row in db.execute('''
+                SELECT item_id, SUM(on_hand_change), SUM(reserved_change),
+                       (SELECT l.reorder_level FROM stock_ledger l
+                        WHERE l.item_id = s.item_id AND l.reorder_level IS NOT NULL
+                        ORDER BY l.id DESC LIMIT 1),
+                       MAX(id)
+                FROM stock_ledger s
+                GROUP BY item_id
+            '''):
+                level = self._by_id.get(row[0])
+                if level is None:
+                    continue
+                level.on_hand, level.reserved = row[1], row[2]
+                level.reorder_level = row[3] or 0
+                self._last_ledger_id = max(self._last_ledger_id, row[4])
+            for level in self._by_id.values():
+                self._update_low(level)
+            self._refreshed_at = time.monotonic()
+
+    def refresh(self, db):
+        """Apply ledger rows written since the last refresh, by any process."""
+        with self._lock:
+            self._load_items(db)
+            rows = db.execute('''
+                SELECT id, item_id, on_hand_change, reserved_change, reorder_level
+                FROM stock_ledger WHERE id > ? ORDER BY id
+            ''', (self._last_ledger_id,)).fetchall()
+            for row in rows:
+                level = self._by_id.get(row[1])
+                if level is not None:
+                    level.on_hand += row[2]
+                    level.reserved += row[3]
+                    if row[4] is not None:
+                        level.reorder_level = row[4]
+                    self._update_low(level)
+                self._last_ledger_id = row[0]
+            self._refreshed_at = time.monotonic()
+
+    def _load_items(self, db):
+        for row in db.execute(
+            'SELECT id, medicine FROM stock_items WHERE id > ? ORDER BY id', (self._last_item_id,)
+        ):
+            level = StockLevel(row[0], row[1])
+            self._levels[row[1].lower()] = level
+            self._by_id[row[0]] = level
+            self._update_low(level)
+            self._last_item_id = row[0]
+
+    def _update_low(self, level):
+        if level.low:
+            self._low.add(level.item_id)
+        else:
+            self._low.discard(level.item_id)
+
+    def _refresh_if_stale(self, db):
+        if time.monotonic() - self._refreshed_at >= self.refresh_interval:
+            self.refresh(db)
+
+    def get(self, db, medicine):
+        """The StockLevel of a medicine, or None if the pharmacy doesn't stock it."""
+        self._refresh_if_stale(db)
+        return self._levels.get((medicine or '').strip().lower())
+
+    def low_stock(self, db):
+        self._refresh_if_stale(db)
+        with self._lock:
+            return sorted((self._by_id[item_id] for item_id in self._low), key=lambda level: level.medicine.lower())
+
+    def all_levels(self, db):
+        self._refresh_if_stale(db)
+        with self._lock:
+            return sorted(self._by_id.values(), key=lambda level: level.medicine.lower())
+
+stock_cache = StockCache()
+
+def get_or_create_item(db, medicine):
+    medicine = medicine.strip()
+    db.execute('INSERT OR IGNORE INTO stock_items (medicine) VALUES (?)', (medicine,))
+    return db.execute('SELECT id FROM stock_items WHERE medicine = ?', (medicine,)).fetchone()[0]
+
+def receive_stock(db, medicine, quantity, username, reorder_level=None):
+    """Record a delivery (or a reorder level change). The caller commits."""
+    item_id = get_or_create_item(db, medicine)
+    db.execute('''
+        INSERT INTO stock_ledger (item_id, kind, on_hand_change, reorder_level, created_by)
+        VALUES (?, 'receive', ?, ?, ?)
+    ''', (item_id, quantity, reorder_level, username))
+
+def reserve_stock(db, prescription_id, items, username):
+    """Reserve the doses of a new prescription's stocked medicines.
+
+    Returns the medicines that are now at or below their reorder level.
+    Medicines the pharmacy doesn't stock are not reserved. The caller
+    commits, so the reservation is part of the prescription's transaction.
+    """
+    levels = {}
+    quantities = {}
+    for item in items:
+        level = stock_cache.get(db, item['medicine'])
+        if level is not None:
+            levels[level.item_id] = level
+            quantities[level.item_id] = quantities.get(level.item_id, 0) + item['times_per_day'] * item['duration_days']
+    db.executemany('''
+        INSERT INTO stock_ledger (item_id, kind, reserved_change, prescription_id, created_by)
+        VALUES (?, 'reserve', ?, ?, ?)
+    ''', [(item_id, quantity, prescription_id, username) for item_id, quantity in quantities.items()])
+    return [
+        levels[item_id].medicine for item_id, quantity in quantities.items()
+        if levels[item_id].available - quantity <= levels[item_id].reorder_level
+    ]
+
+def outstanding_reservations(db, prescription_ids):
+    prescription_ids = list(prescription_ids)
+    if not prescription_ids:
+        return []
+    return db.execute(f'''
+        SELECT prescription_id, item_id, SUM(reserved_change) AS reserved
+        FROM stock_ledger
+        WHERE prescription_id IN ({', '.join('?' * len(prescription_ids))})
+        GROUP BY prescription_id, item_id
+        HAVING SUM(reserved_change) > 0
+    ''', prescription_ids).fetchall()
+
+def dispense_stock(db, prescription_id, username):
+    """Turn a prescription's reservations into stock leaving the shelf. The caller commits."""
+    db.executemany('''
+        INSERT INTO stock_ledger (item_id, kind, on_hand_change, reserved_change, prescription_id, created_by)
+        VALUES (?, 'dispense', ?, ?, ?, ?)
+    ''', [
+        (row['item_id'], -row['reserved'], -row['reserved'], prescription_id, username)
+        for row in outstanding_reservations(db, [prescription_id])
+    ])
+
+def release_reservations(db, prescription_ids, username):
+    """Return the reserved stock of prescriptions that won't be dispensed. The caller commits."""
+    db.executemany('''
+        INSERT INTO stock_ledger (item_id, kind, reserved_change, prescription_id, created_by)
+        VALUES (?, 'release', ?, ?, ?)
+    ''', [
+        (row['item_id'], -row['reserved'], row['prescription_id'], username)
+        for row in outstanding_reservations(db, prescription_ids)
+    ])
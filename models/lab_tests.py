@@ -0,0 +1,157 @@
+import sqlite3
+
+# Tests the lab offers out of the box: (code, name, short name, badge color,
+# the exams column that flagged it before exam_tests existed, worklist
+# queue). More tests can be added to lab_tests directly; they need no
+# schema change.
+LAB_TEST_CATALOG = [
+    ('rbs', 'Random Blood Sugar', 'RBS', 'blue', 'random_blood_sugar', 'chemistry'),
+    ('fbs', 'Fasting Blood Sugar', 'FBS', 'blue', 'fasting_blood_sugar', 'chemistry'),
+    ('lft', 'Liver Function Test', 'LFT', 'green', 'liver_function', 'chemistry'),
+    ('cbc', 'Complete Blood Count', 'CBC', 'red', 'full_blood_count', 'hematology'),
+    ('lipid', 'Lipid Profile', 'Lipid', 'yellow', 'lipid_profile', 'chemistry'),
+    ('kft', 'Kidney Function Test', 'KFT', 'purple', 'kidney_function', 'chemistry'),
+    ('thyroid', 'Thyroid Function Test', 'Thyroid', 'indigo', 'thyroid_function', 'chemistry'),
+    ('urine', 'Urinalysis', 'Urine', 'pink', 'urinalysis', 'microscopy'),
+    ('stool', 'Stool Examination', 'Stool', 'orange', 'stool_examination', 'microscopy'),
+    ('xray', 'Chest X-Ray', 'X-Ray', 'gray', 'chest_xray', 'imaging'),
+    ('ecg', 'Electrocardiogram', 'ECG', 'teal', 'ecg', 'cardiology'),
+    ('ultrasound', 'Ultrasound', 'US', 'cyan', 'ultrasound', 'imaging'),
+]
+
+LEGACY_TEST_COLUMNS = [entry[4] for entry in LAB_TEST_CATALOG]
+
+def init_lab_tests(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS lab_tests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            code TEXT UNIQUE NOT NULL,
+            name TEXT NOT NULL,
+            short_name TEXT NOT NULL,
+            color TEXT NOT NULL DEFAULT 'gray',
+            legacy_column TEXT,
+            category TEXT NOT NULL DEFAULT 'general',
+            sort_order INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    # One row per test requested on an exam; status follows the test itself
+    # (pending -> in_progress when claimed -> completed/cancelled) so the
+    # lab can work per test
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS exam_tests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            exam_id INTEGER NOT NULL,
+            test_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            priority INTEGER NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            claimed_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (exam_id) REFERENCES exams (id) ON DELETE CASCADE,
+            FOREIGN KEY (test_id) REFERENCES lab_tests (id),
+            UNIQUE(exam_id, test_id)
+        )
+    ''')
+
+    # Add worklist columns to tables created before the worklist existed
+    lab_test_columns = [row[1] for row in db.execute('PRAGMA table_info(lab_tests)')]
+    if 'category' not in lab_test_columns:
+        db.execute("ALTER TABLE lab_tests ADD COLUMN category TEXT NOT NULL DEFAULT 'general'")
+        db.executemany(
+            'UPDATE lab_tests SET category = ? WHERE code = ?',
+            [(entry[5], entry[0]) for entry in LAB_TEST_CATALOG]
+        )
+    exam_test_columns = [row[1] for row in db.execute('PRAGMA table_info(exam_tests)')]
+    if 'priority' not in exam_test_columns:
+        db.execute('ALTER TABLE exam_tests ADD COLUMN priority INTEGER NOT NULL DEFAULT 0')
+        db.execute('ALTER TABLE exam_tests ADD COLUMN claimed_by TEXT')
+        db.execute('ALTER TABLE exam_tests ADD COLUMN claimed_at TIMESTAMP')
+
+    # Each test's pending requests in worklist order (most urgent, then
+    # oldest first): "all pending CBCs" is an index range, not a scan of
+    # pending exams, and the next item to claim is the first entry
+    db.execute('DROP INDEX IF EXISTS idx_exam_tests_test_status')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_exam_tests_queue ON exam_tests(test_id, status, priority DESC, created_at)')
+    db.execute("CREATE INDEX IF NOT EXISTS idx_exam_tests_claimed ON exam_tests(claimed_by) WHERE status = 'in_progress'")
+
+    db.executemany('''
+        INSERT OR IGNORE INTO lab_tests (code, name, short_name, color, legacy_column, category, sort_order)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [entry + (position,) for position, entry in enumerate(LAB_TEST_CATALOG)])
+
+def legacy_test_columns(db):
+    """The old per-test flag columns still present on exams."""
+    columns = {row[1] for row in db.execute('PRAGMA table_info(exams)')}
+    return [column for column in LEGACY_TEST_COLUMNS if column in columns]
+
+def migrate_exam_test_flags(db, drop_columns=True):
+    """Copy the exams flag columns into exam_tests, then drop the columns.
+
+    Runs one INSERT ... SELECT per flag column, so existing exams are
+    converted in bulk inside SQLite. Safe to run again. Returns the number
+    of exam_tests rows created. The caller commits.
+    """
+    columns = legacy_test_columns(db)
+    created = 0
+    for column in columns:
+        cursor = db.execute(f'''
+            INSERT OR IGNORE INTO exam_tests (exam_id, test_id, status, created_at)
+            SELECT e.id, t.id,
+                   CASE e.status WHEN 'completed' THEN 'completed'
+                                 WHEN 'cancelled' THEN 'cancelled'
+                                 ELSE 'pending' END,
+                   e.created_at
+            FROM exams e
+            JOIN lab_tests t ON t.legacy_column = ?
+            WHERE e.{column} = 1
+        ''', (column,))
+        created += cursor.rowcount
+
+    if columns and drop_columns:
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            print('Warning: SQLite 3.35+ is needed to drop the old exam test columns; they are left unused')
+        else:
+            for column in columns:
+                db.execute(f'ALTER TABLE exams DROP COLUMN {column}')
+    return created
+
+def get_lab_tests(db):
+    return db.execute(
+        'SELECT id, code, name, short_name, color FROM lab_tests WHERE active = 1 ORDER BY sort_order, id'
+    ).fetchall()
+
+def add_exam_tests(db, exam_id, test_ids, priority=0):
+    db.executemany(
+        'INSERT INTO exam_tests (exam_id, test_id, priority) VALUES (?, ?, ?)',
+        [(exam_id, test_id, priority) for test_id in test_ids]
+    )
+
+def get_exam_tests(db, exam_ids):
+    """Returns {exam_id: [test, ...]} for the given exams, in catalog order."""
+    exam_ids = list(exam_ids)
+    tests = {exam_id: [] for exam_id in exam_ids}
+    if not exam_ids:
+        return tests
+    rows = db.execute(f'''
+        SELECT et.id, et.exam_id, et.status, et.priority, et.claimed_by,
+               t.code, t.name, t.short_name, t.color
+        FROM exam_tests et
+        JOIN lab_tests t ON t.id = et.test_id
+        WHERE et.exam_id IN ({', '.join('?' * len(exam_ids))})
+        ORDER BY t.sort_order, t.id
+    ''', exam_ids).fetchall()
+    for row in rows:
+        tests[row['exam_id']].append(row)
+    return tests
+
+def get_pending_tests(db, test_code):
+    """Pending requests for one test in worklist order, e.g. every pending CBC."""
+    return db.execute('''
+        SELECT et.id, et.exam_id, e.patient_id, et.priority, et.created_at
+        FROM lab_tests t
+        JOIN exam_tests et ON et.test_id = t.id AND et.status = 'pending'
+        JOIN exams e ON e.id = et.exam_id
+        WHERE t.code = ?
+        ORDER BY et.priority DESC, et.created_at, et.id
+    ''', (test_code,)).fetchall()
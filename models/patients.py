@@ -0,0 +1,161 @@
+import base64
+import json
+import re
+import threading
+from collections import OrderedDict
+
+PATIENT_LIST_COLUMNS = '''p.id, p.name, p.date_of_birth, p.gender, p.blood_type, p.allergies,
+                          p.contact, p.address, p.department, p.payment_method'''
+
+def encode_cursor(row):
+    """Opaque keyset cursor pointing just past the given patient row."""
+    raw = json.dumps([row['name'], row['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    """Returns (name, id) or None if the cursor is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        name, patient_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return str(name), int(patient_id)
+    except (ValueError, TypeError):
+        return None
+
+def build_match_query(text):
+    # Every word must match as a prefix, e.g. "jo 555" -> "jo"* AND "555"*
+    terms = re.findall(r'\w+', text or '')
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def has_fts(db):
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='patients_fts'"
+    ).fetchone() is not None
+
+def search_patients(db, query='', cursor=None, limit=20):
+    """Keyset-paginated patient search over name, contact and department.
+
+    Returns (rows, next_cursor). next_cursor is None on the last page.
+    """
+    # Finished patients waiting for the archive job are already gone
+    where = ['p.id NOT IN (SELECT patient_id FROM archive_queue)']
+    params = []
+
+    match = build_match_query(query)
+    if match:
+        if has_fts(db):
+            where.append('p.id IN (SELECT rowid FROM patients_fts WHERE patients_fts MATCH ?)')
+            params.append(match)
+        else:
+            for term in re.findall(r'\w+', query):
+                where.append('(p.name LIKE ? OR p.contact LIKE ? OR p.department LIKE ?)')
+                params.extend([f'%{term}%'] * 3)
+
+    after = decode_cursor(cursor)
+    if after:
+        where.append('(p.name, p.id) > (?, ?)')
+        params.extend(after)
+
+    sql = f'SELECT {PATIENT_LIST_COLUMNS} FROM patients p WHERE ' + ' AND '.join(where)
+    # Fetch one extra row to know whether another page exists
+    sql += ' ORDER BY p.name, p.id LIMIT ?'
+    params.append(limit + 1)
+
+    rows = db.execute(sql, params).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+    return rows, next_cursor
+
+def init_patient_typeahead(db):
+    # Case-insensitive name order: "jo" is the range of names starting
+    # with jo/Jo/JO, so typeahead lookups never scan patients
+    db.execute('CREATE INDEX IF NOT EXISTS idx_patients_name_nocase ON patients(name COLLATE NOCASE)')
+
+    # Bumped whenever a typeahead answer could change, in any process
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS patient_directory_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    db.execute('INSERT OR IGNORE INTO patient_directory_version (id, version) VALUES (1, 0)')
+    bump = 'UPDATE patient_directory_version SET version = version + 1 WHERE id = 1;'
+    for name, event in (('patient_insert', 'INSERT ON patients'),
+                        ('patient_delete', 'DELETE ON patients'),
+                        ('patient_update', 'UPDATE OF name, date_of_birth ON patients'),
+                        ('archive_queue_insert', 'INSERT ON archive_queue')):
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS patient_directory_{name} AFTER {event} BEGIN
+                {bump}
+            END
+        ''')
+
+def typeahead_patients(db, query, limit=10):
+    """Top matches for a typed prefix as (id, name, date_of_birth) rows.
+
+    Names starting with the text come first (an index range); if there are
+    fewer than limit, names with a later word starting with it follow,
+    e.g. "smi" also finds "John Smith".
+    """
+    text = ' '.join((query or '').split())
+    if not text:
+        return []
+    pattern = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    rows = db.execute(r'''
+        SELECT p.id, p.name, CAST(p.date_of_birth AS TEXT) AS date_of_birth
+        FROM patients p
+        WHERE p.name LIKE ? ESCAPE '\' AND p.id NOT IN (SELECT patient_id FROM archive_queue)
+        ORDER BY p.name COLLATE NOCASE, p.id
+        LIMIT ?
+    ''', (pattern, limit)).fetchall()
+
+    match = build_match_query(text)
+    if len(rows) < limit and match and has_fts(db):
+        found = [row['id'] for row in rows]
+        rows += db.execute(f'''
+            SELECT p.id, p.name, CAST(p.date_of_birth AS TEXT) AS date_of_birth
+            FROM patients p
+            WHERE p.id IN (SELECT rowid FROM patients_fts WHERE patients_fts MATCH ?)
+              AND p.id NOT IN ({', '.join('?' * len(found))})
+              AND p.id NOT IN (SELECT patient_id FROM archive_queue)
+            ORDER BY p.name COLLATE NOCASE, p.id
+            LIMIT ?
+        ''', (f'name : ({match})', *found, limit - len(rows))).fetchall()
+    return rows
+
+class TypeaheadCache:
+    """LRU cache of recent typeahead answers, keyed by lowercased prefix.
+
+    Every lookup first reads patient_directory_version (one row); when a
+    patient was added, renamed or removed since, the whole cache is
+    dropped, so other worker processes' changes are never served stale.
+    """
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def lookup(self, db, query, limit=10):
+        version = db.execute('SELECT version FROM patient_directory_version WHERE id = 1').fetchone()[0]
+        key = (' '.join((query or '').lower().split()), limit)
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            elif key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        results = [dict(row) for row in typeahead_patients(db, query, limit)]
+        with self._lock:
+            if version == self._version:
+                self._entries[key] = results
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return results
+
+typeahead_cache = TypeaheadCache()
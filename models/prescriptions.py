@@ -0,0 +1,190 @@
+import sqlite3
+
+ITEM_COLUMNS = ['medicine', 'amount', 'times_per_day', 'duration_days']
+
+def init_prescription_items(db):
+    # One row per medicine on a prescription. prescribed_at is copied from
+    # the prescription so usage reports never have to join back to it.
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS prescription_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            prescription_id INTEGER NOT NULL,
+            position INTEGER NOT NULL DEFAULT 0,
+            medicine TEXT NOT NULL,
+            amount TEXT NOT NULL,
+            times_per_day INTEGER NOT NULL,
+            duration_days INTEGER NOT NULL,
+            prescribed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (prescription_id) REFERENCES prescriptions (id) ON DELETE CASCADE
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_prescription_items_prescription ON prescription_items(prescription_id, position)')
+    # "How much amoxicillin this month" is a range of this index, and it
+    # holds every column the report sums, so the table is never read
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_prescription_items_medicine ON prescription_items(
+            medicine COLLATE NOCASE, prescribed_at, prescription_id, times_per_day, duration_days
+        )
+    ''')
+
+def has_medicines_column(db):
+    """True while prescriptions still stores medicines as a JSON column."""
+    return 'medicines' in {row[1] for row in db.execute('PRAGMA table_info(prescriptions)')}
+
+def migrate_prescription_medicines(db, drop_column=True):
+    """Copy the JSON medicines of every prescription into prescription_items.
+
+    SQLite's json_each unpacks all prescriptions in one INSERT ... SELECT.
+    Prescriptions that already have items are skipped, so it is safe to run
+    again; ones whose JSON is malformed are left out and reported. Returns
+    (items created, prescriptions skipped). The caller commits.
+    """
+    if not has_medicines_column(db):
+        return 0, 0
+
+    cursor = db.execute('''
+        INSERT INTO prescription_items (
+            prescription_id, position, medicine, amount, times_per_day, duration_days, prescribed_at
+        )
+        SELECT pr.id, CAST(med.key AS INTEGER),
+               COALESCE(json_extract(med.value, '$.type'), ''),
+               COALESCE(json_extract(med.value, '$.amount'), ''),
+               COALESCE(json_extract(med.value, '$.times_per_day'), 0),
+               COALESCE(json_extract(med.value, '$.duration_days'), 0),
+               pr.prescribed_at
+        FROM prescriptions pr, json_each(pr.medicines) med
+        WHERE json_valid(pr.medicines)
+          AND json_type(pr.medicines) = 'array'
+          AND NOT EXISTS (SELECT 1 FROM prescription_items i WHERE i.prescription_id = pr.id)
+    ''')
+    created = cursor.rowcount
+    invalid = db.execute('''
+        SELECT COUNT(*) FROM prescriptions
+        WHERE NOT json_valid(medicines) OR json_type(medicines) != 'array'
+    ''').fetchone()[0]
+
+    if drop_column:
+        if invalid:
+            print(f'Warning: {invalid} prescriptions have unreadable medicines; the medicines column is kept')
+        elif sqlite3.sqlite_version_info < (3, 35, 0):
+            print('Warning: SQLite 3.35+ is needed to drop prescriptions.medicines; it is left unused')
+        else:
+            db.execute('ALTER TABLE prescriptions DROP COLUMN medicines')
+    return created, invalid
+
+def add_prescription_items(db, prescription_id, medicines):
+    """Insert the medicines of a new prescription. The caller commits."""
+    db.executemany('''
+        INSERT INTO prescription_items (
+            prescription_id, position, medicine, amount, times_per_day, duration_days, prescribed_at
+        )
+        SELECT ?, ?, ?, ?, ?, ?, prescribed_at FROM prescriptions WHERE id = ?
+    ''', [
+        (prescription_id, position, med['medicine'], med['amount'],
+         med['times_per_day'], med['duration_days'], prescription_id)
+        for position, med in enumerate(medicines)
+    ])
+
+def get_prescription_items(db, prescription_ids):
+    """Returns {prescription_id: [item, ...]} as plain dicts, in prescribed order."""
+    prescription_ids = list(prescription_ids)
+    items = {prescription_id: [] for prescription_id in prescription_ids}
+    if not prescription_ids:
+        return items
+    rows = db.execute(f'''
+        SELECT prescription_id, {', '.join(ITEM_COLUMNS)}
+        FROM prescription_items
+        WHERE prescription_id IN ({', '.join('?' * len(prescription_ids))})
+        ORDER BY prescription_id, position
+    ''', prescription_ids).fetchall()
+    for row in rows:
+        items[row['prescription_id']].append({column: row[column] for column in ITEM_COLUMNS})
+    return items
+
+def medicine_usage(db, start, end, medicine=None):
+    """Prescribed quantities per medicine for prescribed_at in [start, end).
+
+    doses is times per day x days summed over every item, including the
+    items of archived patients. With medicine set (case-insensitive) only
+    that medicine is reported.
+    """
+    where = ['prescribed_at >= ?', 'prescribed_at < ?']
+    params = [start, end]
+    if medicine:
+        where.insert(0, 'medicine = ? COLLATE NOCASE')
+        params.insert(0, medicine)
+    columns = 'medicine, prescription_id, times_per_day, duration_days'
+    return db.execute(f'''
+        SELECT medicine COLLATE NOCASE AS medicine,
+               COUNT(DISTINCT prescription_id) AS prescriptions,
+               COUNT(*) AS items,
+               SUM(times_per_day * duration_days) AS doses
+        FROM (
+            SELECT {columns} FROM prescription_items WHERE {' AND '.join(where)}
+            UNION ALL
+            -- Until the archive job's second step deletes them, items are in both
+            SELECT {columns} FROM archive.archived_prescription_items a
+            WHERE {' AND '.join(where)} AND NOT EXISTS (SELECT 1 FROM prescription_items h WHERE h.id = a.id)
+        )
+        GROUP BY medicine COLLATE NOCASE
+        ORDER BY doses DESC, medicine
+    ''', params * 2).fetchall()
+
+def get_account_queue(db, prescription_ids=None):
+    """Prescriptions not yet sent to the pharmacy, newest first.
+
+    Read off the patient_flow queue index (awaiting payment, then paid).
+    With prescription_ids only those (if still in the queue) are returned.
+    """
+    ids = list(prescription_ids or [])
+    only = f"AND pr.id IN ({', '.join('?' * len(ids))})" if prescription_ids is not None else ''
+    return db.execute(f'''
+        SELECT 
+            pr.id as prescription_id,
+            pr.patient_id,
+            p.name,
+            p.gender,
+            p.payment_method,
+            pr.prescription_comment,
+            pr.management_plan,
+            pr.prescribed_by,
+            pr.prescribed_at,
+            pr.status,
+            pr.pharmacy_status,
+            c.id as consultation_id
+        FROM patient_flow f
+        JOIN prescriptions pr ON pr.id = f.prescription_id
+        JOIN patients p ON pr.patient_id = p.id
+        JOIN consultations c ON pr.consultation_id = c.id
+        WHERE f.stage IN ('completed', 'paid') {only}
+        ORDER BY f.queued_at DESC
+    ''', ids).fetchall()
+
+def get_pharmacy_queue(db, prescription_ids=None):
+    """Prescriptions sent to the pharmacy, newest first.
+
+    Read off the patient_flow queue index. With prescription_ids only
+    those (if still in the queue) are returned.
+    """
+    ids = list(prescription_ids or [])
+    only = f"AND pr.id IN ({', '.join('?' * len(ids))})" if prescription_ids is not None else ''
+    return db.execute(f'''
+        SELECT 
+            pr.id as prescription_id,
+            pr.patient_id,
+            p.name,
+            p.gender,
+            p.date_of_birth,
+            p.contact,
+            p.payment_method,
+            pr.prescription_comment,
+            pr.management_plan,
+            pr.prescribed_by,
+            pr.prescribed_at,
+            pr.status
+        FROM patient_flow f
+        JOIN prescriptions pr ON pr.id = f.prescription_id
+        JOIN patients p ON pr.patient_id = p.id
+        WHERE f.stage = 'sent' {only}
+        ORDER BY f.priority, f.queued_at DESC
+    ''', ids).fetchall()
@@ -0,0 +1,166 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Optional imaging libraries - without them the original file is shown
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+class PreviewGenerator:
+    """Downscaled previews of lab result files, made on a background pool.
+
+    Previews are JPEGs in a cache folder next to the originals' folder.
+    Their mtime doubles as the LRU clock: ensure() bumps it whenever a
+    preview is served, and when the folder outgrows max_bytes the least recently
+    used previews are removed. A missing preview is simply generated again.
+    """
+
+    def __init__(self, source_folder, cache_folder, size=320, max_bytes=200 * 1024 * 1024, workers=2):
+        self.source_folder = source_folder
+        self.cache_folder = cache_folder
+        self.size = size
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._executor = None
+        self._pending = set()
+        self._cache_bytes = None  # lazily measured
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def preview_name(filename):
+        return filename.rsplit('.', 1)[0] + '.preview.jpg'
+
+    def can_preview(self, filename):
+        ext = filename.rsplit('.', 1)[-1].lower()
+        if ext in IMAGE_EXTENSIONS:
+            return Image is not None
+        if ext == 'pdf':
+            return Image is not None and pymupdf is not None
+        return False
+
+    def discard(self, filenames):
+        """Remove the previews of lab files that were deleted."""
+        for filename in filenames:
+            try:
+                os.remove(os.path.join(self.cache_folder, self.preview_name(filename)))
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._cache_bytes = None  # re-measured on the next preview
+
+    def submit(self, filename):
+        """Queue preview generation for a newly uploaded file."""
+        if not self.can_preview(filename):
+            return
+        with self._lock:
+            if filename in self._pending:
+                return
+            self._pending.add(filename)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='cms-preview')
+        self._executor.submit(self._generate_in_background, filename)
+
+    def _generate_in_background(self, filename):
+        try:
+            self.generate(filename)
+        except Exception as e:
+            print(f'Warning: Could not create preview for {filename}: {e}')
+        finally:
+            with self._lock:
+                self._pending.discard(filename)
+
+    def ensure(self, filename):
+        """Return the preview path to serve, generating it now if it is
+        missing. An existing preview is marked as recently used."""
+        path = os.path.join(self.cache_folder, self.preview_name(filename))
+        try:
+            os.utime(path)
+        except OSError:
+            return self.generate(filename)
+        return path
+
+    def generate(self, filename):
+        source = os.path.join(self.source_folder, filename)
+        destination = os.path.join(self.cache_folder, self.preview_name(filename))
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+        if filename.rsplit('.', 1)[-1].lower() == 'pdf':
+            image = self._render_pdf_first_page(source)
+        else:
+            with Image.open(source) as original:
+                original.draft('RGB', (self.size, self.size))  # fast JPEG downscale on decode
+                image = original.convert('RGB')
+        image.thumbnail((self.size, self.size))
+
+        # Write then rename so readers never see a half-written preview
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_folder, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                image.save(out, 'JPEG', quality=80, optimize=True)
+            # A preview made again (e.g. upload and first view racing)
+            # replaces the old one, whose size no longer counts
+            try:
+                replaced = os.path.getsize(destination)
+            except OSError:
+                replaced = 0
+            os.replace(temp_path, destination)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        self._account(destination, replaced)
+        return destination
+
+    def _render_pdf_first_page(self, source):
+        with pymupdf.open(source) as document:
+            page = document[0]
+            zoom = self.size / max(page.rect.width, page.rect.height)
+            pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom))
+            return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+
+    def _account(self, new_preview, replaced=0):
+        with self._lock:
+            if self._cache_bytes is None:
+                self._cache_bytes = self._measure()
+            else:
+                self._cache_bytes += os.path.getsize(new_preview) - replaced
+            if self._cache_bytes <= self.max_bytes:
+                return
+            self._cache_bytes = self._evict(keep=new_preview)
+
+    def _measure(self):
+        total = 0
+        for entry in os.scandir(self.cache_folder):
+            if entry.is_file():
+                total += entry.stat().st_size
+        return total
+
+    def _evict(self, keep):
+        # Drop least recently used previews down to 90% of the budget,
+        # never the one that was just made
+        entries = [e for e in os.scandir(self.cache_folder) if e.is_file()]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        total = sum(e.stat().st_size for e in entries)
+        target = self.max_bytes * 0.9
+        for entry in entries:
+            if total <= target:
+                break
+            if entry.path == keep:
+                continue
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total -= size
+            except OSError:
+                pass
+        return total
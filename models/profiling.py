@@ -0,0 +1,268 @@
+import sqlite3
+import threading
+from time import perf_counter
+from flask import g, has_app_context, has_request_context, request, before_render_template, template_rendered
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+class Histogram:
+    """Prometheus-style histogram with labels, kept in memory per process."""
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        for label_values, values in series:
+            labels = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(self.labels, label_values))
+            prefix = labels + ',' if labels else ''
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {values[-2]}')
+            lines.append(f'{self.name}_count{{{labels}}} {values[-2]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {values[-1]:.6g}')
+        return lines
+
+class Counter:
+    """Prometheus-style counter with labels, kept in memory per process."""
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            labels = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(self.labels, label_values))
+            lines.append(f'{self.name}{{{labels}}} {value}')
+        return lines
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class RequestProfile:
+    """What one request spent, filled in as it runs."""
+
+    __slots__ = ('started', 'queries', 'query_seconds', 'render_starts')
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.render_starts = []
+
+def current_profile():
+    return g.get('profile') if has_app_context() else None
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor that adds its statement's execute and fetch time to the
+    current request's profile, and reports it once it turns slow."""
+
+    def execute(self, sql, parameters=()):
+        self._start(sql, parameters)
+        started = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._spent(perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        self._start(sql, seq_of_parameters[0] if seq_of_parameters else ())
+        started = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._spent(perf_counter() - started)
+
+    def fetchone(self):
+        started = perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._spent(perf_counter() - started)
+
+    def fetchmany(self, size=None):
+        started = perf_counter()
+        try:
+            return super().fetchmany(size if size is not None else self.arraysize)
+        finally:
+            self._spent(perf_counter() - started)
+
+    def fetchall(self):
+        started = perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._spent(perf_counter() - started)
+
+    def __next__(self):
+        started = perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            self._spent(perf_counter() - started)
+
+    def _start(self, sql, parameters):
+        self._sql = sql
+        self._parameters = parameters
+        self._elapsed = 0.0
+        self._reported = False
+        profile = current_profile()
+        if profile is not None:
+            profile.queries += 1
+
+    def _spent(self, seconds):
+        if getattr(self, '_sql', None) is None:
+            return
+        self._elapsed += seconds
+        profile = current_profile()
+        if profile is not None:
+            profile.query_seconds += seconds
+        profiler = getattr(self.connection, 'profiler', None)
+        if profiler and not self._reported and self._elapsed * 1000 >= profiler.slow_query_ms:
+            self._reported = True
+            profiler.slow_query(self.connection, self._sql, self._parameters, self._elapsed)
+
+class ProfiledConnection(sqlite3.Connection):
+    """sqlite3 connection whose cursors are ProfiledCursors.
+
+    Only used while profiling is on (see get_pool), so the plain
+    connection pays nothing otherwise.
+    """
+
+    profiler = None  # set by Profiler.init_app
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class Profiler:
+    """Per-request latency, SQL, template and response size metrics.
+
+    Each request's totals go into in-memory histograms, per worker
+    process, rendered in the Prometheus text format by render().
+    Statements slower than slow_query_ms are printed with their
+    EXPLAIN QUERY PLAN.
+    """
+
+    def __init__(self, slow_query_ms=100):
+        self.slow_query_ms = slow_query_ms
+        self.request_seconds = Histogram(
+            'cms_request_duration_seconds', 'Time to handle a request, until the response is sent',
+            ('endpoint', 'method'), DURATION_BUCKETS)
+        self.requests = Counter('cms_requests_total', 'Requests handled', ('endpoint', 'method', 'status'))
+        self.request_queries = Histogram(
+            'cms_request_queries', 'SQL statements run per request', ('endpoint',), QUERY_COUNT_BUCKETS)
+        self.request_query_seconds = Histogram(
+            'cms_request_query_seconds', 'Time spent in SQL per request', ('endpoint',), DURATION_BUCKETS)
+        self.template_seconds = Histogram(
+            'cms_template_render_seconds', 'Time to render a template', ('template',), DURATION_BUCKETS)
+        self.response_bytes = Histogram(
+            'cms_response_bytes', 'Response body size', ('endpoint',), BYTES_BUCKETS)
+        self.slow_queries = Counter(
+            'cms_slow_queries_total', 'Statements slower than the slow query threshold', ('endpoint',))
+
+    def init_app(self, app):
+        ProfiledConnection.profiler = self
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._rendered, app)
+        app.extensions['profiler'] = self
+
+    def render(self):
+        lines = []
+        for metric in (self.request_seconds, self.requests, self.request_queries, self.request_query_seconds,
+                       self.template_seconds, self.response_bytes, self.slow_queries):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def slow_query(self, conn, sql, parameters, seconds):
+        endpoint = (request.endpoint or 'unmatched') if has_request_context() else 'background'
+        self.slow_queries.inc(endpoint)
+        try:
+            plan = sqlite3.Cursor(conn).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+            plan = '\n'.join(f'    {row[3]}' for row in plan)
+        except sqlite3.Error as e:
+            plan = f'    (no plan: {e})'
+        print(f"Warning: Slow query ({seconds * 1000:.1f} ms) in {endpoint}: {' '.join(sql.split())}\n{plan}")
+
+    def _before_request(self):
+        g.profile = RequestProfile()
+
+    def _after_request(self, response):
+        profile = g.get('profile')
+        if profile is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        method = request.method
+        sent = [response.content_length]
+        if sent[0] is None and response.is_streamed:
+            response.response = count_bytes(response.response, sent)
+        elif sent[0] is None:
+            sent[0] = len(response.get_data())
+
+        def finish():
+            # After the body went out, so streamed responses count in full
+            self.request_seconds.observe(perf_counter() - profile.started, endpoint, method)
+            self.requests.inc(endpoint, method, response.status_code)
+            self.request_queries.observe(profile.queries, endpoint)
+            self.request_query_seconds.observe(profile.query_seconds, endpoint)
+            self.response_bytes.observe(sent[0] or 0, endpoint)
+        response.call_on_close(finish)
+        return response
+
+    def _before_render(self, app, template, context, **extra):
+        profile = current_profile()
+        if profile is not None:
+            profile.render_starts.append(perf_counter())
+
+    def _rendered(self, app, template, context, **extra):
+        profile = current_profile()
+        if profile is not None and profile.render_starts:
+            self.template_seconds.observe(perf_counter() - profile.render_starts.pop(), template.name or 'string')
+
+def count_bytes(chunks, sent):
+    sent[0] = 0
+    try:
+        for chunk in chunks:
+            sent[0] += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
@@ -0,0 +1,87 @@
+import threading
+import time
+from models.database import get_db
+
+class SessionCache:
+    """In-process TTL cache of validated (user_id, username) sessions.
+
+    Each entry remembers the user's session_version at the time it was
+    checked. A session cookie carrying the same version is trusted without
+    touching the users table until the entry expires.
+    """
+
+    def __init__(self, ttl=300, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id, username):
+        """Returns the cached session_version, or None if unknown/expired."""
+        key = (user_id, username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            version, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            return version
+
+    def put(self, user_id, username, version):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._evict_expired()
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[(user_id, username)] = (version, time.monotonic() + self.ttl)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for key in [k for k, (_, expires_at) in self._entries.items() if expires_at < now]:
+            del self._entries[key]
+
+session_cache = SessionCache()
+
+def check_session(user_id, username, version):
+    """True if the session still belongs to an existing, unchanged user.
+
+    Cache hits return without borrowing a database connection at all.
+    """
+    cached = session_cache.get(user_id, username)
+    if cached is not None and cached == version:
+        return True
+
+    user = get_db().execute(
+        'SELECT session_version FROM users WHERE id = ? AND username = ?',
+        (user_id, username)
+    ).fetchone()
+    if not user or user['session_version'] != version:
+        session_cache.invalidate(user_id)
+        return False
+
+    session_cache.put(user_id, username, version)
+    return True
+
+def invalidate_user_sessions(db, user_id):
+    """Call after deleting or changing a user (password, role, username).
+
+    Bumps the user's session_version so every existing cookie is rejected
+    and drops the user from this process's cache. Other worker processes
+    pick the change up once their cached entry expires. The caller commits.
+    """
+    db.execute(
+        'UPDATE users SET session_version = session_version + 1 WHERE id = ?',
+        (user_id,)
+    )
+    session_cache.invalidate(user_id)
@@ -0,0 +1,82 @@
+import errno
+import os
+import shutil
+import tempfile
+from flask import Request, current_app
+
+class UploadSpool:
+    """Temp file that an uploaded file is streamed into, chunk by chunk.
+
+    Werkzeug writes each chunk as it is parsed off the socket. Once the
+    file passes max_size the rest is discarded and too_large is set, so an
+    oversized upload never lands on disk in full. The temp file is deleted
+    when the request closes it unless publish() moved it into place first.
+    """
+
+    def __init__(self, directory, max_size):
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self.max_size = max_size
+        self.size = 0
+        self.too_large = False
+        self.published = False
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            if not self.too_large:
+                self.too_large = True
+                self._file.truncate(0)
+            return len(data)
+        return self._file.write(data)
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def readline(self, *args):
+        return self._file.readline(*args)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def publish(self, destination):
+        """Atomically move the finished upload to its final path."""
+        self._file.close()
+        try:
+            os.replace(self.path, destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Temp folder on another filesystem - copy then swap in place
+            staging = destination + '.part'
+            shutil.copyfile(self.path, staging)
+            os.replace(staging, destination)
+            os.remove(self.path)
+        self.published = True
+        try:
+            os.chmod(destination, 0o644)  # rw-r--r--
+        except OSError as perm_error:
+            print(f'Warning: Could not set file permissions for {destination}: {perm_error}')
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        if not self.published:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+class StreamingUploadRequest(Request):
+    """Request that streams multipart file parts into UploadSpool temp files."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        temp_folder = current_app.config['UPLOAD_TEMP_FOLDER']
+        os.makedirs(temp_folder, exist_ok=True)
+        return UploadSpool(temp_folder, current_app.config['LAB_RESULT_MAX_FILE_SIZE'])
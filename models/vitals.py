@@ -0,0 +1,355 @@
+import io
+import json
+import re
+from datetime import datetime, timedelta, timezone
+
+# Numeric readings that are rolled up; blood pressure counts as systolic
+# and diastolic
+VITAL_METRICS = ['systolic', 'diastolic', 'heart_rate', 'temperature', 'respiratory_rate', 'oxygen_saturation']
+
+# Rollup resolutions: how a reading's bucket start is computed in SQL, the
+# bucket length, and the widest range one trends request may ask for
+ROLLUP_RESOLUTIONS = {
+    'hour': {'start': "strftime('%Y-%m-%d %H:00:00', {value})", 'step': '+1 hour',
+             'default_span': timedelta(days=2), 'max_span': timedelta(days=31)},
+    'day': {'start': "strftime('%Y-%m-%d 00:00:00', {value})", 'step': '+1 day',
+            'default_span': timedelta(days=90), 'max_span': timedelta(days=3 * 366)},
+}
+
+# Accepted ranges, the same as the vitals form
+VITAL_RANGES = {
+    'systolic': (50, 250),
+    'diastolic': (30, 160),
+    'heart_rate': (30, 220),
+    'temperature': (32, 45),
+    'respiratory_rate': (5, 60),
+    'oxygen_saturation': (70, 100),
+}
+INTEGER_VITALS = {'systolic', 'diastolic', 'heart_rate', 'respiratory_rate', 'oxygen_saturation'}
+
+# Batch readings may be stamped this far ahead of the server clock
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+
+BLOOD_PRESSURE_RE = re.compile(r'^\s*(\d{2,3})\s*/\s*(\d{2,3})\s*$')
+
+def parse_blood_pressure(value):
+    """'120/80' -> (120, 80); (None, None) if it can't be read."""
+    match = BLOOD_PRESSURE_RE.match(value or '')
+    if not match:
+        return None, None
+    return int(match.group(1)), int(match.group(2))
+
+def rollup_columns():
+    return [f'{metric}_{part}' for metric in VITAL_METRICS for part in ('n', 'sum', 'min', 'max')]
+
+def init_vitals(db):
+    columns = {row[1] for row in db.execute('PRAGMA table_info(vitals)')}
+    if 'systolic' not in columns:
+        db.execute('ALTER TABLE vitals ADD COLUMN systolic INTEGER')
+        db.execute('ALTER TABLE vitals ADD COLUMN diastolic INTEGER')
+        backfill_blood_pressure(db)
+
+    # One row per patient, resolution and hour/day with the count, sum, min
+    # and max of each metric (n counts readings that have the metric)
+    created = not db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'vitals_rollups'"
+    ).fetchone()
+    metric_columns = ',\n'.join(
+        f'            {column} {"INTEGER NOT NULL DEFAULT 0" if column.endswith("_n") else "NUMERIC"}'
+        for column in rollup_columns()
+    )
+    db.execute(f'''
+        CREATE TABLE IF NOT EXISTS vitals_rollups (
+            patient_id INTEGER NOT NULL,
+            resolution TEXT NOT NULL,
+            period_start TEXT NOT NULL,
+            readings INTEGER NOT NULL,
+{metric_columns},
+            PRIMARY KEY (patient_id, resolution, period_start)
+        ) WITHOUT ROWID
+    ''')
+
+    # A new reading is folded into its hour and day; anything else recounts
+    # the buckets it touched from the (patient_id, recorded_at) index
+    for resolution in ROLLUP_RESOLUTIONS:
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS vitals_rollup_{resolution}_insert AFTER INSERT ON vitals BEGIN
+                {rollup_upsert_sql(resolution)}
+            END
+        ''')
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS vitals_rollup_{resolution}_update AFTER UPDATE ON vitals BEGIN
+                {rollup_recount_sql(resolution, 'OLD')}
+                {rollup_recount_sql(resolution, 'NEW')}
+            END
+        ''')
+        # Readings removed with their patient are dropped below in one go;
+        # the patient row is already gone while the cascade runs
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS vitals_rollup_{resolution}_delete AFTER DELETE ON vitals
+            WHEN EXISTS (SELECT 1 FROM patients WHERE id = OLD.patient_id) BEGIN
+                {rollup_recount_sql(resolution, 'OLD')}
+            END
+        ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS vitals_rollup_patient_delete AFTER DELETE ON patients BEGIN
+            DELETE FROM vitals_rollups WHERE patient_id = OLD.id;
+        END
+    ''')
+
+    if created:
+        rebuild_vitals_rollups(db)
+
+def backfill_blood_pressure(db):
+    """Fill systolic/diastolic from the blood_pressure text. The caller commits."""
+    rows = db.execute('SELECT id, blood_pressure FROM vitals WHERE systolic IS NULL').fetchall()
+    parsed = [(*parse_blood_pressure(row[1]), row[0]) for row in rows]
+    db.executemany('UPDATE vitals SET systolic = ?, diastolic = ? WHERE id = ?',
+                   [values for values in parsed if values[0] is not None])
+    unreadable = sum(1 for values in parsed if values[0] is None)
+    if unreadable:
+        print(f'Warning: {unreadable} vitals readings have an unreadable blood pressure; left out of trends')
+
+def rollup_upsert_sql(resolution):
+    start = ROLLUP_RESOLUTIONS[resolution]['start'].format(value='NEW.recorded_at')
+    columns = ', '.join(rollup_columns())
+    values = ', '.join(
+        f'NEW.{metric} IS NOT NULL, NEW.{metric}, NEW.{metric}, NEW.{metric}' for metric in VITAL_METRICS
+    )
+    updates = ',\n'.join(
+        f'{metric}_n = {metric}_n + excluded.{metric}_n, '
+        f'{metric}_sum = coalesce({metric}_sum + excluded.{metric}_sum, {metric}_sum, excluded.{metric}_sum), '
+        f'{metric}_min = min(coalesce({metric}_min, excluded.{metric}_min), coalesce(excluded.{metric}_min, {metric}_min)), '
+        f'{metric}_max = max(coalesce({metric}_max, excluded.{metric}_max), coalesce(excluded.{metric}_max, {metric}_max))'
+        for metric in VITAL_METRICS
+    )
+    return f'''
+        INSERT INTO vitals_rollups (patient_id, resolution, period_start, readings, {columns})
+        VALUES (NEW.patient_id, '{resolution}', {start}, 1, {values})
+        ON CONFLICT (patient_id, resolution, period_start) DO UPDATE SET
+            readings = readings + 1,
+            {updates};
+    '''
+
+def rollup_select_sql(resolution):
+    """SELECT of rollup rows from vitals v, for a WHERE and GROUP BY to be appended."""
+    start = ROLLUP_RESOLUTIONS[resolution]['start'].format(value='v.recorded_at')
+    aggregates = ', '.join(
+        f'COUNT(v.{metric}), SUM(v.{metric}), MIN(v.{metric}), MAX(v.{metric})' for metric in VITAL_METRICS
+    )
+    return f'''
+        INSERT INTO vitals_rollups (patient_id, resolution, period_start, readings, {', '.join(rollup_columns())})
+        SELECT v.patient_id, '{resolution}', {start}, COUNT(*), {aggregates}
+        FROM vitals v
+    '''
+
+def rollup_recount_sql(resolution, row):
+    start = ROLLUP_RESOLUTIONS[resolution]['start'].format(value=f'{row}.recorded_at')
+    step = ROLLUP_RESOLUTIONS[resolution]['step']
+    return f'''
+        DELETE FROM vitals_rollups
+        WHERE patient_id = {row}.patient_id AND resolution = '{resolution}' AND period_start = {start};
+        {rollup_select_sql(resolution)}
+        WHERE v.patient_id = {row}.patient_id
+          AND v.recorded_at >= {start} AND v.recorded_at < datetime({start}, '{step}')
+        GROUP BY v.patient_id;
+    '''
+
+def rebuild_vitals_rollups(db):
+    """Recompute every rollup from the vitals table. The caller commits."""
+    db.execute('DELETE FROM vitals_rollups')
+    for resolution in ROLLUP_RESOLUTIONS:
+        start = ROLLUP_RESOLUTIONS[resolution]['start'].format(value='v.recorded_at')
+        db.execute(f'{rollup_select_sql(resolution)} GROUP BY v.patient_id, {start}')
+
+def parse_trend_params(args, now=None):
+    """resolution, start, end and metrics of a trends request.
+
+    start/end are ISO dates or datetimes (UTC, like recorded_at); end
+    defaults to now and start to the resolution's default span before it.
+    metrics= is a comma-separated subset of VITAL_METRICS. Raises
+    ValueError on anything unknown or a range wider than max_span.
+    """
+    resolution = args.get('resolution', 'day')
+    if resolution not in ROLLUP_RESOLUTIONS:
+        raise ValueError(f'Unknown resolution: {resolution}')
+    spans = ROLLUP_RESOLUTIONS[resolution]
+    try:
+        end = datetime.fromisoformat(args['end']) if args.get('end') else (now or datetime.now(timezone.utc).replace(tzinfo=None))
+        start = datetime.fromisoformat(args['start']) if args.get('start') else end - spans['default_span']
+    except ValueError:
+        raise ValueError('Invalid start or end')
+    if start >= end:
+        raise ValueError('start must be before end')
+    if end - start > spans['max_span']:
+        raise ValueError(f"At most {spans['max_span'].days} days of {resolution} rollups per request")
+
+    metrics = VITAL_METRICS
+    if args.get('metrics'):
+        metrics = [name.strip() for name in args['metrics'].split(',') if name.strip()]
+        unknown = [name for name in metrics if name not in VITAL_METRICS]
+        if unknown:
+            raise ValueError(f"Unknown metrics: {', '.join(unknown)}")
+    return resolution, start, end, metrics
+
+def get_vitals_trends(db, patient_id, resolution, start, end, metrics=VITAL_METRICS):
+    """Rollup buckets starting in [start, end), oldest first, as chart-ready dicts.
+
+    Each bucket has period_start, readings and {metric: {min, max, mean}};
+    a metric with no readings in the bucket is None.
+    """
+    columns = ', '.join(f'{metric}_n, {metric}_sum, {metric}_min, {metric}_max' for metric in metrics)
+    rows = db.execute(f'''
+        SELECT period_start, readings, {columns}
+        FROM vitals_rollups
+        WHERE patient_id = ? AND resolution = ? AND period_start >= ? AND period_start < ?
+        ORDER BY period_start
+    ''', (patient_id, resolution, start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S')))
+    buckets = []
+    for row in rows:
+        bucket = {'period_start': row['period_start'], 'readings': row['readings']}
+        for metric in metrics:
+            count = row[f'{metric}_n']
+            bucket[metric] = {
+                'min': row[f'{metric}_min'],
+                'max': row[f'{metric}_max'],
+                'mean': round(row[f'{metric}_sum'] / count, 1),
+            } if count else None
+        buckets.append(bucket)
+    return buckets
+
+def read_vitals_batch(stream, ndjson, max_rows):
+    """Readings of a request body, as a list of (row number, reading).
+
+    The body is a JSON array, or with ndjson one JSON object per line read
+    straight off the stream. A line that isn't JSON becomes a reading of
+    None, reported by ingest_vitals. Raises ValueError if the body can't
+    be read at all or holds more than max_rows readings.
+    """
+    readings = []
+    if ndjson:
+        # Raw streams (like the WSGI input) read lines a byte at a time
+        if isinstance(stream, io.RawIOBase):
+            stream = io.BufferedReader(stream)
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                readings.append((number, json.loads(line)))
+            except ValueError:
+                readings.append((number, None))
+            if len(readings) > max_rows:
+                raise ValueError(f'At most {max_rows} readings per batch')
+        return readings
+    try:
+        body = json.load(stream)
+    except ValueError:
+        raise ValueError('Body is not valid JSON')
+    if not isinstance(body, list):
+        raise ValueError('Body must be a JSON array of readings')
+    if len(body) > max_rows:
+        raise ValueError(f'At most {max_rows} readings per batch')
+    return list(enumerate(body, 1))
+
+def parse_vital(reading, metric):
+    value = reading.get(metric)
+    if value is None or value == '':
+        if metric == 'oxygen_saturation':
+            return None
+        raise ValueError(f'{metric} is required')
+    if isinstance(value, bool):
+        raise ValueError(f'{metric} must be a number')
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{metric} must be a number')
+    if metric in INTEGER_VITALS:
+        if not number.is_integer():
+            raise ValueError(f'{metric} must be a whole number')
+        number = int(number)
+    low, high = VITAL_RANGES[metric]
+    if not low <= number <= high:
+        raise ValueError(f'{metric} must be between {low} and {high}')
+    return number
+
+def parse_recorded_at(value, now):
+    """ISO datetime (naive means UTC) -> the stored UTC text; None means now."""
+    if value is None or value == '':
+        return now.strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        recorded_at = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError('recorded_at must be an ISO date and time')
+    if recorded_at.tzinfo is not None:
+        recorded_at = recorded_at.astimezone(timezone.utc).replace(tzinfo=None)
+    if recorded_at > now + MAX_CLOCK_SKEW:
+        raise ValueError('recorded_at is in the future')
+    return recorded_at.strftime('%Y-%m-%d %H:%M:%S')
+
+def validate_reading(reading, patients, now, clean_notes=None):
+    """One reading -> the vitals row values. Raises ValueError with the reason."""
+    if not isinstance(reading, dict):
+        raise ValueError('Reading must be a JSON object')
+    patient_id = reading.get('patient_id')
+    if isinstance(patient_id, bool) or patient_id not in patients:
+        raise ValueError('Unknown patient_id')
+
+    if reading.get('blood_pressure'):
+        systolic, diastolic = parse_blood_pressure(str(reading['blood_pressure']))
+        if systolic is None:
+            raise ValueError('blood_pressure must be systolic/diastolic, e.g. 120/80')
+        reading = dict(reading, systolic=systolic, diastolic=diastolic)
+    values = {metric: parse_vital(reading, metric) for metric in VITAL_METRICS}
+
+    notes = reading.get('notes')
+    if notes is not None and not isinstance(notes, str):
+        raise ValueError('notes must be text')
+    if notes and clean_notes:
+        notes = clean_notes(notes)
+    return (
+        patient_id, f"{values['systolic']}/{values['diastolic']}", values['systolic'], values['diastolic'],
+        values['heart_rate'], values['temperature'], values['respiratory_rate'], values['oxygen_saturation'],
+        notes or None, parse_recorded_at(reading.get('recorded_at'), now)
+    )
+
+def ingest_vitals(db, readings, username, clean_notes=None, all_or_nothing=False):
+    """Validate (row number, reading) pairs and insert the valid ones.
+
+    Patients are looked up with one query and every reading is checked in
+    a single pass; the rows then go in with one executemany. With
+    all_or_nothing nothing is inserted if any reading is invalid. Returns
+    (rows inserted, [{'row': n, 'error': reason}, ...]). The caller
+    commits, so the whole batch is one transaction.
+    """
+    patient_ids = {
+        reading['patient_id'] for _, reading in readings
+        if isinstance(reading, dict) and isinstance(reading.get('patient_id'), int)
+        and not isinstance(reading['patient_id'], bool)
+    }
+    patients = set()
+    ids = list(patient_ids)
+    for offset in range(0, len(ids), 500):
+        chunk = ids[offset:offset + 500]
+        patients.update(row[0] for row in db.execute(
+            f"SELECT id FROM patients WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+        ))
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    rows, errors = [], []
+    for number, reading in readings:
+        if reading is None:
+            errors.append({'row': number, 'error': 'Line is not valid JSON'})
+            continue
+        try:
+            rows.append(validate_reading(reading, patients, now, clean_notes) + (username,))
+        except ValueError as e:
+            errors.append({'row': number, 'error': str(e)})
+
+    if errors and all_or_nothing:
+        return 0, errors
+    db.executemany('''
+        INSERT INTO vitals (patient_id, blood_pressure, systolic, diastolic, heart_rate, temperature,
+                            respiratory_rate, oxygen_saturation, notes, recorded_at, recorded_by)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    return len(rows), errors
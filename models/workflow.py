@@ -0,0 +1,239 @@
+from datetime import datetime, timedelta, timezone
+
+# A consultation's way through the clinic. Each stage is backed by the
+# status columns it writes: the first three by consultations.status, the
+# rest by prescriptions.status and prescriptions.pharmacy_status.
+STAGES = ('waiting', 'sent_to_lab', 'completed', 'paid', 'sent', 'dispensed', 'removed')
+CONSULTATION_STAGES = ('waiting', 'sent_to_lab', 'completed')
+
+# Moves the workflow allows. Staying in a stage is always allowed and
+# writes nothing; removed is reached by deleting the consultation.
+TRANSITIONS = {
+    'waiting': ('sent_to_lab', 'completed'),
+    'sent_to_lab': ('waiting',),
+    'completed': ('paid',),
+    'paid': ('sent',),
+    'sent': ('paid', 'dispensed'),  # back to the account when the pharmacy cancels
+    'dispensed': (),
+    'removed': (),
+}
+
+# (name, from, to) timestamp pairs reported by get_flow_metrics
+FLOW_INTERVALS = (
+    ('lab_turnaround', 'sent_to_lab_at', 'waiting_at'),
+    ('consultation', 'created_at', 'completed_at'),
+    ('payment', 'completed_at', 'paid_at'),
+    ('pharmacy_handoff', 'paid_at', 'sent_at'),
+    ('dispensing', 'sent_at', 'dispensed_at'),
+    ('total', 'created_at', 'dispensed_at'),
+)
+
+NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+def enter_stage_sql(stage):
+    """SET clause moving a patient_flow row into stage (an SQL expression)."""
+    stamps = ', '.join(
+        f"{name}_at = CASE WHEN {stage} = '{name}' THEN {NOW} ELSE {name}_at END" for name in STAGES
+    )
+    return f'''
+        stage = {stage}, stage_at = {NOW}, {stamps},
+        priority = CASE WHEN {stage} = 'sent_to_lab' THEN priority ELSE 0 END,
+        queued_at = CASE {stage}
+            WHEN 'waiting' THEN created_at
+            WHEN 'sent_to_lab' THEN {NOW}
+            WHEN 'completed' THEN {NOW}
+            ELSE COALESCE(completed_at, {NOW})
+        END
+    '''
+
+PRESCRIPTION_STAGE_SQL = '''
+    CASE WHEN NEW.pharmacy_status IN ('sent', 'dispensed') THEN NEW.pharmacy_status
+         WHEN NEW.status = 'paid' THEN 'paid'
+         ELSE 'completed' END
+'''
+
+def init_patient_flow(db):
+    # One row per consultation with its current stage, the ids of its
+    # latest exam and prescription, and when it last entered each stage.
+    # Queue pages read (stage, priority, queued_at) straight off the index.
+    # Rows are kept after the patient is archived so the timestamps still
+    # count towards throughput and wait times. Triggers keep them in step
+    # with the status columns, whoever writes those.
+    exists = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patient_flow'"
+    ).fetchone()
+    stamp_columns = ''.join(f'{name}_at TIMESTAMP,\n            ' for name in STAGES)
+    db.execute(f'''
+        CREATE TABLE IF NOT EXISTS patient_flow (
+            consultation_id INTEGER PRIMARY KEY,
+            patient_id INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            exam_id INTEGER,
+            prescription_id INTEGER,
+            created_at TIMESTAMP NOT NULL,
+            stage_at TIMESTAMP NOT NULL,
+            queued_at TIMESTAMP NOT NULL,
+            {stamp_columns}CHECK (stage IN ({', '.join(f"'{name}'" for name in STAGES)}))
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_patient_flow_queue ON patient_flow(stage, priority DESC, queued_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_patient_flow_created ON patient_flow(created_at)')
+
+    for name, event, action in (
+        ('consultation_insert', 'INSERT ON consultations', f'''
+            INSERT OR REPLACE INTO patient_flow (
+                consultation_id, patient_id, stage, created_at, stage_at, queued_at, waiting_at
+            ) VALUES (
+                NEW.id, NEW.patient_id, 'waiting',
+                COALESCE(NEW.created_at, {NOW}), {NOW}, COALESCE(NEW.created_at, {NOW}), {NOW}
+            );
+            UPDATE patient_flow SET {enter_stage_sql('NEW.status')}
+            WHERE consultation_id = NEW.id AND NEW.status IS NOT 'waiting';
+        '''),
+        ('consultation_update', 'UPDATE OF status ON consultations WHEN NEW.status IS NOT OLD.status',
+         f"UPDATE patient_flow SET {enter_stage_sql('NEW.status')} WHERE consultation_id = NEW.id;"),
+        ('consultation_delete', 'DELETE ON consultations', f'''
+            UPDATE patient_flow SET {enter_stage_sql("'removed'")}
+            WHERE consultation_id = OLD.id AND stage NOT IN ('dispensed', 'removed');
+        '''),
+        ('exam_insert', 'INSERT ON exams',
+         'UPDATE patient_flow SET exam_id = NEW.id, priority = 0 WHERE consultation_id = NEW.consultation_id;'),
+        ('exam_test_insert', 'INSERT ON exam_tests', '''
+            UPDATE patient_flow SET priority = MAX(priority, NEW.priority)
+            WHERE consultation_id = (SELECT consultation_id FROM exams WHERE id = NEW.exam_id)
+              AND exam_id = NEW.exam_id;
+        '''),
+        ('prescription_insert', 'INSERT ON prescriptions',
+         'UPDATE patient_flow SET prescription_id = NEW.id WHERE consultation_id = NEW.consultation_id;'),
+        ('prescription_update', 'UPDATE OF status, pharmacy_status ON prescriptions', f'''
+            UPDATE patient_flow SET {enter_stage_sql(PRESCRIPTION_STAGE_SQL)}
+            WHERE consultation_id = NEW.consultation_id AND prescription_id = NEW.id
+              AND stage IN ('completed', 'paid', 'sent') AND stage IS NOT {PRESCRIPTION_STAGE_SQL};
+        '''),
+    ):
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS patient_flow_{name} AFTER {event} BEGIN
+                {action}
+            END
+        ''')
+
+    if not exists:
+        rebuild_patient_flow(db)
+
+def rebuild_patient_flow(db):
+    """Recreate patient_flow rows from the status columns.
+
+    Only the times the tables record are known: arrival, the latest exam
+    and the prescription. Rows of consultations that no longer exist
+    are left alone.
+    """
+    db.execute('DELETE FROM patient_flow WHERE consultation_id IN (SELECT id FROM consultations)')
+    db.execute('''
+        WITH flow AS (
+            SELECT c.id AS consultation_id, c.patient_id, c.created_at,
+                   (SELECT MAX(id) FROM exams WHERE consultation_id = c.id) AS exam_id,
+                   pr.id AS prescription_id, pr.prescribed_at,
+                   CASE WHEN c.status = 'completed' AND pr.pharmacy_status IN ('sent', 'dispensed') THEN pr.pharmacy_status
+                        WHEN c.status = 'completed' AND pr.status = 'paid' THEN 'paid'
+                        ELSE COALESCE(c.status, 'waiting') END AS stage
+            FROM consultations c
+            LEFT JOIN prescriptions pr ON pr.id = (SELECT MAX(id) FROM prescriptions WHERE consultation_id = c.id)
+        )
+        INSERT INTO patient_flow (
+            consultation_id, patient_id, stage, priority, exam_id, prescription_id,
+            created_at, stage_at, queued_at, waiting_at, sent_to_lab_at, completed_at
+        )
+        SELECT f.consultation_id, f.patient_id, f.stage,
+               CASE WHEN f.stage = 'sent_to_lab'
+                    THEN COALESCE((SELECT MAX(priority) FROM exam_tests WHERE exam_id = f.exam_id), 0)
+                    ELSE 0 END,
+               f.exam_id, f.prescription_id, f.created_at,
+               COALESCE(CASE WHEN f.stage = 'sent_to_lab' THEN e.created_at END, f.prescribed_at, f.created_at),
+               CASE f.stage WHEN 'waiting' THEN f.created_at
+                            WHEN 'sent_to_lab' THEN COALESCE(e.created_at, f.created_at)
+                            ELSE COALESCE(f.prescribed_at, f.created_at) END,
+               f.created_at, e.created_at, f.prescribed_at
+        FROM flow f
+        LEFT JOIN exams e ON e.id = f.exam_id
+    ''')
+
+def get_flow(db, consultation_id):
+    """The patient_flow row of a consultation, or None."""
+    return db.execute('SELECT * FROM patient_flow WHERE consultation_id = ?', (consultation_id,)).fetchone()
+
+def move_to(db, consultation_id, stage):
+    """Move a consultation to stage by writing the status columns behind it.
+
+    Raises ValueError if the consultation is unknown or the workflow does
+    not allow the move. patient_flow follows through its triggers. The
+    caller commits, so the move lands together with the rest of the change.
+    """
+    flow = db.execute(
+        'SELECT stage, prescription_id FROM patient_flow WHERE consultation_id = ?', (consultation_id,)
+    ).fetchone()
+    if flow is None:
+        raise ValueError(f'Consultation {consultation_id} not found')
+    if stage == flow['stage']:
+        return
+    if stage not in TRANSITIONS.get(flow['stage'], ()):
+        raise ValueError(f"Cannot move a patient from {flow['stage']} to {stage}")
+
+    if stage in CONSULTATION_STAGES:
+        db.execute('UPDATE consultations SET status = ? WHERE id = ?', (stage, consultation_id))
+    elif flow['prescription_id'] is None:
+        raise ValueError(f'Consultation {consultation_id} has no prescription')
+    elif stage == 'paid':
+        db.execute(
+            "UPDATE prescriptions SET status = 'paid', pharmacy_status = 'not_sent' WHERE id = ?",
+            (flow['prescription_id'],)
+        )
+    else:
+        db.execute('UPDATE prescriptions SET pharmacy_status = ? WHERE id = ?', (stage, flow['prescription_id']))
+
+def get_flow_metrics(db, hours=24, now=None):
+    """Queue lengths now, and stage throughput and wait times of the
+    consultations that arrived in the last hours. The completed queue is
+    the patients waiting to pay for a prescription.
+
+    Waits are in minutes: mean and max over the consultations that have
+    both timestamps of an interval.
+    """
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    since = (now - timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')
+    # A consultation completed without a prescription stays at completed
+    # but is not waiting for anyone, so only rows with one are queued there
+    queues = {
+        row['stage']: {'patients': row['patients'], 'oldest': row['oldest']}
+        for row in db.execute('''
+            SELECT stage, COUNT(*) AS patients, CAST(MIN(stage_at) AS TEXT) AS oldest
+            FROM patient_flow
+            WHERE stage IN ('waiting', 'sent_to_lab', 'completed', 'paid', 'sent')
+              AND (stage <> 'completed' OR prescription_id IS NOT NULL)
+            GROUP BY stage
+        ''')
+    }
+    minutes = "(julianday({end}) - julianday({start})) * 1440"
+    columns = ['COUNT(*) AS arrived'] + [f'COUNT({name}_at) AS {name}' for name in STAGES[1:]]
+    for name, start, end in FLOW_INTERVALS:
+        span = minutes.format(start=start, end=end)
+        valid = f'{end} >= {start}'
+        columns.append(f'AVG(CASE WHEN {valid} THEN {span} END) AS {name}_mean')
+        columns.append(f'MAX(CASE WHEN {valid} THEN {span} END) AS {name}_max')
+    row = db.execute(f'''
+        SELECT {', '.join(columns)}
+        FROM patient_flow
+        WHERE created_at >= ?
+    ''', (since,)).fetchone()
+    return {
+        'since': since,
+        'queues': queues,
+        'throughput': {name: row[name] for name in ('arrived',) + STAGES[1:]},
+        'waits': {
+            name: {
+                'mean': round(row[f'{name}_mean'], 1) if row[f'{name}_mean'] is not None else None,
+                'max': round(row[f'{name}_max'], 1) if row[f'{name}_max'] is not None else None,
+            }
+            for name, _, _ in FLOW_INTERVALS
+        },
+    }
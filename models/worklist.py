@@ -0,0 +1,160 @@
+from collections import namedtuple
+
+# Lab benches; each works the pending tests of its lab_tests.category
+LAB_QUEUES = {
+    'chemistry': 'Blood Chemistry',
+    'hematology': 'Hematology',
+    'microscopy': 'Urine & Stool',
+    'imaging': 'Imaging',
+    'cardiology': 'ECG',
+    'general': 'General',
+}
+
+# Exam request urgency, highest claimed first
+LAB_PRIORITIES = {0: 'routine', 1: 'urgent', 2: 'stat'}
+
+QueueSummary = namedtuple('QueueSummary', 'queue name pending urgent oldest in_progress')
+
+def queue_test_ids(db, queue):
+    return [row['id'] for row in db.execute(
+        'SELECT id FROM lab_tests WHERE category = ? AND active = 1', (queue,)
+    )]
+
+def get_queue_summary(db):
+    """Pending and claimed counts for every bench that has tests."""
+    counts = {row['category']: row for row in db.execute('''
+        SELECT t.category,
+               SUM(et.status = 'pending') AS pending,
+               SUM(et.status = 'pending' AND et.priority > 0) AS urgent,
+               MIN(CASE WHEN et.status = 'pending' THEN et.created_at END) AS oldest,
+               SUM(et.status = 'in_progress') AS in_progress
+        FROM lab_tests t
+        JOIN exam_tests et ON et.test_id = t.id AND et.status IN ('pending', 'in_progress')
+        WHERE t.active = 1
+        GROUP BY t.category
+    ''')}
+    categories = [row['category'] for row in db.execute(
+        'SELECT DISTINCT category FROM lab_tests WHERE active = 1'
+    )]
+    queues = [queue for queue in LAB_QUEUES if queue in categories]
+    queues += sorted(set(categories) - set(LAB_QUEUES))
+
+    summary = []
+    for queue in queues:
+        row = counts.get(queue)
+        summary.append(QueueSummary(
+            queue, LAB_QUEUES.get(queue, queue.title()),
+            row['pending'] if row else 0,
+            row['urgent'] if row else 0,
+            row['oldest'] if row else None,
+            row['in_progress'] if row else 0
+        ))
+    return summary
+
+def claim_next(db, queue, username, claim_timeout=1800):
+    """Atomically hand the bench's most urgent, oldest pending test to username.
+
+    Runs under BEGIN IMMEDIATE, so the pick and the claim happen while this
+    connection holds SQLite's write lock: two technicians (in any worker
+    process) can never claim the same test. Claims older than
+    claim_timeout seconds are returned to the queue first. Returns the
+    claimed exam_tests row or None when the queue is empty.
+    """
+    test_ids = queue_test_ids(db, queue)
+    if not test_ids:
+        return None
+    placeholders = ', '.join('?' * len(test_ids))
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        db.execute(f'''
+            UPDATE exam_tests SET status = 'pending', claimed_by = NULL, claimed_at = NULL
+            WHERE test_id IN ({placeholders}) AND status = 'in_progress' AND claimed_at < datetime('now', ?)
+        ''', (*test_ids, f'-{int(claim_timeout)} seconds'))
+
+        # Each test's index range is already in worklist order, so only the
+        # head of every test's queue has to be compared
+        heads = ' UNION ALL '.join(['''
+            SELECT * FROM (
+                SELECT id, priority, created_at FROM exam_tests
+                WHERE test_id = ? AND status = 'pending'
+                ORDER BY priority DESC, created_at, id LIMIT 1
+            )'''] * len(test_ids))
+        item = db.execute(f'''
+            SELECT et.id, et.exam_id, e.patient_id, t.name AS test_name, p.name AS patient_name
+            FROM ({heads}) head
+            JOIN exam_tests et ON et.id = head.id
+            JOIN lab_tests t ON t.id = et.test_id
+            JOIN exams e ON e.id = et.exam_id
+            JOIN patients p ON p.id = e.patient_id
+            ORDER BY head.priority DESC, head.created_at, head.id
+            LIMIT 1
+        ''', test_ids).fetchone()
+
+        if item:
+            db.execute('''
+                UPDATE exam_tests SET status = 'in_progress', claimed_by = ?, claimed_at = datetime('now')
+                WHERE id = ?
+            ''', (username, item['id']))
+            db.execute("UPDATE exams SET status = 'in_progress' WHERE id = ? AND status = 'pending'", (item['exam_id'],))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return item
+
+def release_claim(db, exam_test_id, username):
+    """Put a test claimed by username back in its queue. The caller commits."""
+    cursor = db.execute('''
+        UPDATE exam_tests SET status = 'pending', claimed_by = NULL, claimed_at = NULL
+        WHERE id = ? AND status = 'in_progress' AND claimed_by = ?
+    ''', (exam_test_id, username))
+    return cursor.rowcount > 0
+
+def get_claimed_tests(db, username):
+    return db.execute('''
+        SELECT et.id, et.exam_id, et.priority, et.claimed_at, t.name AS test_name, t.short_name,
+               e.patient_id, e.presenting_complaint, e.history_of_complaint, e.clinical_details,
+               p.name AS patient_name
+        FROM exam_tests et
+        JOIN lab_tests t ON t.id = et.test_id
+        JOIN exams e ON e.id = et.exam_id
+        JOIN patients p ON p.id = e.patient_id
+        WHERE et.claimed_by = ? AND et.status = 'in_progress'
+        ORDER BY et.priority DESC, et.claimed_at
+    ''', (username,)).fetchall()
+
+def workable_tests(tests, username):
+    """Tests of an exam that username may enter results for: unclaimed
+    pending ones and the ones they claimed."""
+    return [
+        test for test in tests
+        if test['status'] == 'pending'
+        or (test['status'] == 'in_progress' and test['claimed_by'] == username)
+    ]
+
+def get_lab_queue(db, exam_ids=None):
+    """Exams waiting for the lab, highest priority then oldest first.
+
+    Read off the patient_flow queue index. With exam_ids only those (if
+    still waiting) are returned.
+    """
+    ids = list(exam_ids or [])
+    only = f"AND e.id IN ({', '.join('?' * len(ids))})" if exam_ids is not None else ''
+    return db.execute(f'''
+        SELECT 
+            e.id as exam_id,
+            e.patient_id,
+            p.name,
+            p.gender,
+            p.date_of_birth,
+            e.presenting_complaint,
+            e.history_of_complaint,
+            e.clinical_details,
+            e.created_at
+        FROM patient_flow f
+        JOIN exams e ON e.id = f.exam_id
+        JOIN patients p ON e.patient_id = p.id
+        WHERE f.stage = 'sent_to_lab' AND e.status IN ('pending', 'in_progress') {only}
+        ORDER BY f.priority DESC, f.queued_at ASC
+    ''', ids).fetchall()
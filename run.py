@@ -1,46 +1,252 @@
 # Production runner for the app
+#
+# Serves the app with a pre-forked pool of worker processes, each handling
+# requests on a fixed pool of threads:
+#
+#   CMS_WORKERS=4 CMS_THREADS=8 python run.py
+#
+# Signals (Unix): HUP gracefully reloads workers with fresh code,
+# TERM/INT shut down after in-flight requests finish. Crashed workers are
+# restarted automatically. On Windows a single threaded worker is used.
 
 import os
+import signal
+import socket
+import subprocess
 import sys
-from app import app
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
 def check_environment():
+    from app import app  # runs init_db() once, before any worker starts
+
     print("Clinical Management System")
     print("Starting up...\n")
-    
+
     # Check Python version
     if sys.version_info < (3, 8):
         print("ERROR: Python 3.8 or higher is required!")
         print(f"Current version: {sys.version}")
         sys.exit(1)
-    
+
     print(f"✓ Python version: {sys.version.split()[0]}")
-    
+
     db_path = app.config['DATABASE']
     if os.path.exists(db_path):
         print(f"Database: {db_path}")
     else:
         print(f"Will create database: {db_path}")
-    
-    if not os.path.exists('templates'):
+
+    if not os.path.exists(os.path.join(BASE_DIR, 'templates')):
         print("ERROR: Templates folder not found!")
         sys.exit(1)
     print("Templates OK\n")
 
-def main():
-    check_environment()
-    
+class RequestHandler(WSGIRequestHandler):
+    # One request per connection so idle keep-alive sockets can't tie up
+    # the worker's fixed thread pool
+    protocol_version = 'HTTP/1.0'
+    timeout = 60  # drop clients that stall mid-request
+
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """WSGI server that handles requests on a bounded pool of threads."""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=8, fd=None, multiprocess=False):
+        self.multiprocess = multiprocess
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='cms-request')
+        # One slot per thread, taken before accept(): a busy worker leaves
+        # new connections in the shared listen queue for the other workers
+        # instead of queueing them behind its own requests
+        self.slots = threading.BoundedSemaphore(threads)
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        # Workers share the listening socket; whoever loses the race for a
+        # connection gets BlockingIOError instead of hanging in accept()
+        self.socket.setblocking(False)
+
+    def _handle_request_noblock(self):
+        # Give up after a while so serve_forever() still notices shutdown();
+        # the listening socket stays readable, so it comes straight back here
+        if not self.slots.acquire(timeout=0.5):
+            return
+        try:
+            request, client_address = self.get_request()
+        except OSError:
+            self.slots.release()
+            return
+        if self.verify_request(request, client_address):
+            try:
+                self.process_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+                self.slots.release()
+            except:
+                self.shutdown_request(request)
+                self.slots.release()
+                raise
+        else:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def drain(self):
+        # Let in-flight requests finish, then release the thread pool
+        self.executor.shutdown(wait=True)
+
+def serve_worker(host, port, threads, fd=None, multiprocess=False):
+    """Run one worker until it receives SIGTERM (or CTRL+C when standalone)."""
+    from app import app, start_background_jobs
+    from models.database import get_pool
+
     app.config['DEBUG'] = False
     app.config['TESTING'] = False
-    
+    # Patients queued for the archive before a restart don't wait for the next dispense
+    start_background_jobs()
+
+    server = ThreadPoolWSGIServer(host, port, app, threads=threads, fd=fd, multiprocess=multiprocess)
+
+    def stop(signum, frame):
+        # shutdown() blocks until serve_forever() returns, so it can't run
+        # on the thread that is serving
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    if multiprocess:
+        # The supervisor decides when workers stop
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.drain()
+        get_pool(app).close_all()
+
+class Supervisor:
+    """Pre-fork style process manager for the worker processes."""
+
+    def __init__(self, host, port, workers, threads, graceful_timeout=30):
+        self.host = host
+        self.port = port
+        self.worker_count = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.workers = []
+        self.reload_requested = False
+        self.stop_requested = False
+
+    def spawn_worker(self):
+        # Workers import the app themselves, so a reload picks up new code
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker', str(self.sock.fileno())],
+            pass_fds=(self.sock.fileno(),),
+            cwd=BASE_DIR
+        )
+        self.workers.append(process)
+        return process
+
+    def stop_workers(self, workers):
+        for process in workers:
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        for process in workers:
+            try:
+                process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def reload(self):
+        print("Reloading workers...", flush=True)
+        old_workers = self.workers
+        self.workers = []
+        for _ in range(self.worker_count):
+            self.spawn_worker()
+        # Old workers keep serving their in-flight requests while they stop
+        self.stop_workers(old_workers)
+
+    def run(self):
+        self.sock = socket.create_server((self.host, self.port), backlog=128)
+        self.sock.set_inheritable(True)
+
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, 'reload_requested', True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'stop_requested', True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, 'stop_requested', True))
+
+        for _ in range(self.worker_count):
+            self.spawn_worker()
+
+        try:
+            while not self.stop_requested:
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+
+                for process in list(self.workers):
+                    if process.poll() is not None:
+                        print(f"Worker {process.pid} exited with code {process.returncode}, restarting", flush=True)
+                        self.workers.remove(process)
+                        time.sleep(1)  # avoid a tight restart loop on startup errors
+                        self.spawn_worker()
+
+                time.sleep(0.5)
+        finally:
+            print("\nShutting down...")
+            self.stop_workers(self.workers)
+            self.sock.close()
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--worker':
+        serve_worker(
+            os.environ.get('CMS_HOST', '0.0.0.0'),
+            int(os.environ.get('CMS_PORT', 5001)),
+            int(os.environ.get('CMS_THREADS', 8)),
+            fd=int(sys.argv[2]),
+            multiprocess=True
+        )
+        return
+
+    check_environment()
+    if os.name != 'nt':
+        # The supervisor never serves requests; only workers hold connections
+        from app import app
+        from models.database import get_pool
+        get_pool(app).close_all()
+
     host = os.environ.get('CMS_HOST', '0.0.0.0')
     port = int(os.environ.get('CMS_PORT', 5001))  # Changed to 5001 for macOS Monterey+ compatibility
-    
+    workers = int(os.environ.get('CMS_WORKERS', 2))
+    threads = int(os.environ.get('CMS_THREADS', 8))
+
     print(f"Starting server on http://{host}:{port}")
     print("Press CTRL+C to stop\n")
-    
+
     try:
-        app.run(host=host, port=port, debug=False)
+        if os.name == 'nt':
+            # No fork or fd passing on Windows: one process, many threads
+            print(f"Workers: 1  Threads: {threads}")
+            serve_worker(host, port, threads)
+        else:
+            print(f"Workers: {workers}  Threads per worker: {threads}")
+            Supervisor(host, port, workers, threads,
+                       graceful_timeout=int(os.environ.get('CMS_GRACEFUL_TIMEOUT', 30))).run()
     except KeyboardInterrupt:
         print("\nShutting down...")
         sys.exit(0)
@@ -49,4 +255,4 @@ def main():
         sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()